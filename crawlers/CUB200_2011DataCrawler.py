@@ -1,9 +1,10 @@
-import glob
 import math
 import os
 import random
 
 import utils.splits.cub200
+from .CrawlTable import compact_metadata
+from .DirectoryIndex import DirectoryIndex
 
 
 class CUB200_2011DataCrawler:
@@ -14,11 +15,13 @@ class CUB200_2011DataCrawler:
     self.image_folder = os.path.join(self.data_folder, "images")
 
     self.logger = kwargs.get("logger")
+    self.crawl_workers = kwargs.get("crawl_workers", 8)
 
     self.__verify(self.data_folder)
     self.__verify(self.image_folder)
 
     self.crawl()
+    compact_metadata(self.metadata)   # numpy-backed crawl lists, shared by loader workers without copy-on-write
 
   def __verify(self,folder):
     if not os.path.exists(folder):
@@ -37,11 +40,12 @@ class CUB200_2011DataCrawler:
   def __crawl(self,image_folder):
     # Data/CUB_200_2011/images contains one folder for each of the 200 classes...
     crawler = []
-    class_list = glob.glob(image_folder+"/*")
+    index = DirectoryIndex(image_folder, workers=self.crawl_workers)   # one concurrent walk, then class folders are listed from memory
+    class_list = index.glob(image_folder, "*")
     for class_folder in class_list:
         folder_name = os.path.basename(class_folder)
         class_name = int(folder_name.split(".")[0])
-        image_list = glob.glob(class_folder + "/*.jpg")
+        image_list = index.glob(class_folder, "*.jpg")
         crawler += [(item, class_name, 0) for item in image_list]
         
     # crawler is a list of 3-tuples. Length of N=number of images.
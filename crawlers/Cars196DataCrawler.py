@@ -1,6 +1,7 @@
 import os
 import glob
 import random, math
+from .CrawlTable import compact_metadata
 
 class Cars196DataCrawler:
   def __init__(self,data_folder="Cars196", train_folder="cars_train", test_folder="cars_test", query_folder="", **kwargs):
@@ -19,6 +20,7 @@ class Cars196DataCrawler:
     self.__verify(self.query_folder)
 
     self.crawl()
+    compact_metadata(self.metadata)   # numpy-backed crawl lists, shared by loader workers without copy-on-write
 
   def __verify(self,folder):
     if not os.path.exists(folder):
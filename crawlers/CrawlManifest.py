@@ -0,0 +1,134 @@
+import glob
+import json
+import os
+import time
+
+import numpy as np
+
+
+class CrawlManifest:
+  """ Cache of directory listings and parsed labels, so crawlers do not re-scan unchanged folders at every start-up.
+
+  Each scanned folder is stored with the mtime and size of the directory. Adding, removing, or renaming a file changes the directory's mtime, so a folder whose stat still matches is read from the manifest: no listing, and no parsing of file names. Folders whose stat changed are scanned again, and only those. Text files, like VeRi's test_track.txt, are cached the same way, keyed on their own mtime and size.
+
+  The manifest is one binary .npz file: a JSON header with each entry's key and stat, and per entry a uint8 buffer of names with int64 offsets, and an int64 array of parsed labels. A folder modified in the last few seconds is not cached, since a file added within the same mtime tick would not change its stat.
+
+  Args:
+    path (str): Manifest file. None disables caching: every scan lists the folder.
+    logger (logging.Logger): Optional. Logs rescans and failures to write the manifest.
+
+  Methods:
+    for_crawler(data_folder, manifest, logger): From a crawler's `manifest` kwarg
+    scan(folder, pattern, parse, key): (path, *labels) of the files of folder matching pattern
+    lines(path, key): Space-split lines of a text file
+    save(): Write the manifest, if anything was rescanned
+  """
+  VERSION = 1
+  SETTLE_SECONDS = 2.
+
+  def __init__(self, path=None, logger=None):
+    self.path = path
+    self.logger = logger
+    self.entries = {}
+    self.changed = False
+    if path is not None and os.path.exists(path):
+      try:
+        self._load()
+      except (IOError, OSError, ValueError, KeyError) as error:
+        self._log("Ignoring unreadable crawl manifest {}: {}".format(path, error))
+        self.entries = {}
+
+  @classmethod
+  def for_crawler(cls, data_folder, manifest=False, logger=None):
+    """ False or None disables caching. True puts the manifest next to data_folder, as <data_folder>.manifest.npz. A str is the manifest path. """
+    if not manifest:
+      return cls(None, logger)
+    if manifest is True:
+      manifest = os.path.abspath(data_folder).rstrip(os.sep) + ".manifest.npz"
+    return cls(manifest, logger)
+
+  def _log(self, message):
+    if self.logger is not None:
+      self.logger.info(message)
+
+  def _stat(self, path):
+    stat = os.stat(path)
+    return [int(stat.st_mtime_ns), int(stat.st_size)]
+
+  def _cached(self, key, stat):
+    entry = self.entries.get(key)
+    if entry is not None and entry["stat"] == stat:
+      return entry
+    return None
+
+  def _store(self, key, stat, names, ints):
+    if self.path is None or time.time() - stat[0] / 1e9 < self.SETTLE_SECONDS:
+      return
+    self.entries[key] = {"stat": stat, "names": names, "ints": ints}
+    self.changed = True
+
+  def scan(self, folder, pattern, parse, key=""):
+    """ Files of folder matching the glob pattern, as (path, *parse(path)) tuples, in glob order.
+
+    Args:
+      folder (str): Folder to list
+      pattern (str): Glob pattern of file names, e.g. '*.jpg'
+      parse (callable): Path to a tuple of ints, e.g. (pid, cid)
+      key (str): Identifies parse, e.g. its regex, so a changed parser does not read stale labels
+    """
+    entry_key = json.dumps(["scan", os.path.abspath(folder), pattern, key])
+    stat = self._stat(folder)
+    entry = self._cached(entry_key, stat)
+    if entry is not None:
+      return [(os.path.join(folder, name),) + tuple(labels) for name, labels in zip(entry["names"], entry["ints"].tolist())]
+    paths = glob.glob(os.path.join(folder, pattern))
+    labels = [tuple(int(label) for label in parse(path)) for path in paths]
+    if self.path is not None:
+      self._log("Scanned {} files in {}".format(len(paths), folder))
+    self._store(entry_key, stat, [os.path.basename(path) for path in paths], np.array(labels, dtype=np.int64).reshape(len(labels), -1 if labels else 0))
+    return [(path,) + label for path, label in zip(paths, labels)]
+
+  def lines(self, path, key=""):
+    """ Lines of a text file, stripped and split on spaces """
+    entry_key = json.dumps(["lines", os.path.abspath(path), key])
+    stat = self._stat(path)
+    entry = self._cached(entry_key, stat)
+    if entry is not None:
+      ends = np.cumsum(entry["ints"]).tolist()
+      return [entry["names"][end - length:end] for end, length in zip(ends, entry["ints"].tolist())]
+    with open(path, "r") as text_file:
+      lines = [line.strip().split(" ") for line in text_file]
+    self._store(entry_key, stat, [token for line in lines for token in line], np.array([len(line) for line in lines], dtype=np.int64))
+    return lines
+
+  def _load(self):
+    with np.load(self.path, allow_pickle=False) as manifest:
+      header = json.loads(manifest["header"].tobytes().decode("utf-8"))
+      if header["version"] != self.VERSION:
+        raise ValueError("version {}, expected {}".format(header["version"], self.VERSION))
+      for idx, (key, stat) in enumerate(header["entries"]):
+        buffer, offsets = manifest["names_%d" % idx].tobytes(), manifest["offsets_%d" % idx].tolist()
+        names = [buffer[start:end].decode("utf-8") for start, end in zip(offsets[:-1], offsets[1:])]
+        self.entries[key] = {"stat": stat, "names": names, "ints": manifest["ints_%d" % idx]}
+
+  def save(self):
+    if self.path is None or not self.changed:
+      return
+    header = {"version": self.VERSION, "entries": []}
+    arrays = {}
+    for idx, (key, entry) in enumerate(self.entries.items()):
+      header["entries"].append([key, entry["stat"]])
+      encoded = [name.encode("utf-8") for name in entry["names"]]
+      arrays["names_%d" % idx] = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+      arrays["offsets_%d" % idx] = np.concatenate([np.zeros(1, dtype=np.int64), np.cumsum([len(name) for name in encoded], dtype=np.int64)])
+      arrays["ints_%d" % idx] = entry["ints"]
+    arrays["header"] = np.frombuffer(json.dumps(header).encode("utf-8"), dtype=np.uint8)
+    try:
+      temporary = "{}.{}.tmp".format(self.path, os.getpid())    # per process, as every rank of a multi-process run crawls
+      with open(temporary, "wb") as manifest_file:
+        np.savez(manifest_file, **arrays)
+      os.replace(temporary, self.path)
+      self.changed = False
+      self._log("Wrote crawl manifest {}".format(self.path))
+    except (IOError, OSError) as error:
+      self._log("Could not write crawl manifest {}: {}".format(self.path, error))
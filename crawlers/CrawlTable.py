@@ -0,0 +1,88 @@
+import numpy as np
+
+
+class CrawlTable:
+  """ Compact, read-only list of (path, pid, cid) crawl entries, stored as a few numpy arrays.
+
+  A list of tuples is made of millions of small Python objects. DataLoader workers forked from the training process share them copy-on-write, but reading an entry updates its refcount, so each worker slowly copies every page of the list and resident memory grows with the number of workers. A CrawlTable keeps all paths in one uint8 buffer with int64 offsets, pids as int32, and cids as int16 (int32 if they do not fit), so reads never write to shared pages.
+
+  Indexing, iteration, len, slicing, and + behave as for the list of tuples, so existing code keeps working. Entries are rebuilt as (str, int, int) on access.
+
+  Args:
+    paths (list): Image paths
+    pids, cids (array-like): Identity and camera of each image
+
+  Attributes:
+    pids (ndarray): int32 identities
+    cids (ndarray): int16 (or int32) cameras
+  """
+  def __init__(self, paths=(), pids=(), cids=()):
+    encoded = [str(path).encode("utf-8") for path in paths]
+    lengths = np.array([len(path) for path in encoded], dtype=np.int64)
+    self.offsets = np.concatenate([np.zeros(1, dtype=np.int64), np.cumsum(lengths)])
+    self.buffer = np.frombuffer(b"".join(encoded), dtype=np.uint8).copy()
+    self.pids = np.asarray(pids, dtype=np.int32).reshape(-1)
+    cids = np.asarray(cids, dtype=np.int64).reshape(-1)
+    fits = len(cids) == 0 or (cids.min() >= np.iinfo(np.int16).min and cids.max() <= np.iinfo(np.int16).max)
+    self.cids = cids.astype(np.int16 if fits else np.int32)
+
+  @classmethod
+  def from_entries(cls, entries):
+    """ From a list of (path, pid, cid) tuples """
+    entries = list(entries)
+    return cls([entry[0] for entry in entries], [entry[1] for entry in entries], [entry[2] for entry in entries])
+
+  @classmethod
+  def _from_arrays(cls, buffer, offsets, pids, cids):
+    table = cls.__new__(cls)
+    table.buffer, table.offsets, table.pids, table.cids = buffer, offsets, pids, cids
+    return table
+
+  def __len__(self):
+    return len(self.pids)
+
+  def path(self, idx):
+    return self.buffer[self.offsets[idx]:self.offsets[idx + 1]].tobytes().decode("utf-8")
+
+  @property
+  def paths(self):
+    return [self.path(idx) for idx in range(len(self))]
+
+  def __getitem__(self, idx):
+    if isinstance(idx, slice):
+      start, stop, step = idx.indices(len(self))
+      if step != 1:
+        return CrawlTable.from_entries(self[i] for i in range(start, stop, step))
+      stop = max(start, stop)
+      return CrawlTable._from_arrays(self.buffer[self.offsets[start]:self.offsets[stop]], self.offsets[start:stop + 1] - self.offsets[start], self.pids[start:stop], self.cids[start:stop])
+    if idx < 0:
+      idx += len(self)
+    if not 0 <= idx < len(self):
+      raise IndexError("CrawlTable index out of range")
+    return self.path(idx), int(self.pids[idx]), int(self.cids[idx])
+
+  def __iter__(self):
+    for idx in range(len(self)):
+      yield self[idx]
+
+  def __add__(self, other):
+    if not isinstance(other, CrawlTable):
+      other = CrawlTable.from_entries(other)
+    cids_dtype = np.promote_types(self.cids.dtype, other.cids.dtype)
+    return CrawlTable._from_arrays(np.concatenate([self.buffer, other.buffer]), np.concatenate([self.offsets, other.offsets[1:] + self.offsets[-1]]),
+                                   np.concatenate([self.pids, other.pids]), np.concatenate([self.cids.astype(cids_dtype), other.cids.astype(cids_dtype)]))
+
+  def __radd__(self, other):
+    return CrawlTable.from_entries(other) + self
+
+  @property
+  def nbytes(self):
+    return self.buffer.nbytes + self.offsets.nbytes + self.pids.nbytes + self.cids.nbytes
+
+
+def compact_metadata(metadata, splits=("train", "test", "query")):
+  """ Replace the image-level crawl lists of a crawler's metadata with CrawlTables, in place. Returns metadata. """
+  for split in splits:
+    if split in metadata and "crawl" in metadata[split] and not isinstance(metadata[split]["crawl"], CrawlTable):
+      metadata[split]["crawl"] = CrawlTable.from_entries(metadata[split]["crawl"])
+  return metadata
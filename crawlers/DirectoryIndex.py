@@ -0,0 +1,68 @@
+import fnmatch
+import os
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+
+class DirectoryIndex:
+  """ In-memory index of a directory tree, listed once with os.scandir from a thread pool.
+
+  Crawlers of per-class folder datasets probe many candidate paths with os.path.exists and list each class folder with its own glob, one filesystem round-trip at a time. Walking the tree once, with many directories listed concurrently, and answering those lookups from memory costs one listing per directory, with the latency of network storage overlapped across threads.
+
+  Lookups mirror os.path.exists and glob.glob('<folder>/<pattern>') for paths under root, including glob's order (that of os.scandir) and its skipping of hidden names. Symlinked directories are followed, once per real path.
+
+  Args:
+    root (str): Directory to index
+    workers (int): Threads listing directories concurrently
+
+  Methods:
+    exists(path): Whether path is an indexed directory or file
+    glob(folder, pattern): Paths of the entries of folder whose names match pattern
+  """
+  def __init__(self, root, workers=8):
+    self.root = os.path.normpath(root)
+    self.dirs = {}   # normalized directory path -> (entry names in scandir order, set of them)
+    self._walk(max(workers, 1))
+
+  def _list(self, path):
+    names, subdirs, links = [], [], []
+    with os.scandir(path) as entries:
+      for entry in entries:
+        names.append(entry.name)
+        if entry.is_dir():
+          subdirs.append(entry.name)
+          if entry.is_symlink():
+            links.append(entry.name)
+    return path, names, subdirs, links
+
+  def _walk(self, workers):
+    visited = {os.path.realpath(self.root)}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+      pending = {pool.submit(self._list, self.root)}
+      while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+          path, names, subdirs, links = future.result()
+          self.dirs[path] = (names, set(names))
+          for name in subdirs:
+            subdir = os.path.join(path, name)
+            if name in links:
+              # a symlinked directory is listed once, wherever it points
+              real = os.path.realpath(subdir)
+              if real in visited:
+                continue
+              visited.add(real)
+            pending.add(pool.submit(self._list, subdir))
+
+  def exists(self, path):
+    path = os.path.normpath(path)
+    if path in self.dirs:
+      return True
+    parent, name = os.path.split(path)
+    return parent in self.dirs and name in self.dirs[parent][1]
+
+  def glob(self, folder, pattern="*"):
+    listing = self.dirs.get(os.path.normpath(folder))
+    if listing is None:
+      return []
+    names = [name for name in listing[0] if fnmatch.fnmatch(name, pattern) and (pattern.startswith(".") or not name.startswith("."))]
+    return [os.path.join(folder, name) for name in names]
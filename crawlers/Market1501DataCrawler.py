@@ -1,6 +1,7 @@
 import os
 import re
-import glob
+from .CrawlManifest import CrawlManifest
+from .CrawlTable import compact_metadata
 
 class Market1501DataCrawler:
   def __init__(self,data_folder="Market1501", train_folder="bounding_box_train", test_folder="bounding_box_test", query_folder="query", **kwargs):
@@ -12,6 +13,7 @@ class Market1501DataCrawler:
     self.query_folder = os.path.join(self.data_folder, query_folder)
 
     self.logger = kwargs.get("logger")
+    self.manifest = CrawlManifest.for_crawler(self.data_folder, kwargs.get("manifest", False), self.logger)
 
     self.__verify(self.data_folder)
     self.__verify(self.train_folder)
@@ -19,6 +21,8 @@ class Market1501DataCrawler:
     self.__verify(self.query_folder)
 
     self.crawl()
+    self.manifest.save()
+    compact_metadata(self.metadata)   # numpy-backed crawl lists, shared by loader workers without copy-on-write
 
   def __verify(self,folder):
     if not os.path.exists(folder):
@@ -37,14 +41,13 @@ class Market1501DataCrawler:
     self.logger.info("Query\tPIDS: {:6d}\tCIDS: {:6d}\tIMGS: {:8d}".format(self.metadata["query"]["pids"], self.metadata["query"]["cids"], self.metadata["query"]["imgs"]))
 
   def __crawl(self,folder, reset_labels=False):
-    imgs = glob.glob(os.path.join(folder, "*.jpg"))
     _re = re.compile(r'([\d]+)_[a-z]([\d]+)')
+    imgs = self.manifest.scan(folder, "*.jpg", lambda img: _re.search(img).groups(), key=_re.pattern) # (img, pid, cid), from the manifest if folder is unchanged
     pid_labeler = 0
     pid_tracker, cid_tracker = {}, {}
     crawler = []
     pid_counter, cid_counter, img_counter = 0, 0, 0
-    for img in imgs:
-      pid, cid = map(int, _re.search(img).groups()) # _re.search lol
+    for img, pid, cid in imgs:
       if pid < 0: continue  # ignore junk
       if cid < 0: continue  # ignore junk
       if pid not in pid_tracker:
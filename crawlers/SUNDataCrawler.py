@@ -1,9 +1,10 @@
-import glob
 import math
 import os
 import random
 
 import utils.splits.sun
+from .CrawlTable import compact_metadata
+from .DirectoryIndex import DirectoryIndex
 
 class SUNDataCrawler:
     def __init__(self,data_folder="SUNAttributeDB_Images",  **kwargs):
@@ -13,11 +14,13 @@ class SUNDataCrawler:
         self.image_folder = os.path.join(self.data_folder, "images")
 
         self.logger = kwargs.get("logger")
+        self.crawl_workers = kwargs.get("crawl_workers", 8)
 
         self.__verify(self.data_folder)
         self.__verify(self.image_folder)
 
         self.crawl()
+        compact_metadata(self.metadata)   # numpy-backed crawl lists, shared by loader workers without copy-on-write
 
     def __verify(self,folder):
         if not os.path.exists(folder):
@@ -36,6 +39,8 @@ class SUNDataCrawler:
 
     def __crawl(self, image_folder):
         # Data/CUB_200_2011/images contains folders alphabetically...
+        # One concurrent walk of the tree. Class folders are then resolved and listed from memory
+        self.index = DirectoryIndex(image_folder, workers=self.crawl_workers)
         traincrawler = []
         querycrawler = []
 
@@ -47,7 +52,7 @@ class SUNDataCrawler:
             if path_proposal == False:
                 print(alphabetical, directory_splits, image_folder)
                 raise ValueError()
-            image_list = glob.glob(path_proposal + "/*.jpg")
+            image_list = self.index.glob(path_proposal, "*.jpg")
             traincrawler += [(item, idx, 0) for item in image_list]
 
 
@@ -58,7 +63,7 @@ class SUNDataCrawler:
             path_proposal = self.get_true_path(alphabetical, directory_splits, image_folder)
             if path_proposal == False:
                 raise ValueError()
-            image_list = glob.glob(path_proposal + "/*.jpg")
+            image_list = self.index.glob(path_proposal, "*.jpg")
             querycrawler += [(item, idx+len(utils.splits.sun.trainval), 0) for item in image_list]
         
         random.shuffle(traincrawler)
@@ -86,7 +91,7 @@ class SUNDataCrawler:
         full_name = "_".join(directory_splits)
         path_proposal = os.path.join(image_folder, alphabetical)
         path_proposal = os.path.join(path_proposal, full_name)
-        if os.path.exists(path_proposal):
+        if self.index.exists(path_proposal):
             return path_proposal
         # So the full name doesn't work. We'll try to build it piece by piece...
         path_proposal = os.path.join(image_folder, alphabetical)
@@ -98,12 +103,12 @@ class SUNDataCrawler:
             else:
                 directory_proposal = "_".join([directory_proposal] + [directory])
             proposal = os.path.join(path_proposal, directory_proposal)
-            if os.path.exists(proposal):
+            if self.index.exists(proposal):
                 path_proposal = proposal
                 # reset directory proposal
                 directory_proposal = ""
             # If path does not exist, we try by appending the next directory split to the directory proposal...
-        if not os.path.exists(path_proposal):
+        if not self.index.exists(path_proposal):
             return False
         return path_proposal
             
@@ -1,6 +1,7 @@
 import os
 import re
 import glob
+from .CrawlTable import compact_metadata
 
 class VRICDataCrawler:
   """ Data crawler for the VRIC (Vehicle Re-identification in Context) dataset
@@ -55,6 +56,7 @@ class VRICDataCrawler:
     self.__verify(self.query_folder)
 
     self.crawl()
+    compact_metadata(self.metadata)   # numpy-backed crawl lists, shared by loader workers without copy-on-write
 
   def __verify(self,folder):
     if not os.path.exists(folder):
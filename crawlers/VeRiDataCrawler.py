@@ -1,6 +1,7 @@
 import os
 import re
-import glob
+from .CrawlManifest import CrawlManifest
+from .CrawlTable import compact_metadata
 
 class VeRiDataCrawler:
   """ Data crawler for the VeRi-776 dataset
@@ -15,6 +16,7 @@ class VeRiDataCrawler:
     
     Kwargs:
       logger: Instance of Logging object
+      manifest (bool or str): Cache folder listings in a CrawlManifest. True for <data_folder>.manifest.npz, or its path. Default False
 
     Attributes:
       metadata (dict): Contains image paths, PIDs, and CIDs of training, testing, and query sets
@@ -49,6 +51,7 @@ class VeRiDataCrawler:
     self.tracks_file = os.path.join(self.data_folder, "test_track.txt")
 
     self.logger = kwargs.get("logger")
+    self.manifest = CrawlManifest.for_crawler(self.data_folder, kwargs.get("manifest", False), self.logger)
 
     self.__verify(self.data_folder)
     self.__verify(self.train_folder)
@@ -56,6 +59,8 @@ class VeRiDataCrawler:
     self.__verify(self.query_folder)
 
     self.crawl()
+    self.manifest.save()
+    compact_metadata(self.metadata)   # numpy-backed crawl lists, shared by loader workers without copy-on-write
 
   def __verify(self,folder):
     if not os.path.exists(folder):
@@ -77,14 +82,13 @@ class VeRiDataCrawler:
     self.logger.info("Tracks\tPIDS: {:6d}\tCIDS: {:6d}\Tracks: {:8d}".format(self.metadata["track"]["pids"], self.metadata["track"]["cids"], self.metadata["track"]["imgs"]))
 
   def __crawl(self,folder, reset_labels=False):
-    imgs = glob.glob(os.path.join(folder, "*.jpg"))
     _re = re.compile(r'([\d]+)_[a-z]([\d]+)')
+    imgs = self.manifest.scan(folder, "*.jpg", lambda img: _re.search(img).groups(), key=_re.pattern) # (img, pid, cid), from the manifest if folder is unchanged
     pid_labeler = 0
     pid_tracker, cid_tracker = {}, {}
     crawler = []
     pid_counter, cid_counter, img_counter = 0, 0, 0
-    for img in imgs:
-      pid, cid = map(int, _re.search(img).groups()) # _re.search lol
+    for img, pid, cid in imgs:
       if pid < 0: continue  # ignore junk
       if cid < 0: continue  # ignore junk
       if pid not in pid_tracker:
@@ -105,26 +109,24 @@ class VeRiDataCrawler:
     track_dict, track_info = {}, {}
     track_idx = 0
     #import pdb
-    with open(self.tracks_file, "r") as tracks_file_reader:
-      for line in tracks_file_reader:
-        # each line is a track...
-        track_list = line.strip().split(" ")
-        #pdb.set_trace()
-        track_index = track_list[0]
-        track_images = track_list[1:]
-        track_images = [os.path.join(folder, item) for item in track_images]
-        pid, cid = map(int, _re.search(track_images[0]).groups()) # _re.search lol
-        if pid < 0: continue  # ignore junk
-        if cid < 0: continue  # ignore junk
-        if pid not in pid_tracker:
-          pid_tracker[pid] = pid_labeler if reset_labels else pid
-          pid_labeler += 1
-        crawler.append((track_images, pid_tracker[pid], cid-1))  # cids start at 1 in data
-        #if len(crawler) == 1650:
-        #  pdb.set_trace()
-        for img  in track_images:
-          track_dict[img] = track_idx
-        track_info[track_idx] = {"pid":pid_tracker[pid], "cid":cid-1}
-        track_idx += 1
+    for track_list in self.manifest.lines(self.tracks_file):
+      # each line is a track...
+      #pdb.set_trace()
+      track_index = track_list[0]
+      track_images = track_list[1:]
+      track_images = [os.path.join(folder, item) for item in track_images]
+      pid, cid = map(int, _re.search(track_images[0]).groups()) # _re.search lol
+      if pid < 0: continue  # ignore junk
+      if cid < 0: continue  # ignore junk
+      if pid not in pid_tracker:
+        pid_tracker[pid] = pid_labeler if reset_labels else pid
+        pid_labeler += 1
+      crawler.append((track_images, pid_tracker[pid], cid-1))  # cids start at 1 in data
+      #if len(crawler) == 1650:
+      #  pdb.set_trace()
+      for img  in track_images:
+        track_dict[img] = track_idx
+      track_info[track_idx] = {"pid":pid_tracker[pid], "cid":cid-1}
+      track_idx += 1
     #pdb.set_trace()
     return crawler, len(pid_tracker), len(cid_tracker), len(crawler), track_dict, track_info 
\ No newline at end of file
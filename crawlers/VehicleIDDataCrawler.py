@@ -1,6 +1,8 @@
 import os
 import re
 import glob
+from collections import OrderedDict
+from .CrawlTable import CrawlTable, compact_metadata
 
 class VehicleIDDataCrawler:
     def __init__(self,data_folder="VehicleID", train_folder="image", test_folder="", query_folder="", **kwargs):
@@ -11,12 +13,16 @@ class VehicleIDDataCrawler:
 
         self.train_list = "train_list.txt"
         self.query_list = kwargs.get("test_list","test_list_2400") + ".txt"
+        # several test lists, e.g. [test_list_800, test_list_1600, test_list_2400], are crawled as one test set holding their union.
+        # Each list's own images are kept in metadata["protocols"], for VehicleIDTrainer to evaluate every split from one extraction
+        self.test_lists = kwargs.get("test_lists", None) or []
 
         list_folder = os.path.join(self.data_folder, "train_test_split")
         # The train list is in VehicleID/train_test_split/train_list.txt
         # The gallery/query list is in VehicleID/train_test_split/test_list_13164.txt
         self.train_list = os.path.join(list_folder, self.train_list)
         self.query_list = os.path.join(list_folder, self.query_list)
+        self.test_lists = OrderedDict((test_list, os.path.join(list_folder, test_list + ".txt")) for test_list in self.test_lists)
 
         self.logger = kwargs.get("logger")
 
@@ -25,6 +31,7 @@ class VehicleIDDataCrawler:
 
 
         self.crawl()
+        compact_metadata(self.metadata)   # numpy-backed crawl lists, shared by loader workers without copy-on-write
 
     def __verify(self,folder):
         if not os.path.exists(folder):
@@ -36,7 +43,10 @@ class VehicleIDDataCrawler:
         self.metadata["train"], self.metadata["test"], self.metadata["query"] = {}, {}, {}
         self.metadata["train"]["crawl"], self.metadata["train"]["pids"], self.metadata["train"]["cids"], self.metadata["train"]["imgs"] = self.__crawl(self.train_list, reset_labels=True)
         
-        self.__querycrawl(self.query_list)
+        if self.test_lists:
+            self.__protocolcrawl(self.test_lists)
+        else:
+            self.__querycrawl(self.query_list)
 
         self.logger.info("Train\tPIDS: {:6d}\tCIDS: {:6d}\tIMGS: {:8d}".format(self.metadata["train"]["pids"], self.metadata["train"]["cids"], self.metadata["train"]["imgs"]))
         self.logger.info("Test \tPIDS: {:6d}\tCIDS: {:6d}\tIMGS: {:8d}".format(self.metadata["test"]["pids"], self.metadata["test"]["cids"], self.metadata["test"]["imgs"]))
@@ -62,23 +72,25 @@ class VehicleIDDataCrawler:
         return crawler, len(set(pids.keys())), len(set(cids)), len(crawler)
 
     def __querycrawl(self,query_file, reset_labels=False):
-        crawler = []
-        pids, cids = {}, []
-        pid_label = 0
-        with open(query_file,"r") as query_file_reader:
-            for line in query_file_reader:
-                ln = line.strip().split(" ")
-                img_path = ln[0]+".jpg"
-                img_path = os.path.join(self.image_folder, img_path)
-                pid = int(ln[1])
-                cid = 0
-                if pid not in pids:
-                    pids[pid] = pid_label if reset_labels else pid
-                    pid_label += 1
-                #pids.append(pid)
-                cids.append(cid)
-                crawler.append((img_path, pids[pid], cid))
-        
+        crawler, pids, _, _ = self.__crawl(query_file, reset_labels=reset_labels)
+        self.__split(crawler, pids)
+
+    def __protocolcrawl(self, test_lists):
+        # the union of the test lists, in the order they are given, each image once. Pids are the dataset's own, so they agree across lists
+        crawler, seen = [], set()
+        self.metadata["protocols"] = OrderedDict()
+        for test_list, list_file in test_lists.items():
+            self.__verify(list_file)
+            protocol, protocol_pids, _, protocol_imgs = self.__crawl(list_file)
+            self.metadata["protocols"][test_list] = CrawlTable.from_entries(protocol)
+            self.logger.info("{}\tPIDS: {:6d}\tIMGS: {:8d}".format(test_list, protocol_pids, protocol_imgs))
+            for crawled_img in protocol:
+                if crawled_img[0] not in seen:
+                    seen.add(crawled_img[0])
+                    crawler.append(crawled_img)
+        self.__split(crawler, len(set(crawled_img[1] for crawled_img in crawler)))
+
+    def __split(self, crawler, pids):
         pid_in_gallery = {}
         self.metadata["test"]["crawl"], self.metadata["query"]["crawl"] = [], []
 
@@ -91,8 +103,8 @@ class VehicleIDDataCrawler:
                 pid_in_gallery[pid] = 1
                 self.metadata["test"]["crawl"].append((img_path, pid, cid))
         
-        self.metadata["test"]["pids"], self.metadata["test"]["cids"] = len(pids), 1
-        self.metadata["query"]["pids"], self.metadata["query"]["cids"] = len(pids), 1
+        self.metadata["test"]["pids"], self.metadata["test"]["cids"] = pids, 1
+        self.metadata["query"]["pids"], self.metadata["query"]["cids"] = pids, 1
         
         self.metadata["test"]["imgs"] = len(self.metadata["test"]["crawl"])
         self.metadata["query"]["imgs"] = len(self.metadata["query"]["crawl"])
\ No newline at end of file
@@ -1,3 +1,7 @@
+from .CrawlTable import CrawlTable, compact_metadata
+from .CrawlManifest import CrawlManifest
+from .DirectoryIndex import DirectoryIndex
+
 # Vehicle Re-ID Crawlers
 from .VeRiDataCrawler import VeRiDataCrawler
 from .VRICDataCrawler import VRICDataCrawler
@@ -15,12 +15,14 @@ import torchsummary
 import torchvision
 
 import utils
+from utils.distributed import init_distributed, is_main_process, barrier
 
 @click.command()
 @click.argument('config')
 @click.option('--mode', default="train", help="Execution mode: [train|test]")
 @click.option('--weights', default=".", help="Path to weights if mode is test")
-def main(config, mode, weights):
+@click.option('--local_rank', default=-1, type=int, help="Set by torch.distributed.launch in multi-process runs")
+def main(config, mode, weights, local_rank):
     # Generate configuration
     cfg = kaptan.Kaptan(handler='yaml')
     config = cfg.import_config(config)
@@ -28,7 +30,9 @@ def main(config, mode, weights):
     # Generate logger
     MODEL_SAVE_NAME, MODEL_SAVE_FOLDER, LOGGER_SAVE_NAME, CHECKPOINT_DIRECTORY = utils.generate_save_names(config)
     os.makedirs(MODEL_SAVE_FOLDER, exist_ok=True)
-    logger = utils.generate_logger(MODEL_SAVE_FOLDER, LOGGER_SAVE_NAME)
+    # multi-process training, if launched with torch.distributed.launch and EXECUTION.DISTRIBUTED_BACKEND is set. Only rank 0 logs and saves
+    RANK, WORLD_SIZE, LOCAL_RANK = init_distributed(config.get("EXECUTION.DISTRIBUTED_BACKEND", None), local_rank)
+    logger = utils.generate_logger(MODEL_SAVE_FOLDER, LOGGER_SAVE_NAME, rank=RANK)
 
     logger.info("*"*40);logger.info("");logger.info("")
     logger.info("Using the following configuration:")
@@ -36,7 +40,7 @@ def main(config, mode, weights):
     logger.info("");logger.info("");logger.info("*"*40)
 
     NORMALIZATION_MEAN, NORMALIZATION_STD, RANDOM_ERASE_VALUE = utils.fix_generator_arguments(config)
-    TRAINDATA_KWARGS = {"rea_value": config.get("TRANSFORMATION.RANDOM_ERASE_VALUE")}
+    TRAINDATA_KWARGS = {"rea_value": config.get("TRANSFORMATION.RANDOM_ERASE_VALUE"), "draft_decode": config.get("DATASET.DRAFT_DECODE", False)}
 
     """ MODEL PARAMS """
     from utils import model_weights
@@ -46,9 +50,10 @@ def main(config, mode, weights):
         if mode == "train":
             if os.path.exists(model_weights[config.get("MODEL.MODEL_BASE")][1]):
                 pass
-            else:
+            elif is_main_process():    # other ranks wait for rank 0's download
                 logger.info("Model weights file {} does not exist. Downloading.".format(model_weights[config.get("MODEL.MODEL_BASE")][1]))
                 utils.web.download(model_weights[config.get("MODEL.MODEL_BASE")][1], model_weights[config.get("MODEL.MODEL_BASE")][0])
+            barrier()
             MODEL_WEIGHTS = model_weights[config.get("MODEL.MODEL_BASE")][1]
     else:
         raise NotImplementedError("Model %s is not available. Please choose one of the following: %s"%(config.get("MODEL.MODEL_BASE"), str(model_weights.keys())))
@@ -64,10 +69,21 @@ def main(config, mode, weights):
     else:
         backup_logger = None
 
-    NUM_GPUS = torch.cuda.device_count()
+    DEVICE = resolve_device(config.get("EXECUTION.DEVICE", None))
+    INTRA_OP_THREADS, INTER_OP_THREADS = configure_threads(config.get("EXECUTION.INTRA_OP_THREADS", None), config.get("EXECUTION.INTER_OP_THREADS", None), device=DEVICE, processes=WORLD_SIZE)
+    if WORLD_SIZE > 1 and DEVICE.type == "cuda":
+        DEVICE = torch.device("cuda", LOCAL_RANK)   # one GPU per process
+        torch.cuda.set_device(DEVICE)
+    NUM_GPUS = torch.cuda.device_count() if DEVICE.type == "cuda" else 0
+    if WORLD_SIZE > 1:
+        NUM_GPUS = min(NUM_GPUS, 1)
     if NUM_GPUS > 1:
-        raise RuntimeError("Not built for multi-GPU. Please start with single-GPU.")
+        raise RuntimeError("Multi-GPU runs need one process per GPU. Launch with torch.distributed.launch and set EXECUTION.DISTRIBUTED_BACKEND.")
     logger.info("Found %i GPUs"%NUM_GPUS)
+    if WORLD_SIZE > 1:
+        logger.info("Training with {} processes over {}. Batches are per process, and learning rates are scaled by {}".format(WORLD_SIZE, config.get("EXECUTION.DISTRIBUTED_BACKEND"), WORLD_SIZE))
+    LR_SCALE = NUM_GPUS if WORLD_SIZE == 1 else WORLD_SIZE
+    logger.info("Running on {} with {} intra-op and {} inter-op threads".format(DEVICE, INTRA_OP_THREADS, INTER_OP_THREADS))
 
     # --------------------- BUILD GENERATORS ------------------------    
     data_crawler = utils.dynamic_import(cfg=config, module_name="crawlers", import_name="EXECUTION.CRAWLER")
@@ -93,7 +109,9 @@ def main(config, mode, weights):
                             mode=train_mode, 
                             batch_size=config.get("TRANSFORMATION.BATCH_SIZE"), 
                             instance = config.get("TRANSFORMATION.INSTANCES"), 
-                            workers = config.get("TRANSFORMATION.WORKERS"))
+                            workers = config.get("TRANSFORMATION.WORKERS"),
+                            rank = RANK,
+                            world_size = WORLD_SIZE)
 
     logger.info("Generated training data generator")
     TRAIN_CLASSES = train_generator.num_entities
@@ -105,7 +123,8 @@ def main(config, mode, weights):
                                     normalization_scale = 1./config.get("TRANSFORMATION.NORMALIZATION_SCALE"),
                                     h_flip = 0, 
                                     t_crop = False, 
-                                    rea = False)
+                                    rea = False,
+                                    draft_decode = config.get("DATASET.DRAFT_DECODE", False))
     test_generator.setup(   crawler, 
                             mode=test_mode, 
                             batch_size=config.get("TRANSFORMATION.BATCH_SIZE"), 
@@ -128,16 +147,16 @@ def main(config, mode, weights):
     logger.info("Finished instantiating model with {} architecture".format(config.get("MODEL.MODEL_ARCH")))
 
     if mode == "test":
-        carzam_model.load_state_dict(torch.load(weights))
-        carzam_model.cuda()
+        carzam_model.load_state_dict(torch.load(weights, map_location=DEVICE))
+        carzam_model.to(DEVICE)
         carzam_model.eval()
     else:
         if weights != "":   # Load weights if train and starting from a another model base...
             logger.info("Commencing partial model load from {}".format(weights))
             carzam_model.partial_load(weights)
             logger.info("Completed partial model load from {}".format(weights))
-        carzam_model.cuda()
-        logger.info(torchsummary.summary(carzam_model, input_size=(3, *config.get("DATASET.SHAPE"))))
+        carzam_model.to(DEVICE)
+        logger.info(torchsummary.summary(carzam_model, input_size=(3, *config.get("DATASET.SHAPE")), device=DEVICE.type))
 
     # --------------------- INSTANTIATE LOSS ------------------------
     from loss import CarZamLossBuilder as LossBuilder
@@ -151,7 +170,7 @@ def main(config, mode, weights):
                                 lr_bias = config.get("LOSS_OPTIMIZER.LR_BIAS_FACTOR", config.get("OPTIMIZER.LR_BIAS_FACTOR")), 
                                 weight_decay= config.get("LOSS_OPTIMIZER.WEIGHT_DECAY", config.get("OPTIMIZER.WEIGHT_DECAY")), 
                                 weight_bias= config.get("LOSS_OPTIMIZER.WEIGHT_BIAS_FACTOR", config.get("OPTIMIZER.WEIGHT_BIAS_FACTOR")), 
-                                gpus=NUM_GPUS)
+                                gpus=LR_SCALE)
     loss_optimizer = LOSS_OPT.build(loss_builder=loss_function,
                                     name=config.get("LOSS_OPTIMIZER.OPTIMIZER_NAME", config.get("OPTIMIZER.OPTIMIZER_NAME")),
                                     **json.loads(config.get("LOSS_OPTIMIZER.OPTIMIZER_KWARGS", config.get("OPTIMIZER.OPTIMIZER_KWARGS"))))
@@ -163,7 +182,7 @@ def main(config, mode, weights):
     optimizer_builder = getattr(optimizer_builder, config.get("EXECUTION.OPTIMIZER_BUILDER"))
     logger.info("Loaded {} from {} to build Optimizer model".format(config.get("EXECUTION.OPTIMIZER_BUILDER"), "optimizer"))
 
-    OPT = optimizer_builder(base_lr=config.get("OPTIMIZER.BASE_LR"), lr_bias = config.get("OPTIMIZER.LR_BIAS_FACTOR"), weight_decay=config.get("OPTIMIZER.WEIGHT_DECAY"), weight_bias=config.get("OPTIMIZER.WEIGHT_BIAS_FACTOR"), gpus=NUM_GPUS)
+    OPT = optimizer_builder(base_lr=config.get("OPTIMIZER.BASE_LR"), lr_bias = config.get("OPTIMIZER.LR_BIAS_FACTOR"), weight_decay=config.get("OPTIMIZER.WEIGHT_DECAY"), weight_bias=config.get("OPTIMIZER.WEIGHT_BIAS_FACTOR"), gpus=LR_SCALE)
     optimizer = OPT.build(carzam_model, config.get("OPTIMIZER.OPTIMIZER_NAME"), **json.loads(config.get("OPTIMIZER.OPTIMIZER_KWARGS")))
     logger.info("Built optimizer")
 
@@ -213,11 +232,11 @@ def main(config, mode, weights):
     logger.info("Loaded {} from {} to build Trainer".format(config.get("EXECUTION.TRAINER"), "trainer"))
     
     loss_stepper = trainer(model=carzam_model, loss_fn = loss_function, optimizer = optimizer, loss_optimizer=loss_optimizer, scheduler = scheduler, loss_scheduler = loss_scheduler, train_loader = train_generator.dataloader, test_loader = test_generator.dataloader, queries = TEST_CLASSES, epochs = config.get("EXECUTION.EPOCHS"), logger = logger, test_mode=config.get("EXECUTION.TEST_MODE", "zsl"))  # or "gzsl"
-    loss_stepper.setup(step_verbose = config.get("LOGGING.STEP_VERBOSE"), save_frequency=config.get("SAVE.SAVE_FREQUENCY"), test_frequency = config.get("EXECUTION.TEST_FREQUENCY"), save_directory = MODEL_SAVE_FOLDER, save_backup = DRIVE_BACKUP, backup_directory = CHECKPOINT_DIRECTORY, gpus=NUM_GPUS,fp16 = config.get("OPTIMIZER.FP16"), model_save_name = MODEL_SAVE_NAME, logger_file = LOGGER_SAVE_NAME)
+    loss_stepper.setup(step_verbose = config.get("LOGGING.STEP_VERBOSE"), save_frequency=config.get("SAVE.SAVE_FREQUENCY"), test_frequency = config.get("EXECUTION.TEST_FREQUENCY"), save_directory = MODEL_SAVE_FOLDER, save_backup = DRIVE_BACKUP, backup_directory = CHECKPOINT_DIRECTORY, gpus=NUM_GPUS,fp16 = config.get("OPTIMIZER.FP16"), model_save_name = MODEL_SAVE_NAME, logger_file = LOGGER_SAVE_NAME, device = DEVICE, find_unused_parameters = config.get("EXECUTION.FIND_UNUSED_PARAMETERS", True))
     if mode == 'train':
       loss_stepper.train(continue_epoch=previous_stop)
     elif mode == 'test':
-      loss_stepper.evaluate()
+      loss_stepper.run_evaluation()
     else:
       raise NotImplementedError()
 
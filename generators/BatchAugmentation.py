@@ -0,0 +1,81 @@
+import math
+
+import numpy as np
+import torch
+
+
+class ToUInt8Tensor:
+  """ PIL image to a uint8 (3, H, W) tensor, without scaling. Per-sample stand-in for T.ToTensor when augmentation is batched. """
+  def __call__(self, img):
+    return torch.from_numpy(np.array(img, dtype=np.uint8, copy=True)).permute(2, 0, 1).contiguous()
+
+
+class BatchAugmentation:
+  """ Flip, crop, normalization, and random erasing of a whole uint8 batch at once.
+
+  Does what the per-sample RandomHorizontalFlip -> RandomCrop -> ToTensor -> Normalize -> RandomErasing pipeline of SequencedGenerator does, with the random choices drawn per sample, but as a few tensor ops over the batch. Runs wherever the batch is: in collate_fn inside loader workers, or on the training device after the uint8 batch is transferred.
+
+  Args:
+    i_shape (int, int): Crop size (H, W)
+    normalization_mean, normalization_std (float or list): Normalization, as for T.Normalize, applied after scaling to [0, 1]
+    h_flip (float): Probability of horizontal flip
+    t_crop (bool): Random crops of size i_shape
+    rea (bool): Random erasing at probability 0.5, with scale (0.02, 0.4) and ratio (0.3, 3.3), as T.RandomErasing
+    rea_value (float): Value of erased pixels, after normalization
+
+  Call with a uint8 (N, 3, H, W) batch. Returns the float32 batch, on the same device.
+  """
+  def __init__(self, i_shape, normalization_mean=0.5, normalization_std=0.5, h_flip=0.5, t_crop=True, rea=True, rea_value=0):
+    self.i_shape = tuple(i_shape)
+    self.mean = torch.tensor(normalization_mean, dtype=torch.float32).view(-1, 1, 1)
+    self.std = torch.tensor(normalization_std, dtype=torch.float32).view(-1, 1, 1)
+    self.h_flip = h_flip
+    self.t_crop = t_crop
+    self.rea = rea
+    self.rea_value = rea_value if rea_value is not None else 0
+    self.rea_scale, self.rea_ratio, self.rea_attempts = (0.02, 0.4), (0.3, 3.3), 10
+
+  def __call__(self, batch):
+    if self.h_flip > 0:
+      flip = (torch.rand(batch.size(0), device=batch.device) < self.h_flip).view(-1, 1, 1, 1)
+      batch = torch.where(flip, batch.flip(3), batch)
+    if self.t_crop:
+      batch = self.crop(batch)
+    batch = batch.float().div_(255.)
+    batch = batch.sub_(self.mean.to(batch.device)).div_(self.std.to(batch.device))
+    if self.rea:
+      batch = self.erase(batch)
+    return batch
+
+  def crop(self, batch):
+    N, _, H, W = batch.shape
+    h, w = self.i_shape
+    if (h, w) == (H, W):
+      return batch    # a crop the size of the image is the image
+    top = torch.randint(0, H - h + 1, (N,), device=batch.device)
+    left = torch.randint(0, W - w + 1, (N,), device=batch.device)
+    rows = (top.view(-1, 1) + torch.arange(h, device=batch.device)).view(N, 1, h, 1).expand(-1, batch.size(1), -1, W)
+    batch = batch.gather(2, rows)
+    cols = (left.view(-1, 1) + torch.arange(w, device=batch.device)).view(N, 1, 1, w).expand(-1, batch.size(1), h, -1)
+    return batch.gather(3, cols)
+
+  def erase(self, batch):
+    N, _, H, W = batch.shape
+    device = batch.device
+    # every attempt at once, keeping the first that fits, as T.RandomErasing tries up to 10 times
+    area = H * W * torch.empty(N, self.rea_attempts, device=device).uniform_(*self.rea_scale)
+    ratio = torch.exp(torch.empty(N, self.rea_attempts, device=device).uniform_(math.log(self.rea_ratio[0]), math.log(self.rea_ratio[1])))
+    h = torch.sqrt(area * ratio).round().long()
+    w = torch.sqrt(area / ratio).round().long()
+    fits = (h < H) & (w < W)
+    first = torch.argmax(fits.int(), dim=1)     # first fitting attempt, or 0 if none fit
+    h, w = h.gather(1, first.view(-1, 1)).view(-1), w.gather(1, first.view(-1, 1)).view(-1)
+    apply = (torch.rand(N, device=device) < 0.5) & fits.any(dim=1)
+    top = (torch.rand(N, device=device) * (H - h + 1).float()).long()
+    left = (torch.rand(N, device=device) * (W - w + 1).float()).long()
+    rows = torch.arange(H, device=device).view(1, H)
+    cols = torch.arange(W, device=device).view(1, W)
+    in_rows = (rows >= top.view(-1, 1)) & (rows < (top + h).view(-1, 1))
+    in_cols = (cols >= left.view(-1, 1)) & (cols < (left + w).view(-1, 1))
+    mask = (in_rows.view(N, 1, H, 1) & in_cols.view(N, 1, 1, W)) & apply.view(N, 1, 1, 1)
+    return batch.masked_fill(mask, self.rea_value)
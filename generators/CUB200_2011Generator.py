@@ -1,96 +1,45 @@
 import os.path as osp
-import random
-from collections import defaultdict
 
 import numpy as np
 import torch
 import torchvision.transforms as T
-from PIL import Image, ImageFile
+from PIL import ImageFile
 from torch.utils.data import Dataset as TorchDataset
 from torch.utils.data.dataloader import DataLoader as TorchDataLoader
-from torch.utils.data.sampler import Sampler
+from .ImageDecode import draft_size, open_image
+from .DistributedSampler import DistributedShuffleSampler
 
 ImageFile.LOAD_TRUNCATED_IMAGES = True
 
 class TDataSet(TorchDataset):
-  def __init__(self,dataset, transform):
-    self.dataset = [item for item in dataset if item[1]]
+  def __init__(self,dataset, transform, draft=None):
+    # entries with pid 0 are skipped. The crawl (a CrawlTable) is indexed in place rather than copied into a list, so workers share it without copy-on-write growth
+    self.dataset = dataset
+    pids = dataset.pids if hasattr(dataset, "pids") else np.array([item[1] for item in dataset], dtype=np.int64)
+    self.index = np.flatnonzero(pids)
     self.transform = transform
+    self.draft = draft
 
   def __len__(self):
-    return len(self.dataset)
+    return len(self.index)
 
   def __getitem__(self,idx):
-    img, pid, cid = self.dataset[idx]
+    img, pid, cid = self.dataset[int(self.index[idx])]
     img_arr = self.transform(self.load(img))
     return img_arr, pid, idx
   
   def load(self,img):
     if not osp.exists(img):
       raise IOError("{img} does not exist in path".format(img=img))
-    img_load = Image.open(img).convert('RGB')
+    img_load = open_image(img, self.draft)
     return img_load
 
-class TSampler(Sampler):
-  """ Triplet sampler """
-  def __init__(self, dataset, batch_size, instance):
-    self.dataset = dataset
-    self.batch_size=batch_size
-    self.instance = instance
-    self.unique_ids = self.batch_size // self.instance
-    self.indices = defaultdict(list)
-    self.pids = set()
-    for idx, (img, pid, cid) in enumerate(self.dataset):
-      self.indices[pid].append(idx)
-      self.pids.add(pid)
-    self.pids = list(self.pids)
-    self.batch = 0
-    for pid in self.pids:
-      num_ids = len(self.indices[pid])
-      num_ids = self.instance if num_ids < self.instance else num_ids
-      self.batch += num_ids - num_ids % self.instance
-  
-  def __iter__(self):
-    batch_idx = defaultdict(list)
-    for pid in self.pids:
-      ids = [item for item in self.indices[pid]]
-      if len(ids) < self.instance:
-        ids = np.random.choice(ids, size=self.instance, replace=True)
-      random.shuffle(ids)
-      batch, batch_counter = [], 0
-      for idx in ids:
-        batch.append(idx)
-        batch_counter += 1
-        if len(batch) == self.instance:
-          batch_idx[pid].append(batch)
-          batch = []
-    _pids, r_pids = [item for item in self.pids], []
-    # Optimize this???
-    to_remove = {}
-    pid_len = len(_pids)
-    while pid_len >= self.unique_ids:
-      sampled = random.sample(_pids, self.unique_ids)
-      for pid in sampled:
-        batch = batch_idx[pid].pop(0)
-        r_pids.extend(batch)
-        if len(batch_idx[pid]) == 0:
-          to_remove[pid] = 1
-
-      _pids = [item for item in _pids if item not in to_remove]
-      pid_len = len(_pids)
-      to_remove = {}
-
-    self.__len = len(r_pids)
-    return iter(r_pids)
-  
-  def __len__(self):
-    return self.__len
 class CUB200_2011Generator:
   def __init__(self,gpus, i_shape = (208,208), normalization_mean = 0.5, normalization_std = 0.5, normalization_scale = 1./255., h_flip = 0.5, t_crop = True, rea = True, **kwargs):
     """ Data generator for training and testing.
 
     Args:
-      gpus (int): Number of GPUs
+      gpus (int): Number of GPUs. 0 for CPU-only runs, which count as one device for batch sizing
       i_shape (int, int): 2D Image shape
       normalization_mean (float): Value to pass as mean normalization parameter to pytorch Normalization
       normalization_std (float): Value to pass as std normalization parameter to pytorch Normalization
@@ -98,9 +47,14 @@ class CUB200_2011Generator:
       h_flip (float): Probability of horizontal flip for image
       t_crop (bool): Whether to include random cropping
       rea (bool): Whether to include random erasing augmentation (at 0.5 prob)
+
+    Kwargs:
+      rea_value (float): Value of randomly erased pixels
+      draft_decode (bool): Decode JPEGs at the smallest 1/2, 1/4, or 1/8 DCT scale that still covers i_shape, then resize. Default False
     
     """
-    self.gpus = gpus
+    self.gpus = max(gpus, 1)
+    self.draft = draft_size(i_shape) if kwargs.get("draft_decode", False) else None
     
     transformer_primitive = []
     
@@ -115,32 +69,35 @@ class CUB200_2011Generator:
       transformer_primitive.append(T.RandomErasing(p=0.5, scale=(0.02, 0.4), value = kwargs.get('rea_value', 0)))
     self.transformer = T.Compose(transformer_primitive)
 
-  def setup(self,datacrawler, mode='train', batch_size=32, instance = 6, workers = 8):
+  def setup(self,datacrawler, mode='train', batch_size=32, instance = 6, workers = 8, rank = 0, world_size = 1):
     """ Setup the data generator.
 
     Args:
       workers (int): Number of workers to use during data retrieval/loading
       datacrawler (VeRiDataCrawler): A DataCrawler object that has crawled the data directory
       mode (str): One of 'train', 'test', 'query'. 
+      rank (int): Rank of this process in multi-process training. Training modes shuffle a disjoint share of the images on each rank.
+      world_size (int): Number of training processes. batch_size is per process.
     """
     if datacrawler is None:
       raise ValueError("Must pass DataCrawler instance. Passed `None`")
-    self.workers = workers * self.gpus
+    self.workers = workers  # independent of the GPU count, so CPU-only runs get loader workers too
 
     if mode == "train":
-      self.__dataset = TDataSet(datacrawler.metadata["train"]["crawl"] + datacrawler.metadata["test"]["crawl"], self.transformer)
+      self.__dataset = TDataSet(datacrawler.metadata["train"]["crawl"] + datacrawler.metadata["test"]["crawl"], self.transformer, self.draft)
     elif mode == "train-gzsl":
-      self.__dataset = TDataSet(datacrawler.metadata["train"]["crawl"], self.transformer)
+      self.__dataset = TDataSet(datacrawler.metadata["train"]["crawl"], self.transformer, self.draft)
     elif mode == "zsl" or mode == "test":
-      self.__dataset = TDataSet(datacrawler.metadata["query"]["crawl"], self.transformer)
+      self.__dataset = TDataSet(datacrawler.metadata["query"]["crawl"], self.transformer, self.draft)
     elif mode == "gzsl":  # For the generalized zero shot learning mode
-      self.__dataset = TDataSet(datacrawler.metadata["test"]["crawl"] + datacrawler.metadata["query"]["crawl"], self.transformer)
+      self.__dataset = TDataSet(datacrawler.metadata["test"]["crawl"] + datacrawler.metadata["query"]["crawl"], self.transformer, self.draft)
     else:
       raise NotImplementedError()
     
     if mode == "train" or mode == "train-gzsl":
+      sampler = DistributedShuffleSampler(self.__dataset, rank=rank, world_size=world_size) if world_size > 1 else None
       self.dataloader = TorchDataLoader(self.__dataset, batch_size=batch_size*self.gpus, \
-                                        shuffle=True, \
+                                        shuffle=sampler is None, sampler=sampler, \
                                         num_workers=self.workers, drop_last=True, collate_fn=self.collate_simple)
       self.num_entities = datacrawler.metadata["train"]["pids"]
     elif mode == "zsl" or mode == "test":
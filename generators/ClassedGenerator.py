@@ -21,7 +21,7 @@ class ClassedGenerator:
         """ Data generator for training and testing.
 
         Args:
-            gpus (int): Number of GPUs
+            gpus (int): Number of GPUs. 0 for CPU-only runs, which count as one device for batch sizing
             i_shape (int, int): 2D Image shape
             normalization_mean (float): Value to pass as mean normalization parameter to pytorch Normalization
             normalization_std (float): Value to pass as std normalization parameter to pytorch Normalization
@@ -31,7 +31,7 @@ class ClassedGenerator:
             rea (bool): Whether to include random erasing augmentation (at 0.5 prob)
         
         """
-        self.gpus = gpus
+        self.gpus = max(gpus, 1)
         
         transformer_primitive = []
         
@@ -56,7 +56,7 @@ class ClassedGenerator:
         """
         if datacrawler is None:
             raise ValueError("Must pass DataCrawler instance. Passed `None`")
-        self.workers = workers * self.gpus
+        self.workers = workers  # independent of the GPU count, so CPU-only runs get loader workers too
 
         train_mode = True if mode == "train" else False
         target_convert = None
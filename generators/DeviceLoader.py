@@ -0,0 +1,115 @@
+import queue
+import threading
+import time
+
+import torch
+
+
+class DeviceLoader:
+  """ Wraps a DataLoader, and prefetches its next batches onto the device in a background thread.
+
+  The thread pulls batches from the loader, pins them, copies their tensors to the device (on a side CUDA stream, so copies overlap the training step), applies transform, and queues up to `prefetch` finished batches. On CPU-only hosts there is no copy, but dequeuing from the loader workers and transform still overlap compute.
+
+  The time spent waiting for each batch is recorded, so a run can tell whether it is input-bound: a wait near zero means the loader keeps up.
+
+  Args:
+    loader (DataLoader): Loader to wrap. Its attributes (dataset, sampler, batch_size, ...) are available on the wrapper.
+    device (torch.device): Device to copy batches to
+    prefetch (int): Batches prepared ahead
+    transform (callable): Optional. Applied to the first tensor of each batch (the images) after the copy, e.g. SequencedGenerator.batch_augmentation
+
+  Attributes:
+    wait_times (list): Seconds waited for each batch of the current epoch
+  """
+  def __init__(self, loader, device, prefetch=2, transform=None):
+    self.loader = loader
+    self.device = torch.device(device)
+    self.prefetch = max(prefetch, 1)
+    self.transform = transform
+    self.wait_times = []
+
+  def __getattr__(self, name):
+    # only called for attributes the wrapper does not have
+    return getattr(self.__dict__["loader"], name)
+
+  def __len__(self):
+    return len(self.loader)
+
+  def wait_time(self, last=None):
+    """ Mean seconds waited per batch, over the last `last` batches of this epoch (all of them if None) """
+    waits = self.wait_times[-last:] if last is not None else self.wait_times
+    return sum(waits) / float(len(waits)) if waits else 0.
+
+  def _to_device(self, batch):
+    if isinstance(batch, torch.Tensor):
+      if self.device.type == "cuda":
+        return (batch if batch.is_pinned() else batch.pin_memory()).to(self.device, non_blocking=True)
+      return batch.to(self.device)
+    if isinstance(batch, (list, tuple)):
+      return type(batch)(self._to_device(item) for item in batch)
+    return batch
+
+  def _prepare(self, batch, stream):
+    if stream is not None:
+      with torch.cuda.stream(stream):
+        batch = self._to_device(batch)
+        if self.transform is not None:
+          batch = (self.transform(batch[0]),) + tuple(batch[1:])
+        event = torch.cuda.Event()
+        event.record(stream)
+      return batch, event
+    batch = self._to_device(batch)
+    if self.transform is not None:
+      batch = (self.transform(batch[0]),) + tuple(batch[1:])
+    return batch, None
+
+  def _put(self, batches, item, stop):
+    # False if the consumer stopped first, so the thread never blocks on a full queue nobody reads
+    while not stop.is_set():
+      try:
+        batches.put(item, timeout=0.1)
+        return True
+      except queue.Full:
+        continue
+    return False
+
+  def _fill(self, batches, stream, stop):
+    try:
+      for batch in self.loader:
+        if not self._put(batches, self._prepare(batch, stream), stop):
+          return
+      self._put(batches, StopIteration(), stop)
+    except Exception as exception:   # re-raised in the training thread
+      self._put(batches, exception, stop)
+
+  def __iter__(self):
+    self.wait_times = []
+    batches = queue.Queue(maxsize=self.prefetch)
+    stream = torch.cuda.Stream(self.device) if self.device.type == "cuda" else None
+    stop = threading.Event()
+    thread = threading.Thread(target=self._fill, args=(batches, stream, stop), daemon=True)
+    thread.start()
+    try:
+      while True:
+        start = time.time()
+        item = batches.get()
+        if isinstance(item, StopIteration):
+          break
+        if isinstance(item, Exception):
+          raise item
+        batch, event = item
+        if event is not None:
+          torch.cuda.current_stream(self.device).wait_event(event)
+          self._record(batch)
+        self.wait_times.append(time.time() - start)
+        yield batch
+    finally:
+      stop.set()   # lets the thread exit if the epoch is abandoned early
+
+  def _record(self, batch):
+    # tensors made on the side stream are used on the current one. Keeps the caching allocator from reusing them too early
+    if isinstance(batch, torch.Tensor):
+      batch.record_stream(torch.cuda.current_stream(self.device))
+    elif isinstance(batch, (list, tuple)):
+      for item in batch:
+        self._record(item)
@@ -0,0 +1,70 @@
+import numpy as np
+from torch.utils.data.sampler import Sampler
+from utils.distributed import broadcast_seed
+from .PKSampler import PKSampler
+
+
+class DistributedPKSampler(PKSampler):
+  """ P x K sampler for multi-process training. Each rank gets a disjoint share of the identity groups of every epoch.
+
+  All ranks build the same epoch order as PKSampler, from the same seed and epoch, and cut it into P x K batches. Rank r takes batches r, r + world_size, r + 2 * world_size, ..., so the world_size batches of one step hold different identity groups, and every group of the epoch is seen once across ranks. The epoch is cut to a multiple of world_size batches, so every rank takes the same number of steps, as DistributedDataParallel requires.
+
+  Args:
+    dataset (list): (path, pid, cid) entries, as in crawler metadata
+    batch_size (int): P x K, per rank
+    instance (int): K, images per identity in a batch
+    rank (int): Rank of this process
+    world_size (int): Number of processes
+    seed (int): Seed of the epoch orders. Must be the same on every rank. None uses the seed of rank 0 (see utils.distributed.broadcast_seed).
+  """
+  def __init__(self, dataset, batch_size, instance, rank, world_size, seed=None):
+    super(DistributedPKSampler, self).__init__(dataset, batch_size, instance, seed=seed)
+    if seed is None:
+      self.seed = broadcast_seed(self.seed)
+    self.rank = rank
+    self.world_size = world_size
+    self.global_batches = PKSampler.__len__(self) // self.batch_size // world_size * world_size
+
+  def __len__(self):
+    return self.global_batches // self.world_size * self.batch_size
+
+  def epoch_indices(self, rng):
+    batches = super(DistributedPKSampler, self).epoch_indices(rng).reshape(-1, self.batch_size)
+    return batches[:self.global_batches][self.rank::self.world_size].reshape(-1)
+
+
+class DistributedShuffleSampler(Sampler):
+  """ Random order for multi-process training, where each rank gets a disjoint, equally long share of the dataset. The few images left over by the division are dropped, different ones each epoch.
+
+  Like torch.utils.data.distributed.DistributedSampler, but the epoch advances on every iteration, as with PKSampler, so trainers do not need to call set_epoch. The order depends only on the seed and the epoch, and is checkpointed with `state_dict`.
+
+  Args:
+    dataset (Dataset): Dataset to sample from
+    rank (int): Rank of this process
+    world_size (int): Number of processes
+    seed (int): Seed of the epoch orders. None uses a seed drawn on rank 0.
+  """
+  def __init__(self, dataset, rank, world_size, seed=None):
+    self.size = len(dataset)
+    self.num_samples = self.size // world_size
+    self.rank = rank
+    self.world_size = world_size
+    self.seed = broadcast_seed(int(np.random.randint(2**31 - 1))) if seed is None else seed
+    self.epoch = 0
+
+  def __len__(self):
+    return self.num_samples
+
+  def set_epoch(self, epoch):
+    self.epoch = epoch
+
+  def state_dict(self):
+    return {"seed": self.seed, "epoch": self.epoch}
+
+  def load_state_dict(self, state):
+    self.seed, self.epoch = state["seed"], state["epoch"]
+
+  def __iter__(self):
+    order = np.random.RandomState([self.seed, self.epoch]).permutation(self.size)[:self.num_samples * self.world_size]
+    self.epoch += 1
+    return iter(order[self.rank::self.world_size].tolist())
@@ -0,0 +1,122 @@
+import json
+import os
+
+import numpy as np
+import torch
+from torch.utils.data import Subset
+from torch.utils.data.dataloader import DataLoader as TorchDataLoader
+from utils.evaluation.store import dataset_fingerprint
+
+
+class EvalInputCache:
+  """ Wraps the test loader, and keeps the decoded and resized test images for later evaluations.
+
+  The test transform is deterministic, so every evaluation decodes and resizes the same images to the same pixels. The first full pass over the wrapped loader stores its uint8 (N, 3, H, W) images, in RAM or in a memmap on disk. Later passes read batches straight from the store, with no decoding and no loader workers. Normalization is cheap and runs on every pass, so the store does not depend on the normalization parameters.
+
+  An on-disk store is reused by later runs (e.g. `--mode test`) if it holds the same (path, pid, cid) entries, image shape, and decoding. Otherwise it is rewritten by the first pass. meta.json is written last, so an interrupted pass is not mistaken for a complete store.
+
+  Args:
+    loader (DataLoader): Test loader yielding (uint8 images, pids, cids, paths), over a dataset whose `dataset` attribute is the list of (path, pid, cid) entries. Its attributes are available on the wrapper.
+    store (str): 'memory', or a directory for the on-disk store
+    i_shape (int, int): Image shape
+    normalize (callable): uint8 batch to the model input, e.g. a BatchAugmentation without augmentation
+    draft (bool): Whether images were decoded with DATASET.DRAFT_DECODE. Part of the store's identity.
+  """
+  def __init__(self, loader, store, i_shape, normalize, draft=False):
+    self.loader = loader
+    self.store = store
+    self.normalize = normalize
+    entries = loader.dataset.dataset
+    self.count = len(entries)
+    self.paths = [path for path, _, _ in entries]
+    self.pids = torch.tensor([pid for _, pid, _ in entries], dtype=torch.int64)
+    self.cids = torch.tensor([cid for _, _, cid in entries], dtype=torch.int64)
+    self.shape = (self.count, 3) + tuple(i_shape)
+    self.meta = {"fingerprint": dataset_fingerprint(entries), "shape": list(self.shape), "draft": bool(draft)}
+    self.images = None
+    if store != "memory":
+      os.makedirs(store, exist_ok=True)
+      if os.path.exists(self._path("meta.json")):
+        with open(self._path("meta.json"), "r") as meta_file:
+          if json.load(meta_file) == self.meta:
+            self.images = np.memmap(self._path("images.bin"), dtype=np.uint8, mode="r", shape=self.shape)
+
+  def _path(self, name):
+    return os.path.join(self.store, name)
+
+  def __getattr__(self, name):
+    # only called for attributes the wrapper does not have
+    return getattr(self.__dict__["loader"], name)
+
+  def __len__(self):
+    return len(self.loader)
+
+  @property
+  def complete(self):
+    return self.images is not None
+
+  def __iter__(self):
+    if self.complete:
+      return self._read(np.arange(self.count))
+    return self._fill()
+
+  def with_indices(self, indices):
+    """ Iterable over the test entries at `indices` only, read from the store if it is complete """
+    return _CacheView(self, np.asarray(list(indices), dtype=np.int64))
+
+  def _read(self, indices):
+    for start in range(0, len(indices), self.batch_size):
+      batch = indices[start:start + self.batch_size]
+      if len(batch) and batch[-1] - batch[0] == len(batch) - 1:
+        images = self.images[batch[0]:batch[-1] + 1]   # contiguous, one read
+      else:
+        images = self.images[batch]
+      yield self.normalize(torch.from_numpy(np.array(images))), self.pids[batch], self.cids[batch], tuple(self.paths[idx] for idx in batch)
+
+  def _fill(self):
+    if self.store == "memory":
+      images = np.empty(self.shape, dtype=np.uint8)
+    else:
+      if os.path.exists(self._path("meta.json")):
+        os.remove(self._path("meta.json"))
+      images = np.memmap(self._path("images.bin"), dtype=np.uint8, mode="w+", shape=self.shape)
+    filled = 0
+    for img, pid, cid, path in self.loader:
+      images[filled:filled + len(img)] = img.numpy()
+      filled += len(img)
+      yield self.normalize(img), pid, cid, path
+    if filled != self.count:
+      return
+    if self.store == "memory":
+      self.images = images
+      return
+    images.flush()
+    del images
+    with open(self._path("meta.json.tmp"), "w") as meta_file:
+      json.dump(self.meta, meta_file)
+    os.replace(self._path("meta.json.tmp"), self._path("meta.json"))
+    self.images = np.memmap(self._path("images.bin"), dtype=np.uint8, mode="r", shape=self.shape)
+
+
+class _CacheView:
+  # a subset of the test entries, from the store if complete, else from the wrapped loader
+  def __init__(self, cache, indices):
+    self.cache = cache
+    self.indices = indices
+
+  def __len__(self):
+    return (len(self.indices) + self.cache.batch_size - 1) // self.cache.batch_size
+
+  def __iter__(self):
+    if self.cache.complete:
+      for batch in self.cache._read(self.indices):
+        yield batch
+      return
+    loader = self.cache.loader
+    if hasattr(loader, "with_indices"):
+      loader = loader.with_indices(self.indices.tolist())
+    else:
+      loader = TorchDataLoader(Subset(loader.dataset, self.indices.tolist()), batch_size=loader.batch_size, \
+                                shuffle=False, num_workers=loader.num_workers, collate_fn=loader.collate_fn)
+    for img, pid, cid, path in loader:
+      yield self.cache.normalize(img), pid, cid, path
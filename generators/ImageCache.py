@@ -0,0 +1,81 @@
+import multiprocessing
+
+import numpy as np
+import torch
+
+
+class ImageCache:
+  """ LRU cache of decoded, resized images, shared between DataLoader workers.
+
+  Images are stored as uint8 (H, W, 3) arrays in a slab of shared memory allocated up front, so a worker can serve an image another worker decoded. The slab holds budget // (H*W*3) images, capped at the dataset size. Once it is full, the least recently used image is evicted to make room.
+
+  Args:
+    num_items (int): Number of images in the dataset. Images are keyed by dataset index.
+    i_shape (int, int): (H, W) of the cached images
+    budget (int): Memory budget in bytes. 0 disables caching.
+
+  Methods:
+    get(idx, loader): The cached image for idx, calling loader() to decode and cache it on a miss
+    stats(): Hits, misses, cached images, and capacity
+  """
+  def __init__(self, num_items, i_shape, budget):
+    self.i_shape = tuple(i_shape)
+    self.image_bytes = self.i_shape[0] * self.i_shape[1] * 3
+    self.capacity = int(min(num_items, max(budget, 0) // self.image_bytes))
+    self.pixels = torch.zeros((self.capacity,) + self.i_shape + (3,), dtype=torch.uint8).share_memory_()
+    self.slot_of = torch.full((num_items,), -1, dtype=torch.int64).share_memory_()   # dataset index -> slot
+    self.item_of = torch.full((self.capacity,), -1, dtype=torch.int64).share_memory_()   # slot -> dataset index
+    self.last_used = torch.zeros(self.capacity, dtype=torch.int64).share_memory_()
+    self.counters = torch.zeros(4, dtype=torch.int64).share_memory_()   # clock, hits, misses, used slots
+    self.lock = multiprocessing.Lock()
+
+  @property
+  def nbytes(self):
+    return self.capacity * self.image_bytes
+
+  def get(self, idx, loader):
+    """ Cached image for dataset index idx.
+
+    Args:
+      idx (int): Dataset index
+      loader (callable): Returns the decoded, resized image as a uint8 (H, W, 3) array. Only called on a miss.
+
+    Returns:
+      ndarray: uint8 (H, W, 3) image
+    """
+    if self.capacity == 0:
+      return loader()
+    with self.lock:
+      slot = int(self.slot_of[idx])
+      self.counters[0] += 1
+      if slot >= 0:
+        self.counters[1] += 1
+        self.last_used[slot] = self.counters[0]
+        return self.pixels[slot].numpy().copy()
+      self.counters[2] += 1
+    # decode outside the lock, so workers decode in parallel
+    image = np.asarray(loader(), dtype=np.uint8)
+    if image.shape != self.pixels.shape[1:]:
+      return image
+    with self.lock:
+      if int(self.slot_of[idx]) >= 0:   # another worker cached it in the meantime
+        return image
+      slot = self._free_slot()
+      self.pixels[slot] = torch.from_numpy(image)
+      self.slot_of[idx] = slot
+      self.item_of[slot] = idx
+      self.last_used[slot] = self.counters[0]
+    return image
+
+  def _free_slot(self):
+    # caller holds the lock
+    used = int(self.counters[3])
+    if used < self.capacity:
+      self.counters[3] += 1
+      return used
+    slot = int(torch.argmin(self.last_used))
+    self.slot_of[self.item_of[slot]] = -1
+    return slot
+
+  def stats(self):
+    return {"hits": int(self.counters[1]), "misses": int(self.counters[2]), "cached": int(self.counters[3]), "capacity": self.capacity}
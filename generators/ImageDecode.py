@@ -0,0 +1,29 @@
+from PIL import Image
+from PIL import ImageFile
+ImageFile.LOAD_TRUNCATED_IMAGES = True
+
+
+def draft_size(i_shape):
+  """ PIL (width, height) a decode must cover so that resizing to i_shape only ever shrinks it.
+
+  Args:
+    i_shape (int or (int, int)): Size passed to T.Resize. A (H, W) pair, or an int for the shorter edge.
+  """
+  if isinstance(i_shape, int):
+    return (i_shape, i_shape)
+  return (int(i_shape[1]), int(i_shape[0]))
+
+
+def open_image(source, draft=None):
+  """ Open an image as RGB. With draft, JPEGs are decoded at reduced resolution.
+
+  The JPEG decoder can scale by 1/2, 1/4, or 1/8 while inverting the DCT, which skips most of the decoding work. PIL's `draft` picks the largest of these scales that still gives an image at least `draft` in both dimensions, so the following resize never upsamples. Other formats ignore it and decode at full size.
+
+  Args:
+    source (str or file): Image path, or file object
+    draft ((int, int)): Optional. Minimum (width, height) of the decoded image, from `draft_size`. None decodes at full resolution.
+  """
+  img = Image.open(source)
+  if draft is not None:
+    img.draft('RGB', draft)
+  return img.convert('RGB')
@@ -0,0 +1,91 @@
+import numpy as np
+from torch.utils.data.sampler import Sampler
+
+
+class PKSampler(Sampler):
+  """ P x K identity sampler. Each batch of batch_size consecutive indices has P = batch_size // instance identities with K = instance images each.
+
+  Samples the same way the earlier list-based TSampler did: each identity's images are shuffled and cut into groups of K, dropping the remainder (identities with fewer than K images are sampled K times with replacement), and each batch takes one group from each of P different identities. The epoch is built with numpy in rounds: round r holds the r-th group of every identity that has one, in random order, so every identity is drawn at the same rate. Identities ending one round's partial batch are moved to the end of the next round, so a batch never holds the same identity twice. The epoch ends at the first round with fewer than P identities, which can be a few batches earlier than TSampler, which kept going while any P identities had groups left.
+
+  The length is known at construction. The order depends only on the seed and the epoch, so a sampler resumed from `state_dict` repeats the epochs it would have produced.
+
+  Args:
+    dataset (list): (path, pid, cid) entries, as in crawler metadata. A CrawlTable's pid array is read directly.
+    batch_size (int): P x K
+    instance (int): K, images per identity in a batch
+    seed (int): Seed of the epoch orders. None draws one from numpy's global random state.
+
+  Methods:
+    state_dict(), load_state_dict(state): Seed and epoch, to resume the same sequence of epochs
+    set_epoch(epoch): Epoch whose order the next __iter__ produces
+  """
+  def __init__(self, dataset, batch_size, instance, seed=None):
+    self.batch_size = batch_size
+    self.instance = instance
+    self.unique_ids = self.batch_size // self.instance
+    self.seed = int(np.random.randint(2**31 - 1)) if seed is None else seed
+    self.epoch = 0
+
+    labels = np.asarray(dataset.pids, dtype=np.int64) if hasattr(dataset, "pids") else np.array([pid for _, pid, _ in dataset], dtype=np.int64)
+    self.pids, inverse, self.counts = np.unique(labels, return_inverse=True, return_counts=True)
+    self.order = np.argsort(inverse, kind="mergesort")    # dataset indices grouped by identity
+    self.starts = np.cumsum(self.counts) - self.counts
+    self.groups = np.maximum(self.counts, self.instance) // self.instance   # groups of K per identity
+
+    # identities with at least r+1 groups form round r. Rounds stop at the first one with fewer than P identities
+    self.round_sizes = np.bincount(self.groups, minlength=self.groups.max() + 1 if len(self.groups) else 1)[::-1].cumsum()[::-1][1:]
+    self.round_sizes = self.round_sizes[self.round_sizes >= self.unique_ids]
+    self.__len = int(self.round_sizes.sum()) // self.unique_ids * self.batch_size
+
+  def __len__(self):
+    return self.__len
+
+  def set_epoch(self, epoch):
+    self.epoch = epoch
+
+  def state_dict(self):
+    return {"seed": self.seed, "epoch": self.epoch}
+
+  def load_state_dict(self, state):
+    self.seed, self.epoch = state["seed"], state["epoch"]
+
+  def __iter__(self):
+    rng = np.random.RandomState([self.seed, self.epoch])
+    self.epoch += 1
+    return iter(self.epoch_indices(rng).tolist())
+
+  def epoch_indices(self, rng):
+    """ Dataset indices of one epoch, as an int64 array of length len(self) """
+    num_pids, K = len(self.pids), self.instance
+    # shuffle images within each identity: random keys, sorted within each identity's block
+    keys = rng.random_sample(len(self.order)) + np.repeat(np.arange(num_pids), self.counts)
+    shuffled = self.order[np.argsort(keys, kind="mergesort")]
+    # group j of identity p is images [j*K, (j+1)*K) of its shuffled block. Identities with fewer than K images draw K with replacement
+    small = self.counts < K
+    if small.any():
+      draws = self.starts[small][:, None] + (rng.random_sample((small.sum(), K)) * self.counts[small][:, None]).astype(np.int64)
+      small_groups = shuffled[draws]
+    small_row = np.cumsum(small) - 1
+
+    # identities by decreasing group count, so round r is a prefix of this order
+    by_groups = np.argsort(-self.groups, kind="mergesort")
+    sequence, carried = [], np.zeros(0, dtype=np.int64)
+    for round_idx, round_size in enumerate(self.round_sizes):
+      members = by_groups[:round_size][rng.permutation(round_size)]
+      if len(carried):
+        # identities in the unfinished batch of the previous round go last, so the batch is completed by other identities
+        tail = np.isin(members, carried)
+        members = np.concatenate([members[~tail], members[tail]])
+      sequence.append(np.stack([np.full(round_size, round_idx), members], axis=1))
+      carried = members[len(members) - (len(carried) + round_size) % self.unique_ids:] if (len(carried) + round_size) % self.unique_ids else np.zeros(0, dtype=np.int64)
+    if not sequence:
+      return np.zeros(0, dtype=np.int64)
+    sequence = np.concatenate(sequence, axis=0)[:self.__len // K]
+    rounds, members = sequence[:, 0], sequence[:, 1]
+
+    offsets = self.starts[members] + rounds * K
+    indices = shuffled[np.minimum(offsets[:, None] + np.arange(K)[None, :], len(shuffled) - 1)]   # clipped rows are small identities, replaced below
+    if small.any():
+      is_small = small[members]
+      indices[is_small] = small_groups[small_row[members[is_small]]]
+    return indices.reshape(-1)
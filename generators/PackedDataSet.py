@@ -0,0 +1,126 @@
+import json
+import multiprocessing
+import os
+
+import numpy as np
+import torchvision.transforms as T
+from PIL import Image
+from PIL import ImageFile
+from torch.utils.data import Dataset as TorchDataset
+from .ImageDecode import draft_size, open_image
+ImageFile.LOAD_TRUNCATED_IMAGES = True
+
+
+class _Decoder:
+  # picklable image decoder for the pack worker pool
+  def __init__(self, i_shape, draft=False):
+    self.resize = T.Resize(size=i_shape)
+    self.draft = draft_size(i_shape) if draft else None
+  def __call__(self, path):
+    return np.asarray(self.resize(open_image(path, self.draft)), dtype=np.uint8)
+
+
+def pack(metadata, directory, i_shape, splits=("train", "query", "test"), track_dict=None, workers=1, draft=False, logger=None):
+  """ Pack the images of a crawler into one contiguous uint8 memmap, readable by PackedDataSet without opening any image file.
+
+  Writes, in directory:
+    images.bin: uint8 (N, H, W, 3), every split's images decoded and resized to i_shape, splits back to back in the given order
+    index.bin: int64 (N, 3), the pid, cid, and track of each image. track is -1 for images without one.
+    paths.txt: Image paths, one per line
+    meta.json: Shape, and the [start, stop) rows of each split. Written last, so an interrupted pack is not mistaken for a complete one.
+
+  Args:
+    metadata (dict): Crawler metadata, with a 'crawl' list of (path, pid, cid) for each split
+    directory (str): Output directory. Created if it does not exist.
+    i_shape (int, int): (H, W) to resize images to. Should be DATASET.SHAPE.
+    splits (list): Splits of metadata to pack. Keep query right before test, so the test generator reads one contiguous range.
+    track_dict (dict): Optional. Image path -> track index, e.g. metadata['track']['dict'] for VeRi
+    workers (int): Processes decoding images in parallel
+    draft (bool): Decode JPEGs at reduced resolution before resizing, as with DATASET.DRAFT_DECODE
+    logger (logging.Logger): Optional. Logs progress.
+  """
+  i_shape = tuple(i_shape)
+  os.makedirs(directory, exist_ok=True)
+  if os.path.exists(os.path.join(directory, "meta.json")):
+    os.remove(os.path.join(directory, "meta.json"))
+  entries, ranges = [], {}
+  for split in splits:
+    ranges[split] = [len(entries), len(entries) + len(metadata[split]["crawl"])]
+    entries += metadata[split]["crawl"]
+  track_dict = track_dict if track_dict is not None else {}
+
+  images = np.memmap(os.path.join(directory, "images.bin"), dtype=np.uint8, mode="w+", shape=(max(len(entries), 1),) + i_shape + (3,))
+  decoder = _Decoder(i_shape, draft)
+  pool = multiprocessing.Pool(workers) if workers > 1 else None
+  decoded = pool.imap(decoder, [path for path, _, _ in entries], chunksize=64) if pool is not None else map(decoder, [path for path, _, _ in entries])
+  for idx, image in enumerate(decoded):
+    images[idx] = image
+    if logger is not None and (idx + 1) % 10000 == 0:
+      logger.info("Packed {} of {} images".format(idx + 1, len(entries)))
+  if pool is not None:
+    pool.close()
+    pool.join()
+  images.flush()
+  del images
+
+  index = np.array([(pid, cid, track_dict.get(path, -1)) for path, pid, cid in entries], dtype=np.int64).reshape(-1, 3)
+  index.tofile(os.path.join(directory, "index.bin"))
+  with open(os.path.join(directory, "paths.txt"), "w") as paths_file:
+    paths_file.write("\n".join(str(path) for path, _, _ in entries))
+  with open(os.path.join(directory, "meta.json.tmp"), "w") as meta_file:
+    json.dump({"shape": list(i_shape), "count": len(entries), "splits": ranges}, meta_file)
+  os.replace(os.path.join(directory, "meta.json.tmp"), os.path.join(directory, "meta.json"))
+  if logger is not None:
+    logger.info("Packed {} images of shape {} into {}".format(len(entries), i_shape, directory))
+
+
+class PackedDataSet(TorchDataset):
+  """ TDataSet over a pack written by `pack`. Images are slices of a memmap, so reading one opens no file and decodes nothing.
+
+  Returns the same (image, pid, cid, path) samples as TDataSet. Images in the pack are already resized, so transform should only hold the random augmentations and tensor conversion (SequencedGenerator.augmenter).
+
+  Args:
+    directory (str): Pack directory
+    splits (list): Splits to read, e.g. ['query', 'test']. Their rows must be contiguous in the pack.
+    transform (callable): Applied to each PIL image
+  """
+  def __init__(self, directory, splits, transform):
+    self.directory = directory
+    self.transform = transform
+    if not os.path.exists(os.path.join(directory, "meta.json")):
+      raise IOError("{directory} is not a complete pack. Run pack_dataset.py first".format(directory=directory))
+    with open(os.path.join(directory, "meta.json"), "r") as meta_file:
+      self.meta = json.load(meta_file)
+    ranges = sorted(self.meta["splits"][split] for split in splits)
+    for (_, stop), (start, _) in zip(ranges[:-1], ranges[1:]):
+      if stop != start:
+        raise ValueError("Splits {} are not contiguous in pack {}".format(list(splits), directory))
+    self.start, self.stop = ranges[0][0], ranges[-1][1]
+    index = np.fromfile(os.path.join(directory, "index.bin"), dtype=np.int64).reshape(-1, 3)[self.start:self.stop]
+    self.pids, self.cids, self.tracks = index[:, 0], index[:, 1], index[:, 2]
+    with open(os.path.join(directory, "paths.txt"), "r") as paths_file:
+      self.paths = paths_file.read().split("\n")[self.start:self.stop]
+    self.images = None   # opened lazily, so each worker maps the file itself instead of receiving a pickled copy
+
+  @property
+  def crawl(self):
+    return [(path, int(pid), int(cid)) for path, pid, cid in zip(self.paths, self.pids, self.cids)]
+
+  @property
+  def dataset(self):
+    # (path, pid, cid) entries, like TDataSet.dataset, for the embedding store and evaluation input cache
+    return self.crawl
+
+  def __getstate__(self):
+    state = self.__dict__.copy()
+    state["images"] = None
+    return state
+
+  def __len__(self):
+    return self.stop - self.start
+
+  def __getitem__(self, idx):
+    if self.images is None:
+      self.images = np.memmap(os.path.join(self.directory, "images.bin"), dtype=np.uint8, mode="r", shape=(max(self.meta["count"], 1),) + tuple(self.meta["shape"]) + (3,))
+    img_arr = self.transform(Image.fromarray(np.asarray(self.images[self.start + idx])))
+    return img_arr, int(self.pids[idx]), int(self.cids[idx]), self.paths[idx]
@@ -1,88 +1,62 @@
 import torch
 import torchvision.transforms as T
 from torch.utils.data.dataloader import DataLoader as TorchDataLoader
-from torch.utils.data.sampler import Sampler
+from .PKSampler import PKSampler
+from .DistributedSampler import DistributedPKSampler
+from .BatchAugmentation import BatchAugmentation, ToUInt8Tensor
 from torch.utils.data import Dataset as TorchDataset
 from PIL import Image
 from PIL import ImageFile
 ImageFile.LOAD_TRUNCATED_IMAGES = True
-from collections import defaultdict
-import random
 import os.path as osp
 import numpy as np
+from .ImageCache import ImageCache
+from .ImageDecode import draft_size, open_image
+from .PackedDataSet import PackedDataSet
+from .ShardedDataSet import ShardedDataSet, ShardedDataLoader
+from .WorkerPool import PooledLoader
+from .EvalInputCache import EvalInputCache
 
 import pdb
 class TDataSet(TorchDataset):
-  def __init__(self,dataset, transform):
+  def __init__(self,dataset, transform, resize=None, augment=None, cache_bytes=0, i_shape=None, draft=None):
+    """ Dataset over (path, pid, cid) entries.
+
+    Args:
+      dataset (list): (path, pid, cid) entries
+      transform (torchvision.transforms.Compose): Full transform, from the decoded image to the tensor
+      resize (callable): The deterministic part of transform, i.e. resizing. Only used with the cache.
+      augment (callable): The rest of transform, applied to resized images. Only used with the cache.
+      cache_bytes (int): Memory budget of the decoded image cache in bytes. 0 disables it.
+      i_shape (int, int): Image shape after resize. Required with the cache.
+      draft (int, int): Minimum (width, height) JPEGs are decoded at, from ImageDecode.draft_size. None decodes at full resolution.
+    """
     self.dataset = dataset
     self.transform = transform
+    self.resize = resize
+    self.augment = augment
+    self.draft = draft
+    self.cache = None
+    if cache_bytes > 0:
+      self.cache = ImageCache(len(self.dataset), i_shape, cache_bytes)
   def __len__(self):
     return len(self.dataset)
   def __getitem__(self,idx):
     img, pid, cid = self.dataset[idx]
-    img_arr = self.transform(self.load(img))
+    if self.cache is None:
+      img_arr = self.transform(self.load(img))
+    else:
+      # random augmentations run on the cached pixels; decoding and resizing happen once per image
+      img_arr = self.augment(Image.fromarray(self.cache.get(idx, lambda: np.asarray(self.resize(self.load(img)), dtype=np.uint8))))
     return img_arr, pid, cid, img
   
   def load(self,img):
     if not osp.exists(img):
       raise IOError("{img} does not exist in path".format(img=img))
-    img_load = Image.open(img).convert('RGB')
+    img_load = open_image(img, self.draft)
     return img_load
 
-class TSampler(Sampler):
-  """ Triplet sampler """
-  def __init__(self, dataset, batch_size, instance):
-    self.dataset = dataset
-    self.batch_size=batch_size
-    self.instance = instance
-    self.unique_ids = self.batch_size // self.instance
-    self.indices = defaultdict(list)
-    self.pids = set()
-    for idx, (img, pid, cid) in enumerate(self.dataset):
-      self.indices[pid].append(idx)
-      self.pids.add(pid)
-    self.pids = list(self.pids)
-    self.batch = 0
-    for pid in self.pids:
-      num_ids = len(self.indices[pid])
-      num_ids = self.instance if num_ids < self.instance else num_ids
-      self.batch += num_ids - num_ids % self.instance
-  
-  def __iter__(self):
-    batch_idx = defaultdict(list)
-    for pid in self.pids:
-      ids = [item for item in self.indices[pid]]
-      if len(ids) < self.instance:
-        ids = np.random.choice(ids, size=self.instance, replace=True)
-      random.shuffle(ids)
-      batch, batch_counter = [], 0
-      for idx in ids:
-        batch.append(idx)
-        batch_counter += 1
-        if len(batch) == self.instance:
-          batch_idx[pid].append(batch)
-          batch = []
-    _pids, r_pids = [item for item in self.pids], []
-    # Optimize this???
-    to_remove = {}
-    pid_len = len(_pids)
-    while pid_len >= self.unique_ids:
-      sampled = random.sample(_pids, self.unique_ids)
-      for pid in sampled:
-        batch = batch_idx[pid].pop(0)
-        r_pids.extend(batch)
-        if len(batch_idx[pid]) == 0:
-          to_remove[pid] = 1
-
-      _pids = [item for item in _pids if item not in to_remove]
-      pid_len = len(_pids)
-      to_remove = {}
-
-    self.__len = len(r_pids)
-    return iter(r_pids)
-  
-  def __len__(self):
-    return self.__len
+TSampler = PKSampler   # shared P x K sampler, see PKSampler.py
 class SequencedGenerator:
   def __init__(self,gpus, i_shape = (208,208), normalization_mean = 0.5, normalization_std = 0.5, normalization_scale = 1./255., h_flip = 0.5, t_crop = True, rea = True, **kwargs):
     """ Data generator for training and testing. Works with the VeriDataCrawler. Should work with any crawler working on VeRi-like data. Not yet tested with VehicleID. Only  use with VeRi.
@@ -90,7 +64,7 @@ class SequencedGenerator:
     Generates batches of batch size CONFIG.TRANSFORMATION.BATCH_SIZE, with CONFIG.TRANSFORMATION.INSTANCE unique ids. So if BATCH_SIZE=36 and INSTANCE=6, then generate batch of 36 images, with 6 identities, 6 image per identity. See arguments of setup function for INSTANCE.
 
     Args:
-      gpus (int): Number of GPUs
+      gpus (int): Number of GPUs. 0 for CPU-only runs, which count as one device for batch sizing
       i_shape (int, int): 2D Image shape
       normalization_mean (float): Value to pass as mean normalization parameter to pytorch Normalization
       normalization_std (float): Value to pass as std normalization parameter to pytorch Normalization
@@ -98,13 +72,36 @@ class SequencedGenerator:
       h_flip (float): Probability of horizontal flip for image
       t_crop (bool): Whether to include random cropping
       rea (bool): Whether to include random erasing augmentation (at 0.5 prob)
+
+    Kwargs:
+      rea_value (float): Value of randomly erased pixels
+      batch_augmentation (str): Where flip, crop, normalization, and random erasing run. One of:
+        1. None - per sample, in the loader workers (default)
+        2. 'collate' - on the whole uint8 batch, in collate_fn
+        3. 'device' - on the whole uint8 batch, after the trainer moves it to the device. Batches leave the workers as uint8, and `batch_augmentation` must be applied by the trainer.
+      draft_decode (bool): Decode JPEGs at the smallest 1/2, 1/4, or 1/8 DCT scale that still covers i_shape, then resize. Default False
     
     """
-    self.gpus = gpus
+    self.gpus = max(gpus, 1)
+    self.i_shape = i_shape
+    self.draft = draft_size(i_shape) if kwargs.get("draft_decode", False) else None
+    self.normalization = (normalization_mean, normalization_std)
+    self.deterministic = not (h_flip > 0 or t_crop or rea)
     
     transformer_primitive = []
     
-    transformer_primitive.append(T.Resize(size=i_shape))
+    self.resizer = T.Resize(size=i_shape)
+    self.batch_mode = kwargs.get("batch_augmentation", None) or None
+    if self.batch_mode not in [None, "collate", "device"]:
+      raise NotImplementedError("batch_augmentation must be one of [None, 'collate', 'device']. Got %s"%self.batch_mode)
+    self.batch_augmenter, self.batch_augmentation = None, None
+    if self.batch_mode is not None:
+      # workers only decode and resize. Everything random runs once per batch
+      self.batch_augmenter = BatchAugmentation(i_shape, normalization_mean, normalization_std, h_flip, t_crop, rea, kwargs.get('rea_value', 0))
+      self.batch_augmentation = self.batch_augmenter if self.batch_mode == "device" else None
+      self.augmenter = ToUInt8Tensor()
+      self.transformer = T.Compose([self.resizer, self.augmenter])
+      return
     if h_flip > 0:
       transformer_primitive.append(T.RandomHorizontalFlip(p=h_flip))
     if t_crop:
@@ -113,47 +110,102 @@ class SequencedGenerator:
     transformer_primitive.append(T.Normalize(mean=normalization_mean, std=normalization_std))
     if rea:
       transformer_primitive.append(T.RandomErasing(p=0.5, scale=(0.02, 0.4), value = kwargs.get('rea_value', 0)))
-    self.transformer = T.Compose(transformer_primitive)
+    self.augmenter = T.Compose(transformer_primitive)
+    self.transformer = T.Compose([self.resizer] + transformer_primitive)
 
-  def setup(self,datacrawler, mode='train', batch_size=32, instance = 8, workers = 8):
+  def setup(self,datacrawler, mode='train', batch_size=32, instance = 8, workers = 8, cache_bytes = 0, packed_folder = None, sharded_folder = None, shuffle_buffer = 10000, sampler_seed = None, pin_memory = False, worker_pool = None, eval_cache = None, rank = 0, world_size = 1):
     """ Setup the data generator.
 
     Args:
       workers (int): Number of workers to use during data retrieval/loading
       datacrawler (VeRiDataCrawler): A DataCrawler object that has crawled the data directory
       mode (str): One of 'train', 'test', 'query'. 
+      cache_bytes (int): Memory budget, in bytes, for caching decoded and resized images in shared memory. Least recently used images are evicted past the budget. 0 disables the cache.
+      packed_folder (str): Pack written by pack_dataset.py for this crawler and image shape. If provided, images are read from the pack instead of image files, and cache_bytes is ignored.
+      sharded_folder (str): Shards written by pack_dataset.py --format sharded. Only used in 'train' mode: images are streamed from the shards in P x K batches instead of sampled by TSampler.
+      shuffle_buffer (int): Images each loader worker buffers when streaming shards. Larger buffers mix identities from more shards into each batch.
+      sampler_seed (int): Seed of the P x K sampler in 'train' mode, or of the shard order and buffer draws with sharded_folder. None picks a random seed. The P x K sampler's state is saved with checkpoints either way; the shard stream's epoch is not.
+      pin_memory (bool): Collate batches into pinned memory, for faster asynchronous copies to a GPU
+      worker_pool (WorkerPool): Optional. Persistent workers to load batches with, instead of workers forked by each DataLoader iteration. Can be shared with other generators. Not used with sharded_folder.
+      eval_cache (str): Optional. 'test' mode only, for deterministic transforms. Keep the decoded and resized test images after the first evaluation, in RAM ('memory') or in this directory, and feed later evaluations from them. Ignored with packed_folder, which already holds them.
+      rank (int): Rank of this process in multi-process training. In 'train' mode, each rank samples a disjoint share of the P x K batches of every epoch.
+      world_size (int): Number of training processes. batch_size is per process.
     """
     if datacrawler is None:
       raise ValueError("Must pass DataCrawler instance. Passed `None`")
-    self.workers = workers * self.gpus
+    self.workers = workers  # independent of the GPU count, so CPU-only runs get loader workers too
+    if world_size > 1 and mode == "train" and sharded_folder is not None:
+      raise NotImplementedError("sharded_folder is not supported in multi-process training. Use packed_folder or image files")
 
-    if mode == "train":
-      self.__dataset = TDataSet(datacrawler.metadata[mode]["crawl"], self.transformer)
+    if mode == "train" and sharded_folder is not None:
+      self.__dataset = ShardedDataSet(sharded_folder, mode, self.transformer, batch_size=batch_size*self.gpus, instance=instance*self.gpus, shuffle_buffer=shuffle_buffer, draft=self.draft, seed=sampler_seed)
+    elif packed_folder is not None:
+      splits = ["train"] if mode == "train" else ["query", "test"]
+      self.__dataset = PackedDataSet(packed_folder, splits, self.augmenter)
+      if self.__dataset.paths != [path for split in splits for path, _, _ in datacrawler.metadata[split]["crawl"]]:
+        raise ValueError("Pack {} does not match the crawled {} images. Re-run pack_dataset.py".format(packed_folder, mode))
+      if list(self.__dataset.meta["shape"]) != list(self.i_shape):
+        raise ValueError("Pack {} holds images of shape {}, not {}. Re-run pack_dataset.py".format(packed_folder, self.__dataset.meta["shape"], list(self.i_shape)))
+    elif mode == "train":
+      self.__dataset = TDataSet(datacrawler.metadata[mode]["crawl"], self.transformer, self.resizer, self.augmenter, cache_bytes, self.i_shape, self.draft)
     elif mode == "test":
       # For testing, we combine images in the query and testing set to generate batches
-      self.__dataset = TDataSet(datacrawler.metadata["query"]["crawl"] + datacrawler.metadata[mode]["crawl"], self.transformer)
+      transformer, augmenter = self.transformer, self.augmenter
+      if eval_cache is not None:
+        if not self.deterministic or self.batch_mode is not None:
+          raise ValueError("eval_cache needs a deterministic transform: no h_flip, t_crop, rea, or batch_augmentation")
+        augmenter = ToUInt8Tensor()   # the cache stores uint8 images, and normalizes them itself
+        transformer = T.Compose([self.resizer, augmenter])
+      self.__dataset = TDataSet(datacrawler.metadata["query"]["crawl"] + datacrawler.metadata[mode]["crawl"], transformer, self.resizer, augmenter, cache_bytes, self.i_shape, self.draft)
     else:
       raise NotImplementedError()
     
-    if mode == "train":
+    if isinstance(self.__dataset, ShardedDataSet):
+      # P x K batches are assembled by the dataset itself
+      self.dataloader = ShardedDataLoader(self.__dataset, batch_size=batch_size*self.gpus, drop_last=True, \
+                                        num_workers=self.workers, collate_fn=self.collate_simple, pin_memory=pin_memory)
+      self.num_entities = datacrawler.metadata[mode]["pids"]
+    elif worker_pool is not None:
+      # persistent workers. The dataset is handed to them once, when the pool starts
+      if mode == "train":
+        self.dataloader = PooledLoader(worker_pool, mode, self.__dataset, batch_size=batch_size*self.gpus, collate_fn=self.collate_simple, \
+                                        sampler = self.train_sampler(datacrawler.metadata[mode]["crawl"], batch_size*self.gpus, instance*self.gpus, sampler_seed, rank, world_size), pin_memory=pin_memory)
+        self.num_entities = datacrawler.metadata[mode]["pids"]
+      else:
+        self.dataloader = PooledLoader(worker_pool, mode, self.__dataset, batch_size=batch_size*self.gpus, collate_fn=self.collate_with_camera, pin_memory=pin_memory)
+        self.num_entities = len(datacrawler.metadata["query"]["crawl"])
+    elif mode == "train":
       self.dataloader = TorchDataLoader(self.__dataset, batch_size=batch_size*self.gpus, \
-                                        sampler = TSampler(datacrawler.metadata[mode]["crawl"], batch_size=batch_size*self.gpus, instance=instance*self.gpus), \
-                                        num_workers=self.workers, collate_fn=self.collate_simple)
+                                        sampler = self.train_sampler(datacrawler.metadata[mode]["crawl"], batch_size*self.gpus, instance*self.gpus, sampler_seed, rank, world_size), \
+                                        num_workers=self.workers, collate_fn=self.collate_simple, pin_memory=pin_memory)
       self.num_entities = datacrawler.metadata[mode]["pids"]
     elif mode == "test":
       self.dataloader = TorchDataLoader(self.__dataset, batch_size=batch_size*self.gpus, \
                                         shuffle = False, 
-                                        num_workers=self.workers, collate_fn=self.collate_with_camera)
+                                        num_workers=self.workers, collate_fn=self.collate_with_camera, pin_memory=pin_memory)
       self.num_entities = len(datacrawler.metadata["query"]["crawl"])
     else:
       raise NotImplementedError()
+    if isinstance(self.__dataset, TDataSet) and mode == "test" and eval_cache is not None:
+      normalize = BatchAugmentation(self.i_shape, *self.normalization, h_flip=0, t_crop=False, rea=False)
+      self.dataloader = EvalInputCache(self.dataloader, eval_cache, self.i_shape, normalize, draft=self.draft is not None)
     
+  def train_sampler(self, crawl, batch_size, instance, seed, rank, world_size):
+    if world_size > 1:
+      return DistributedPKSampler(crawl, batch_size=batch_size, instance=instance, rank=rank, world_size=world_size, seed=seed)
+    return TSampler(crawl, batch_size=batch_size, instance=instance, seed=seed)
+
   def collate_simple(self,batch):
     img, pid, _, _ = zip(*batch)
     pid = torch.tensor(pid, dtype=torch.int64)
-    return torch.stack(img, dim=0), pid
+    return self.collate_images(img), pid
   def collate_with_camera(self,batch):
     img, pid, cid, path = zip(*batch)
     pid = torch.tensor(pid, dtype=torch.int64)
     cid = torch.tensor(cid, dtype=torch.int64)
-    return torch.stack(img, dim=0), pid, cid, path
+    return self.collate_images(img), pid, cid, path
+  def collate_images(self, img):
+    img = torch.stack(img, dim=0)
+    if self.batch_mode == "collate":
+      img = self.batch_augmenter(img)
+    return img
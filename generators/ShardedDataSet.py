@@ -0,0 +1,199 @@
+import io
+import json
+import os
+import random
+import tarfile
+from collections import OrderedDict
+
+import torch
+from PIL import ImageFile
+from torch.utils.data import IterableDataset
+from torch.utils.data.dataloader import DataLoader as TorchDataLoader
+from .ImageDecode import open_image
+ImageFile.LOAD_TRUNCATED_IMAGES = True
+
+
+def write_shards(metadata, directory, split="train", shard_bytes=100 * 2**20, seed=0, logger=None):
+  """ Write the images of one crawler split into tar shards of about shard_bytes each, for ShardedDataSet.
+
+  Each sample is two consecutive tar members: '<n>.jpg' with the original image file bytes, and '<n>.json' with its pid, cid, and path. Images of one identity are kept together, and identities are written in a random order, so a shard holds complete identities from across the dataset. <split>.json lists the shards with their sample counts, and the number of images of each identity.
+
+  Args:
+    metadata (dict): Crawler metadata, with a 'crawl' list of (path, pid, cid) for the split
+    directory (str): Output directory. Created if it does not exist.
+    split (str): Split of metadata to write
+    shard_bytes (int): Target shard size in bytes. A shard is closed once it reaches this size.
+    seed (int): Seed of the identity order
+    logger (logging.Logger): Optional. Logs each shard.
+  """
+  os.makedirs(directory, exist_ok=True)
+  by_pid = OrderedDict()
+  for path, pid, cid in metadata[split]["crawl"]:
+    by_pid.setdefault(pid, []).append((path, pid, cid))
+  pids = list(by_pid.keys())
+  random.Random(seed).shuffle(pids)
+
+  shards, shard, shard_size, shard_count, sample_idx = [], None, 0, 0, 0
+  for pid in pids:
+    for path, pid, cid in by_pid[pid]:
+      if shard is None:
+        name = "{}-{:06d}.tar".format(split, len(shards))
+        shard, shard_size, shard_count = tarfile.open(os.path.join(directory, name), "w"), 0, 0
+      with open(path, "rb") as image_file:
+        image_bytes = image_file.read()
+      record = json.dumps({"pid": int(pid), "cid": int(cid), "path": str(path)}).encode("utf-8")
+      for suffix, data in [("jpg", image_bytes), ("json", record)]:
+        info = tarfile.TarInfo("{:09d}.{}".format(sample_idx, suffix))
+        info.size = len(data)
+        shard.addfile(info, io.BytesIO(data))
+      sample_idx += 1
+      shard_count += 1
+      shard_size += len(image_bytes) + len(record) + 1024   # plus the two tar headers
+      if shard_size >= shard_bytes:
+        shard.close()
+        shards.append({"name": name, "count": shard_count})
+        if logger is not None:
+          logger.info("Wrote shard {} with {} images".format(name, shard_count))
+        shard = None
+  if shard is not None:
+    shard.close()
+    shards.append({"name": name, "count": shard_count})
+
+  with open(os.path.join(directory, split + ".json.tmp"), "w") as index_file:
+    json.dump({"shards": shards, "count": sample_idx, "pid_counts": {str(pid): len(by_pid[pid]) for pid in pids}}, index_file)
+  os.replace(os.path.join(directory, split + ".json.tmp"), os.path.join(directory, split + ".json"))
+  if logger is not None:
+    logger.info("Wrote {} images of split {} into {} shards in {}".format(sample_idx, split, len(shards), directory))
+
+
+class ShardedDataSet(IterableDataset):
+  """ Streams a split written by `write_shards`, and yields samples in P x K identity batches like TSampler.
+
+  Shards are read front to back, in a random order each epoch, and split between DataLoader workers. Samples wait in a buffer of at most shuffle_buffer images, grouped by identity. Once P identities have K images buffered, P of the ready identities are picked at random and K random images of each are yielded, so every batch_size consecutive samples of a worker form one P x K batch. When the buffer is full, the identity buffered longest is settled as TSampler would: if it was never batched, it is completed to K images by sampling with replacement, otherwise its last fewer-than-K images are dropped. The same happens to everything left at the end of the epoch.
+
+  Use with `ShardedDataLoader` (or any DataLoader with the same batch_size and drop_last), so batches do not straddle workers. The shard order and the buffer draws depend only on the seed and the epoch. ShardedDataLoader advances the epoch at every iteration; with another DataLoader, call `set_epoch` before each epoch.
+
+  Args:
+    directory (str): Shard directory
+    split (str): Split to read
+    transform (callable): Applied to each decoded PIL image
+    batch_size (int): P x K
+    instance (int): K, images per identity in a batch
+    shuffle_buffer (int): Maximum images buffered per worker
+    draft (int, int): Minimum (width, height) JPEGs are decoded at, from ImageDecode.draft_size. None decodes at full resolution.
+    seed (int): Seed of the epoch orders. None draws one from the global random state.
+  """
+  def __init__(self, directory, split, transform, batch_size, instance, shuffle_buffer=10000, draft=None, seed=None):
+    self.directory = directory
+    self.transform = transform
+    self.batch_size = batch_size
+    self.instance = instance
+    self.unique_ids = batch_size // instance
+    self.shuffle_buffer = max(shuffle_buffer, batch_size)
+    self.draft = draft
+    self.seed = random.randrange(2**31 - 1) if seed is None else seed
+    self.epoch = 0
+    if not os.path.exists(os.path.join(directory, split + ".json")):
+      raise IOError("{directory} has no shards for split {split}. Run pack_dataset.py --format sharded first".format(directory=directory, split=split))
+    with open(os.path.join(directory, split + ".json"), "r") as index_file:
+      self.index = json.load(index_file)
+    self.shards = [os.path.join(directory, shard["name"]) for shard in self.index["shards"]]
+
+  def __len__(self):
+    # samples in full P x K batches per epoch, as TSampler counts them. Approximate once split between workers
+    samples = 0
+    for count in self.index["pid_counts"].values():
+      count = max(count, self.instance)
+      samples += count - count % self.instance
+    return samples - samples % self.batch_size
+
+  def set_epoch(self, epoch):
+    # set in the main process, before workers get their copy of the dataset
+    self.epoch = epoch
+
+  def _samples(self, shards):
+    for shard in shards:
+      with tarfile.open(shard, "r|") as stream:
+        image_bytes = None
+        for member in stream:
+          data = stream.extractfile(member).read()
+          if member.name.endswith(".jpg"):
+            image_bytes = data
+          else:
+            yield image_bytes, json.loads(data.decode("utf-8"))
+
+  def _decode(self, image_bytes, record):
+    img = open_image(io.BytesIO(image_bytes), self.draft)
+    return self.transform(img), record["pid"], record["cid"], record["path"]
+
+  def __iter__(self):
+    worker = torch.utils.data.get_worker_info()
+    # workers share the epoch's shard order, and each takes its own share of it
+    shards = list(self.shards)
+    random.Random("{}-{}".format(self.seed, self.epoch)).shuffle(shards)
+    if worker is not None:
+      shards = shards[worker.id::worker.num_workers]
+    rng = random.Random("{}-{}-{}".format(self.seed, self.epoch, -1 if worker is None else worker.id))
+
+    buffered, ready, batched, size = OrderedDict(), set(), set(), 0
+    for image_bytes, record in self._samples(shards):
+      pid = record["pid"]
+      buffered.setdefault(pid, []).append((image_bytes, record))
+      size += 1
+      if len(buffered[pid]) >= self.instance:
+        ready.add(pid)
+      if size >= self.shuffle_buffer and len(ready) < len(buffered):
+        size += self._settle(next(pid for pid in buffered if pid not in ready), buffered, ready, batched, rng)
+      while len(ready) >= self.unique_ids and (size >= self.shuffle_buffer or len(ready) >= 2 * self.unique_ids):
+        batch, size = self._pop_batch(buffered, ready, batched, size, rng)
+        for sample in batch:
+          yield self._decode(*sample)
+
+    # end of the epoch: settle every identity left, then drain
+    for pid in [pid for pid in buffered if pid not in ready]:
+      size += self._settle(pid, buffered, ready, batched, rng)
+    while len(ready) >= self.unique_ids:
+      batch, size = self._pop_batch(buffered, ready, batched, size, rng)
+      for sample in batch:
+        yield self._decode(*sample)
+
+  def _settle(self, pid, buffered, ready, batched, rng):
+    # an identity with fewer than K images buffered: complete it if it was never batched, drop the remainder otherwise. Returns the change in buffer size
+    samples = buffered[pid]
+    if pid in batched:
+      del buffered[pid]
+      return -len(samples)
+    missing = self.instance - len(samples)
+    samples.extend(rng.choice(samples) for _ in range(missing))
+    ready.add(pid)
+    return missing
+
+  def _pop_batch(self, buffered, ready, batched, size, rng):
+    batch = []
+    for pid in rng.sample(sorted(ready), self.unique_ids):
+      samples = buffered[pid]
+      rng.shuffle(samples)
+      batch.extend(samples[:self.instance])
+      del samples[:self.instance]
+      size -= self.instance
+      batched.add(pid)
+      if len(samples) < self.instance:
+        ready.discard(pid)
+      if len(samples) == 0:
+        del buffered[pid]
+    return batch, size
+
+
+class ShardedDataLoader(TorchDataLoader):
+  """ DataLoader over a ShardedDataSet, with a length, so training loops can report steps per epoch. Each iteration is a new epoch of the dataset. """
+  def __init__(self, *args, **kwargs):
+    super(ShardedDataLoader, self).__init__(*args, **kwargs)
+    self.epoch = 0
+
+  def __len__(self):
+    return len(self.dataset) // self.batch_size
+
+  def __iter__(self):
+    self.dataset.set_epoch(self.epoch)
+    self.epoch += 1
+    return super(ShardedDataLoader, self).__iter__()
@@ -0,0 +1,179 @@
+import atexit
+import itertools
+import queue
+import random
+import threading
+import traceback
+from collections import OrderedDict
+
+import numpy as np
+import torch
+import torch.multiprocessing as multiprocessing
+from torch.utils.data.sampler import BatchSampler, SequentialSampler
+
+
+class _WorkerError:
+  # picklable stand-in for an exception raised in a worker, re-raised by the loader
+  def __init__(self, worker_id, trace):
+    self.worker_id = worker_id
+    self.trace = trace
+
+
+def _worker_loop(datasets, tasks, results, seed, worker_id):
+  torch.set_num_threads(1)
+  random.seed(seed)
+  torch.manual_seed(seed)
+  np.random.seed(seed % 2**32)
+  while True:
+    task = tasks.get()
+    if task is None:
+      return
+    token, batch_idx, name, indices = task
+    try:
+      dataset, collate_fn = datasets[name]
+      batch = collate_fn([dataset[idx] for idx in indices])
+    except Exception:
+      batch = _WorkerError(worker_id, traceback.format_exc())
+    results.put((token, batch_idx, batch))
+
+
+class WorkerPool:
+  """ Loader worker processes that stay alive across epochs, and can serve several datasets.
+
+  A DataLoader forks new workers every time it is iterated, and each of them gets its own copy of the dataset and transform. A WorkerPool forks its workers once, on the first iteration of any of its loaders, with every registered dataset. Loaders then only send batch indices and receive collated batches, so a new epoch or an evaluation starts without process start-up. Train and test loaders can share one pool, or each have their own.
+
+  Registering a dataset after the workers started restarts them on the next iteration, so register everything (i.e. build every PooledLoader) before training starts.
+
+  Args:
+    workers (int): Worker processes
+    prefetch (int): Batches queued per worker ahead of the one being consumed
+  """
+  def __init__(self, workers, prefetch=2):
+    self.workers = max(workers, 1)
+    self.prefetch = max(prefetch, 1)
+    self.datasets = OrderedDict()
+    self.processes = []
+    self.tokens = itertools.count()
+    self.lock = threading.Lock()
+    self.pending = {}   # iteration token -> {batch index: batch} received out of order
+    atexit.register(self.close)
+
+  def register(self, name, dataset, collate_fn):
+    if name in self.datasets and self.datasets[name] == (dataset, collate_fn):
+      return
+    if self.processes:
+      self.close()    # restarted with the new dataset on the next iteration
+    self.datasets[name] = (dataset, collate_fn)
+
+  def start(self):
+    self.tasks, self.results = multiprocessing.Queue(), multiprocessing.Queue()
+    base_seed = torch.empty((), dtype=torch.int64).random_().item()   # as DataLoader seeds its workers
+    for worker_id in range(self.workers):
+      process = multiprocessing.Process(target=_worker_loop, args=(self.datasets, self.tasks, self.results, base_seed + worker_id, worker_id), daemon=True)
+      process.start()
+      self.processes.append(process)
+
+  def close(self):
+    if not self.processes:
+      return
+    for _ in self.processes:
+      self.tasks.put(None)
+    for process in self.processes:
+      process.join(timeout=5)
+      if process.is_alive():
+        process.terminate()
+    self.processes = []
+
+  def iterate(self, name, batch_sampler):
+    """ Collated batches of dataset `name`, for the index lists of batch_sampler, in order """
+    with self.lock:
+      if not self.processes:
+        self.start()
+      token = next(self.tokens)
+      self.pending[token] = {}
+    batches = enumerate(batch_sampler)
+
+    def submit():
+      item = next(batches, None)
+      if item is None:
+        return 0
+      self.tasks.put((token, item[0], name, list(item[1])))
+      return 1
+
+    try:
+      outstanding = sum(submit() for _ in range(self.prefetch * self.workers))
+      batch_idx = 0
+      while outstanding:
+        batch = self._result(token, batch_idx)
+        outstanding += submit() - 1
+        batch_idx += 1
+        if isinstance(batch, _WorkerError):
+          raise RuntimeError("Caught an exception in pool worker {}:\n{}".format(batch.worker_id, batch.trace))
+        yield batch
+    finally:
+      # batches of an abandoned iteration still in flight are dropped on arrival
+      with self.lock:
+        self.pending.pop(token, None)
+
+  def _result(self, token, batch_idx):
+    # the result queue is shared by every loader of the pool, e.g. a prefetch thread and an evaluation
+    while True:
+      with self.lock:
+        received = self.pending[token]
+        if batch_idx in received:
+          return received.pop(batch_idx)
+        try:
+          result_token, result_idx, batch = self.results.get(timeout=0.1)
+        except queue.Empty:
+          dead = [process.pid for process in self.processes if not process.is_alive()]
+          if dead:
+            raise RuntimeError("Pool workers {} exited unexpectedly".format(dead))
+          continue
+        if result_token in self.pending:
+          self.pending[result_token][result_idx] = batch
+
+
+class PooledLoader:
+  """ DataLoader-like loader whose batches are prepared by a WorkerPool.
+
+  Args:
+    pool (WorkerPool): Pool to use. The dataset is registered with it under `name`.
+    name (str): Name of the dataset in the pool
+    dataset (Dataset): Map-style dataset
+    batch_size (int): Batch size
+    collate_fn (callable): Collates a list of samples into a batch
+    sampler (Sampler or list): Dataset indices, in order. Sequential if None.
+    drop_last (bool): Drop the last incomplete batch
+    pin_memory (bool): Pin the tensors of each batch as it is received
+  """
+  def __init__(self, pool, name, dataset, batch_size, collate_fn, sampler=None, drop_last=False, pin_memory=False):
+    self.pool = pool
+    self.name = name
+    self.dataset = dataset
+    self.batch_size = batch_size
+    self.collate_fn = collate_fn
+    self.sampler = sampler if sampler is not None else SequentialSampler(dataset)
+    self.drop_last = drop_last
+    self.pin_memory = pin_memory
+    self.batch_sampler = BatchSampler(self.sampler, batch_size, drop_last)
+    self.num_workers = pool.workers
+    pool.register(name, dataset, collate_fn)
+
+  def __len__(self):
+    return len(self.batch_sampler)
+
+  def __iter__(self):
+    for batch in self.pool.iterate(self.name, self.batch_sampler):
+      yield _pin(batch) if self.pin_memory else batch
+
+  def with_indices(self, indices):
+    """ Loader over only the given dataset indices, on the same pool """
+    return PooledLoader(self.pool, self.name, self.dataset, self.batch_size, self.collate_fn, sampler=list(indices), drop_last=self.drop_last, pin_memory=self.pin_memory)
+
+
+def _pin(batch):
+  if isinstance(batch, torch.Tensor):
+    return batch.pin_memory()
+  if isinstance(batch, (list, tuple)):
+    return type(batch)(_pin(item) for item in batch)
+  return batch
@@ -1,4 +1,7 @@
 from .SequencedGenerator import SequencedGenerator
+from .DeviceLoader import DeviceLoader
+from .WorkerPool import WorkerPool, PooledLoader
+from .DistributedSampler import DistributedPKSampler, DistributedShuffleSampler
 TripletGenerator = SequencedGenerator
 
 from .ClassedGenerator import ClassedGenerator
@@ -17,7 +17,7 @@ class CenterLoss(Loss):
         
         self.num_classes = num_classes
         self.feat_dim = feat_dim
-        self.centers = nn.Parameter(torch.randn(self.num_classes, self.feat_dim).cuda())
+        self.centers = nn.Parameter(torch.randn(self.num_classes, self.feat_dim))
         
     def forward(self, features, labels):
         """
@@ -30,7 +30,7 @@ class CenterLoss(Loss):
                   torch.pow(self.centers, 2).sum(dim=1, keepdim=True).expand(self.num_classes, batch_size).t()
         distmat.addmm_(1, -2, features, self.centers.t())
 
-        classes = torch.arange(self.num_classes).long().cuda()
+        classes = torch.arange(self.num_classes, device=features.device).long()
         labels = labels.unsqueeze(1).expand(batch_size, self.num_classes)
         mask = labels.eq(classes.expand(batch_size, self.num_classes))
 
@@ -45,15 +45,11 @@ class ClusterLoss(Loss):
              cluster_loss
         """
         
-        unique_labels = targets.cpu().unique().cuda()
+        unique_labels = targets.unique()
 
-        inter_min_distance = torch.zeros(unique_labels.size(0))
-        intra_max_distance = torch.zeros(unique_labels.size(0))
-        center_features = torch.zeros(unique_labels.size(0), features.size(1))
-
-        inter_min_distance = inter_min_distance.cuda()
-        intra_max_distance = intra_max_distance.cuda()
-        center_features = center_features.cuda()
+        inter_min_distance = torch.zeros(unique_labels.size(0), device=features.device)
+        intra_max_distance = torch.zeros(unique_labels.size(0), device=features.device)
+        center_features = torch.zeros(unique_labels.size(0), features.size(1), device=features.device)
 
         index = torch.range(0, unique_labels.size(0) - 1)
         for i in range(unique_labels.size(0)):
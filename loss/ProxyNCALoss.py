@@ -27,7 +27,7 @@ class ProxyNCA(Loss):
         self.SMOOTHING = kwargs.get("smoothing", 0.1)
         self.NORMALIZATION = kwargs.get("normalization", 3.0)
         self.logsoftmax = nn.LogSoftmax(dim=-1)
-        self.proxies = nn.Parameter(torch.randn(self.classes, self.embedding) / 8).cuda()
+        self.proxies = nn.Parameter(torch.randn(self.classes, self.embedding) / 8)
 
     def forward(self,features, labels):
         normalized_proxy = self.NORMALIZATION * torch.nn.functional.normalize(self.proxies, p=2,dim=-1)
@@ -39,8 +39,7 @@ class ProxyNCA(Loss):
         log_probs = self.logsoftmax(dist)
 
         # smooth labels
-        labels = torch.zeros(log_probs.size()).scatter_(1, labels.unsqueeze(1).data.cpu(), 1)
-        labels = labels.cuda()
+        labels = torch.zeros(log_probs.size(), device=log_probs.device).scatter_(1, labels.unsqueeze(1).data, 1)
         labels = (1 - (self.SMOOTHING + (self.SMOOTHING / self.embedding))) * labels + self.SMOOTHING / self.embedding
 
         # cross entropy with distances as logits, one hot labels
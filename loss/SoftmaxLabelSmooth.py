@@ -28,8 +28,7 @@ class SoftmaxLabelSmooth(Loss):
             labels: ground truth labels with shape (batch_size)
         """
         log_probs = self.logsoftmax(logits)
-        labels = torch.zeros(log_probs.size()).scatter_(1, labels.unsqueeze(1).data.cpu(), 1)
-        labels = labels.cuda()
+        labels = torch.zeros(log_probs.size(), device=log_probs.device).scatter_(1, labels.unsqueeze(1).data, 1)
         labels = (1 - self.eps) * labels + self.eps / self.soft_dim
         loss = (- labels * log_probs).mean(0).sum()
         return loss
\ No newline at end of file
@@ -39,7 +39,7 @@ class TripletLoss(Loss):
     return self.loss_fn(features, labels, self.margin)
 
 
-  def hard_mining(self, features, labels, margin, squared=False, device='cuda'):
+  def hard_mining(self, features, labels, margin, squared=False, device=None):
     """Build the triplet loss over a batch of features.
 
     For each anchor, we get the hardest positive and hardest negative to form a triplet.
@@ -50,11 +50,13 @@ class TripletLoss(Loss):
         margin: margin for triplet loss
         squared: Boolean. If true, output is the pairwise squared euclidean distance matrix.
                  If false, output is the pairwise euclidean distance matrix.
+        device: device for the masks. Defaults to the device of labels.
     
     Returns:
         triplet_loss: scalar tensor containing the triplet loss
         
     """
+    device = labels.device if device is None else device
     # Get the pairwise distance matrix
     pairwise_dist = self._pairwise_distances(features, squared=squared)
 
@@ -87,7 +87,7 @@ class ReidModel(nn.Module):
                         nn.init.constant_(m.bias, 0.0)
     
     def partial_load(self,weights_path):
-        params = torch.load(weights_path)
+        params = torch.load(weights_path, map_location="cpu")  # copy_ moves each tensor to wherever the model lives
         for _key in params:
             if _key not in self.state_dict().keys() or params[_key].shape != self.state_dict()[_key].shape: 
                 continue
@@ -44,7 +44,7 @@ class ReIDOptimizerBuilder:
             learning_rate = self.base_lr * self.lr_bias
             weight_decay = self.weight_decay * self.weight_bias
         else:
-            learning_rate = self.base_lr * self.gpus
+            learning_rate = self.base_lr * max(self.gpus, 1)
             weight_decay = self.weight_decay
         params += [{"params": [value], "lr":learning_rate, "weight_decay": weight_decay}]
     optimizer = __import__('torch.optim', fromlist=['optim'])
@@ -0,0 +1,43 @@
+# Pack a dataset into one memmap, for DATASET.PACKED_FOLDER, or into tar shards, for DATASET.SHARDED_FOLDER
+import logging
+import kaptan
+import click
+
+@click.command()
+@click.argument('config')
+@click.option('--format', 'pack_format', default="memmap", help="Pack format: [memmap/sharded]")
+@click.option('--output', default="", help="Pack directory. Defaults to DATASET.PACKED_FOLDER, or DATASET.SHARDED_FOLDER for sharded")
+@click.option('--workers', default=4, help="Processes decoding images in parallel. memmap only")
+@click.option('--shard-mb', default=100, help="Approximate shard size in MB. sharded only")
+def main(config, pack_format, output, workers, shard_mb):
+    cfg = kaptan.Kaptan(handler='yaml')
+    config = cfg.import_config(config)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+    logger = logging.getLogger(__name__)
+
+    if pack_format not in ["memmap", "sharded"]:
+        raise NotImplementedError("Pack format must be one of ['memmap', 'sharded']. Got %s"%pack_format)
+    output_key = "DATASET.PACKED_FOLDER" if pack_format == "memmap" else "DATASET.SHARDED_FOLDER"
+    output = output if output != "" else config.get(output_key, None)
+    if output is None:
+        raise ValueError("Provide --output, or %s in the configuration"%output_key)
+
+    data_crawler_ = config.get("EXECUTION.CRAWLER", "VeRiDataCrawler")
+    data_crawler = __import__("crawlers."+data_crawler_, fromlist=[data_crawler_])
+    data_crawler = getattr(data_crawler, data_crawler_)
+    logger.info("Crawling data folder %s"%config.get("DATASET.ROOT_DATA_FOLDER"))
+    crawler = data_crawler(data_folder = config.get("DATASET.ROOT_DATA_FOLDER"), train_folder=config.get("DATASET.TRAIN_FOLDER"), test_folder = config.get("DATASET.TEST_FOLDER"), query_folder=config.get("DATASET.QUERY_FOLDER"), **{"logger":logger, "manifest":config.get("DATASET.CRAWL_MANIFEST", False)})
+
+    if pack_format == "memmap":
+        from generators.PackedDataSet import pack
+        track_dict = crawler.metadata["track"]["dict"] if "track" in crawler.metadata else None
+        pack(crawler.metadata, output, config.get("DATASET.SHAPE"), track_dict=track_dict, workers=workers, draft=config.get("DATASET.DRAFT_DECODE", False), logger=logger)
+    else:
+        # shards keep the original image files, and only the training split is streamed
+        from generators.ShardedDataSet import write_shards
+        write_shards(crawler.metadata, output, "train", shard_bytes=shard_mb * 2**20, logger=logger)
+
+
+if __name__ == "__main__":
+    main()
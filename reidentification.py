@@ -4,18 +4,23 @@ import kaptan
 import click
 import utils
 import torch, torchsummary
+from utils.torch_utils import resolve_device, configure_threads
+from utils.distributed import init_distributed, is_main_process, barrier
 
 @click.command()
 @click.argument('config')
 @click.option('--mode', default="train", help="Execution mode: [train/test]")
 @click.option('--weights', default="", help="Path to weights if mode is test")
-def main(config, mode, weights):
+@click.option('--local_rank', default=-1, type=int, help="Set by torch.distributed.launch in multi-process runs")
+def main(config, mode, weights, local_rank):
     cfg = kaptan.Kaptan(handler='yaml')
     config = cfg.import_config(config)
     
     MODEL_SAVE_NAME, MODEL_SAVE_FOLDER, LOGGER_SAVE_NAME, CHECKPOINT_DIRECTORY = utils.generate_save_names(config)
     os.makedirs(MODEL_SAVE_FOLDER, exist_ok=True)
-    logger = utils.generate_logger(MODEL_SAVE_FOLDER, LOGGER_SAVE_NAME)
+    # multi-process training, if launched with torch.distributed.launch and EXECUTION.DISTRIBUTED_BACKEND is set. Only rank 0 logs and saves
+    RANK, WORLD_SIZE, LOCAL_RANK = init_distributed(config.get("EXECUTION.DISTRIBUTED_BACKEND", None), local_rank)
+    logger = utils.generate_logger(MODEL_SAVE_FOLDER, LOGGER_SAVE_NAME, rank=RANK)
 
     logger.info("*"*40);logger.info("");logger.info("")
     logger.info("Using the following configuration:")
@@ -23,7 +28,7 @@ def main(config, mode, weights):
     logger.info("");logger.info("");logger.info("*"*40)
 
     NORMALIZATION_MEAN, NORMALIZATION_STD, RANDOM_ERASE_VALUE = utils.fix_generator_arguments(config)
-    TRAINDATA_KWARGS = {"rea_value": config.get("TRANSFORMATION.RANDOM_ERASE_VALUE")}
+    TRAINDATA_KWARGS = {"rea_value": config.get("TRANSFORMATION.RANDOM_ERASE_VALUE"), "batch_augmentation": config.get("TRANSFORMATION.BATCH_AUGMENTATION", None), "draft_decode": config.get("DATASET.DRAFT_DECODE", False)}
 
     """ MODEL PARAMS """
     from utils import model_weights
@@ -33,9 +38,10 @@ def main(config, mode, weights):
         if mode == "train":
             if os.path.exists(model_weights[config.get("MODEL.MODEL_BASE")][1]):
                 pass
-            else:
+            elif is_main_process():    # other ranks wait for rank 0's download
                 logger.info("Model weights file {} does not exist. Downloading.".format(model_weights[config.get("MODEL.MODEL_BASE")][1]))
                 utils.web.download(model_weights[config.get("MODEL.MODEL_BASE")][1], model_weights[config.get("MODEL.MODEL_BASE")][0])
+            barrier()
             MODEL_WEIGHTS = model_weights[config.get("MODEL.MODEL_BASE")][1]
     else:
         raise NotImplementedError("Model %s is not available. Please choose one of the following: %s"%(config.get("MODEL.MODEL_BASE"), str(model_weights.keys())))
@@ -50,10 +56,21 @@ def main(config, mode, weights):
     else:
         backup_logger = None
 
-    NUM_GPUS = torch.cuda.device_count()
+    DEVICE = resolve_device(config.get("EXECUTION.DEVICE", None))
+    INTRA_OP_THREADS, INTER_OP_THREADS = configure_threads(config.get("EXECUTION.INTRA_OP_THREADS", None), config.get("EXECUTION.INTER_OP_THREADS", None), device=DEVICE, processes=WORLD_SIZE)
+    if WORLD_SIZE > 1 and DEVICE.type == "cuda":
+        DEVICE = torch.device("cuda", LOCAL_RANK)   # one GPU per process
+        torch.cuda.set_device(DEVICE)
+    NUM_GPUS = torch.cuda.device_count() if DEVICE.type == "cuda" else 0
+    if WORLD_SIZE > 1:
+        NUM_GPUS = min(NUM_GPUS, 1)
     if NUM_GPUS > 1:
-        raise RuntimeError("Not built for multi-GPU. Please start with single-GPU.")
+        raise RuntimeError("Multi-GPU runs need one process per GPU. Launch with torch.distributed.launch and set EXECUTION.DISTRIBUTED_BACKEND.")
     logger.info("Found %i GPUs"%NUM_GPUS)
+    if WORLD_SIZE > 1:
+        logger.info("Training with {} processes over {}. Batches are per process, and learning rates are scaled by {}".format(WORLD_SIZE, config.get("EXECUTION.DISTRIBUTED_BACKEND"), WORLD_SIZE))
+    LR_SCALE = NUM_GPUS if WORLD_SIZE == 1 else WORLD_SIZE
+    logger.info("Running on {} with {} intra-op and {} inter-op threads".format(DEVICE, INTRA_OP_THREADS, INTER_OP_THREADS))
 
     # --------------------- BUILD GENERATORS ------------------------
     data_crawler_ = config.get("EXECUTION.CRAWLER", "VeRiDataCrawler")
@@ -61,13 +78,23 @@ def main(config, mode, weights):
     data_crawler = getattr(data_crawler, data_crawler_)
 
     from generators import SequencedGenerator
+    # persistent loader workers, one pool per generator or one for both
+    WORKER_POOL = config.get("TRANSFORMATION.WORKER_POOL", None) or None
+    if WORKER_POOL not in [None, "persistent", "shared"]:
+        raise NotImplementedError("TRANSFORMATION.WORKER_POOL must be one of ['', 'persistent', 'shared']. Got %s"%WORKER_POOL)
+    train_pool, test_pool = None, None
+    if WORKER_POOL is not None:
+        from generators import WorkerPool
+        train_pool = WorkerPool(config.get("TRANSFORMATION.WORKERS"))
+        test_pool = train_pool if WORKER_POOL == "shared" else WorkerPool(config.get("TRANSFORMATION.WORKERS"))
+        logger.info("Loading batches with %s pools of %i persistent workers"%(WORKER_POOL, train_pool.workers))
     logger.info("Crawling data folder %s"%config.get("DATASET.ROOT_DATA_FOLDER"))
-    crawler = data_crawler(data_folder = config.get("DATASET.ROOT_DATA_FOLDER"), train_folder=config.get("DATASET.TRAIN_FOLDER"), test_folder = config.get("DATASET.TEST_FOLDER"), query_folder=config.get("DATASET.QUERY_FOLDER"), **{"logger":logger})
+    crawler = data_crawler(data_folder = config.get("DATASET.ROOT_DATA_FOLDER"), train_folder=config.get("DATASET.TRAIN_FOLDER"), test_folder = config.get("DATASET.TEST_FOLDER"), query_folder=config.get("DATASET.QUERY_FOLDER"), **{"logger":logger, "manifest":config.get("DATASET.CRAWL_MANIFEST", False), "test_lists":config.get("DATASET.TEST_LISTS", None)})
     train_generator = SequencedGenerator(gpus=NUM_GPUS, i_shape=config.get("DATASET.SHAPE"), \
                                 normalization_mean=NORMALIZATION_MEAN, normalization_std=NORMALIZATION_STD, normalization_scale=1./config.get("TRANSFORMATION.NORMALIZATION_SCALE"), \
                                 h_flip = config.get("TRANSFORMATION.H_FLIP"), t_crop=config.get("TRANSFORMATION.T_CROP"), rea=config.get("TRANSFORMATION.RANDOM_ERASE"), 
                                 **TRAINDATA_KWARGS)
-    train_generator.setup(crawler, mode='train',batch_size=config.get("TRANSFORMATION.BATCH_SIZE"), instance = config.get("TRANSFORMATION.INSTANCES"), workers = config.get("TRANSFORMATION.WORKERS"))
+    train_generator.setup(crawler, mode='train',batch_size=config.get("TRANSFORMATION.BATCH_SIZE"), instance = config.get("TRANSFORMATION.INSTANCES"), workers = config.get("TRANSFORMATION.WORKERS"), cache_bytes = config.get("DATASET.IMAGE_CACHE_BYTES", 0), packed_folder = config.get("DATASET.PACKED_FOLDER", None), sharded_folder = config.get("DATASET.SHARDED_FOLDER", None), shuffle_buffer = config.get("DATASET.SHUFFLE_BUFFER", 10000), sampler_seed = config.get("TRANSFORMATION.SAMPLER_SEED", None), pin_memory = DEVICE.type == "cuda", worker_pool = train_pool, rank = RANK, world_size = WORLD_SIZE)
     logger.info("Generated training data generator")
     TRAIN_CLASSES = config.get("MODEL.SOFTMAX_DIM", train_generator.num_entities)
     test_generator=  SequencedGenerator(    gpus=NUM_GPUS, 
@@ -77,12 +104,18 @@ def main(config, mode, weights):
                                             normalization_scale = 1./config.get("TRANSFORMATION.NORMALIZATION_SCALE"),
                                             h_flip = 0, 
                                             t_crop = False, 
-                                            rea = False)
+                                            rea = False,
+                                            draft_decode = config.get("DATASET.DRAFT_DECODE", False))
     test_generator.setup(   crawler, 
                             mode='test', 
                             batch_size=config.get("TRANSFORMATION.BATCH_SIZE"), 
                             instance=config.get("TRANSFORMATION.INSTANCES"), 
-                            workers=config.get("TRANSFORMATION.WORKERS"))
+                            workers=config.get("TRANSFORMATION.WORKERS"),
+                            cache_bytes=config.get("DATASET.IMAGE_CACHE_BYTES", 0),
+                            packed_folder=config.get("DATASET.PACKED_FOLDER", None),
+                            pin_memory=DEVICE.type == "cuda",
+                            worker_pool=test_pool,
+                            eval_cache=config.get("EVALUATION.INPUT_CACHE", None) or None)
     QUERY_CLASSES = test_generator.num_entities
     logger.info("Generated validation data/query generator")
 
@@ -106,16 +139,16 @@ def main(config, mode, weights):
     logger.info("Finished instantiating model with {} architecture".format(config.get("MODEL.MODEL_ARCH")))
 
     if mode == "test":
-        reid_model.load_state_dict(torch.load(weights))
-        reid_model.cuda()
+        reid_model.load_state_dict(torch.load(weights, map_location=DEVICE))
+        reid_model.to(DEVICE)
         reid_model.eval()
     else:
         if weights != "":   # Load weights if train and starting from a another model base...
             logger.info("Commencing partial model load from {}".format(weights))
             reid_model.partial_load(weights)
             logger.info("Completed partial model load from {}".format(weights))
-        reid_model.cuda()
-        logger.info(torchsummary.summary(reid_model, input_size=(3, *config.get("DATASET.SHAPE"))))
+        reid_model.to(DEVICE)
+        logger.info(torchsummary.summary(reid_model, input_size=(3, *config.get("DATASET.SHAPE")), device=DEVICE.type))
     # --------------------- INSTANTIATE LOSS ------------------------
     from loss import ReIDLossBuilder
     loss_function = ReIDLossBuilder(loss_functions=config.get("LOSS.LOSSES"), loss_lambda=config.get("LOSS.LOSS_LAMBDAS"), loss_kwargs=config.get("LOSS.LOSS_KWARGS"), **{"logger":logger})
@@ -128,7 +161,7 @@ def main(config, mode, weights):
                                 lr_bias = config.get("LOSS_OPTIMIZER.LR_BIAS_FACTOR", config.get("OPTIMIZER.LR_BIAS_FACTOR")), 
                                 weight_decay= config.get("LOSS_OPTIMIZER.WEIGHT_DECAY", config.get("OPTIMIZER.WEIGHT_DECAY")), 
                                 weight_bias= config.get("LOSS_OPTIMIZER.WEIGHT_BIAS_FACTOR", config.get("OPTIMIZER.WEIGHT_BIAS_FACTOR")), 
-                                gpus=NUM_GPUS)
+                                gpus=LR_SCALE)
     loss_optimizer = LOSS_OPT.build(loss_builder=loss_function,
                                     name=config.get("LOSS_OPTIMIZER.OPTIMIZER_NAME", config.get("OPTIMIZER.OPTIMIZER_NAME")),
                                     **json.loads(config.get("LOSS_OPTIMIZER.OPTIMIZER_KWARGS", config.get("OPTIMIZER.OPTIMIZER_KWARGS"))))
@@ -138,7 +171,7 @@ def main(config, mode, weights):
     optimizer_builder = getattr(optimizer_builder, config.get("EXECUTION.OPTIMIZER_BUILDER", "OptimizerBuilder"))
     logger.info("Loaded {} from {} to build Optimizer model".format(config.get("EXECUTION.OPTIMIZER_BUILDER", "OptimizerBuilder"), "optimizer"))
 
-    OPT = optimizer_builder(base_lr=config.get("OPTIMIZER.BASE_LR"), lr_bias = config.get("OPTIMIZER.LR_BIAS_FACTOR"), weight_decay=config.get("OPTIMIZER.WEIGHT_DECAY"), weight_bias=config.get("OPTIMIZER.WEIGHT_BIAS_FACTOR"), gpus=NUM_GPUS)
+    OPT = optimizer_builder(base_lr=config.get("OPTIMIZER.BASE_LR"), lr_bias = config.get("OPTIMIZER.LR_BIAS_FACTOR"), weight_decay=config.get("OPTIMIZER.WEIGHT_DECAY"), weight_bias=config.get("OPTIMIZER.WEIGHT_BIAS_FACTOR"), gpus=LR_SCALE)
     optimizer = OPT.build(reid_model, config.get("OPTIMIZER.OPTIMIZER_NAME"), **json.loads(config.get("OPTIMIZER.OPTIMIZER_KWARGS")))
     logger.info("Built optimizer")
     # --------------------- INSTANTIATE SCHEDULER ------------------------
@@ -186,12 +219,27 @@ def main(config, mode, weights):
     trainer = getattr(trainer, config.get("EXECUTION.TRAINER","SimpleTrainer"))
     logger.info("Loaded {} from {} to build Trainer".format(config.get("EXECUTION.TRAINER","SimpleTrainer"), "trainer"))
 
-    loss_stepper = trainer(model=reid_model, loss_fn = loss_function, optimizer = optimizer, loss_optimizer = loss_optimizer, scheduler = scheduler, loss_scheduler = loss_scheduler, train_loader = train_generator.dataloader, test_loader = test_generator.dataloader, queries = QUERY_CLASSES, epochs = config.get("EXECUTION.EPOCHS"), logger = logger, crawler=crawler)
-    loss_stepper.setup(step_verbose = config.get("LOGGING.STEP_VERBOSE"), save_frequency=config.get("SAVE.SAVE_FREQUENCY"), test_frequency = config.get("EXECUTION.TEST_FREQUENCY"), save_directory = MODEL_SAVE_FOLDER, save_backup = DRIVE_BACKUP, backup_directory = CHECKPOINT_DIRECTORY, gpus=NUM_GPUS,fp16 = config.get("OPTIMIZER.FP16"), model_save_name = MODEL_SAVE_NAME, logger_file = LOGGER_SAVE_NAME)
+    # prefetch training batches onto the device in the background. Batch augmentation then runs in the prefetch thread too
+    PREFETCH_BATCHES = config.get("TRANSFORMATION.PREFETCH_BATCHES", 2)
+    train_loader, batch_augmentation = train_generator.dataloader, train_generator.batch_augmentation
+    if PREFETCH_BATCHES > 0:
+        from generators import DeviceLoader
+        train_loader, batch_augmentation = DeviceLoader(train_loader, DEVICE, prefetch=PREFETCH_BATCHES, transform=batch_augmentation), None
+        logger.info("Prefetching {} training batches onto {}".format(PREFETCH_BATCHES, DEVICE))
+
+    loss_stepper = trainer(model=reid_model, loss_fn = loss_function, optimizer = optimizer, loss_optimizer = loss_optimizer, scheduler = scheduler, loss_scheduler = loss_scheduler, train_loader = train_loader, test_loader = test_generator.dataloader, queries = QUERY_CLASSES, epochs = config.get("EXECUTION.EPOCHS"), logger = logger, crawler=crawler, \
+                            gallery_tile_size=config.get("EVALUATION.GALLERY_TILE_SIZE", None), track_pooling=config.get("EVALUATION.TRACK_POOLING", "min"), \
+                            ranking=config.get("EVALUATION.RANKING", "full"), exact_map=config.get("EVALUATION.EXACT_MAP", True), \
+                            eval_metrics=config.get("EVALUATION.METRICS", None), \
+                            embedding_store=config.get("EVALUATION.EMBEDDING_STORE", None), embedding_store_dtype=config.get("EVALUATION.EMBEDDING_STORE_DTYPE", "float32"), \
+                            embedding_format=config.get("EVALUATION.EMBEDDING_FORMAT", "float32"), quantization_report=config.get("EVALUATION.QUANTIZATION_REPORT", False), \
+                            eval_seed=config.get("EVALUATION.SEED", 0), gallery_repeats=config.get("EVALUATION.GALLERY_REPEATS", 10), \
+                            distributed_eval=config.get("EVALUATION.DISTRIBUTED", True), batch_augmentation=batch_augmentation)
+    loss_stepper.setup(step_verbose = config.get("LOGGING.STEP_VERBOSE"), save_frequency=config.get("SAVE.SAVE_FREQUENCY"), test_frequency = config.get("EXECUTION.TEST_FREQUENCY"), save_directory = MODEL_SAVE_FOLDER, save_backup = DRIVE_BACKUP, backup_directory = CHECKPOINT_DIRECTORY, gpus=NUM_GPUS,fp16 = config.get("OPTIMIZER.FP16"), model_save_name = MODEL_SAVE_NAME, logger_file = LOGGER_SAVE_NAME, device = DEVICE, find_unused_parameters = config.get("EXECUTION.FIND_UNUSED_PARAMETERS", True))
     if mode == 'train':
       loss_stepper.train(continue_epoch=previous_stop)
     elif mode == 'test':
-      loss_stepper.evaluate()
+      loss_stepper.run_evaluation()
     else:
       raise NotImplementedError()
     
@@ -2,6 +2,8 @@ import torch
 import os
 import shutil
 import loss.builders
+from utils.torch_utils import resolve_device
+from utils.distributed import get_rank, get_world_size, is_main_process, barrier, broadcast_module, all_reduce_gradients
 
 class BaseTrainer:
 
@@ -33,7 +35,7 @@ class BaseTrainer:
 
     def setup(self, step_verbose = 5, save_frequency = 5, test_frequency = 5, \
                 save_directory = './checkpoint/', save_backup = False, backup_directory = None, gpus=1,\
-                fp16 = False, model_save_name = None, logger_file = None):
+                fp16 = False, model_save_name = None, logger_file = None, device = None, find_unused_parameters = True):
         self.step_verbose = step_verbose
         self.save_frequency = save_frequency
         self.test_frequency = test_frequency
@@ -49,16 +51,30 @@ class BaseTrainer:
 
         self.gpus = gpus
 
-        if self.gpus != 1:
+        if self.gpus > 1:
             raise NotImplementedError()
         
-        self.model.cuda()
+        self.device = resolve_device(device)  # cuda if available, else cpu, unless set
+        self.model.to(self.device)
+        self.loss_fn.to(self.device)
         
         self.fp16 = fp16
-        if self.fp16 and self.apex is not None:
+        if self.fp16 and self.apex is not None and self.device.type == "cuda":
             self.model, self.optimizer = self.apex.amp.initialize(self.model, self.optimizer, opt_level='O1')
 
+        # multi-process training (see utils.distributed). Training steps run the model through DistributedDataParallel, which averages
+        # gradients across ranks during backward. self.model stays the plain model, for evaluation and checkpoints
+        self.rank, self.world_size = get_rank(), get_world_size()
+        self.train_model = self.model
+        if self.world_size > 1:
+            self.train_model = torch.nn.parallel.DistributedDataParallel(self.model, device_ids=[self.device.index] if self.device.type == "cuda" else None, \
+                                                                            find_unused_parameters=find_unused_parameters)
+            broadcast_module(self.loss_fn)  # learned proxies and centers start the same everywhere
+            self.logger.info("Training on rank {} of {} processes".format(self.rank, self.world_size))
+
     def save(self):
+        if not is_main_process():   # every rank holds the same weights
+            return
         self.logger.info("Saving model, optimizer, and scheduler.")
         MODEL_SAVE = self.model_save_name + '_epoch%i'%self.global_epoch + '.pth'
         OPTIM_SAVE = self.model_save_name + '_epoch%i'%self.global_epoch + '_optimizer.pth'
@@ -66,6 +82,7 @@ class BaseTrainer:
         LOSS_SAVE = self.model_save_name + "_epoch%i"%self.global_epoch + "_loss.pth"
         LOSS_OPTIMIZER_SAVE = self.model_save_name + "_epoch%i"%self.global_epoch + "_loss_optimizer.pth"
         LOSS_SCHEDULER_SAVE = self.model_save_name + "_epoch%i"%self.global_epoch + "_loss_scheduler.pth"
+        SAMPLER_SAVE = self.model_save_name + "_epoch%i"%self.global_epoch + "_sampler.pth"
 
         torch.save(self.model.state_dict(), os.path.join(self.save_directory, MODEL_SAVE))
         torch.save(self.optimizer.state_dict(), os.path.join(self.save_directory, OPTIM_SAVE))
@@ -76,6 +93,8 @@ class BaseTrainer:
             torch.save(self.loss_optimizer.state_dict(), os.path.join(self.save_directory, LOSS_OPTIMIZER_SAVE))
         if self.loss_scheduler is not None: # For loss funtions with empty parameters
             torch.save(self.loss_scheduler.state_dict(), os.path.join(self.save_directory, LOSS_SCHEDULER_SAVE))
+        if self.train_sampler() is not None: # seeded samplers, so a resumed run sees the same epochs
+            torch.save(self.train_sampler().state_dict(), os.path.join(self.save_directory, SAMPLER_SAVE))
 
         if self.save_backup:
             shutil.copy2(os.path.join(self.save_directory, MODEL_SAVE), self.backup_directory)
@@ -86,6 +105,8 @@ class BaseTrainer:
                 shutil.copy2(os.path.join(self.save_directory, LOSS_OPTIMIZER_SAVE), self.backup_directory)
             if self.loss_scheduler is not None: # For loss funtions with empty parameters
                 shutil.copy2(os.path.join(self.save_directory, LOSS_SCHEDULER_SAVE), self.backup_directory)
+            if self.train_sampler() is not None:
+                shutil.copy2(os.path.join(self.save_directory, SAMPLER_SAVE), self.backup_directory)
             self.logger.info("Performing drive backup of model, optimizer, and scheduler.")
             
             LOGGER_SAVE = os.path.join(self.backup_directory, self.logger_file)
@@ -101,6 +122,7 @@ class BaseTrainer:
         loss_load = self.model_save_name + "_epoch%i"%load_epoch + "_loss.pth"
         loss_optimizer_load = self.model_save_name + "_epoch%i"%load_epoch + "_loss_optimizer.pth"
         loss_scheduler_load = self.model_save_name + "_epoch%i"%load_epoch + "_loss_scheduler.pth"
+        sampler_load = self.model_save_name + "_epoch%i"%load_epoch + "_sampler.pth"
 
         if self.save_backup:
             self.logger.info("Loading model, optimizer, and scheduler from drive backup.")
@@ -110,6 +132,7 @@ class BaseTrainer:
             loss_load_path = os.path.join(self.backup_directory, loss_load)
             loss_optimizer_load_path = os.path.join(self.backup_directory, loss_optimizer_load)
             loss_scheduler_load_path = os.path.join(self.backup_directory, loss_scheduler_load)
+            sampler_load_path = os.path.join(self.backup_directory, sampler_load)
         else:
             self.logger.info("Loading model, optimizer, and scheduler from local backup.")
             model_load_path = os.path.join(self.save_directory, model_load)
@@ -118,26 +141,61 @@ class BaseTrainer:
             loss_load_path = os.path.join(self.save_directory, loss_load)
             loss_optimizer_load_path = os.path.join(self.save_directory, loss_optimizer_load)
             loss_scheduler_load_path = os.path.join(self.save_directory, loss_scheduler_load)
+            sampler_load_path = os.path.join(self.save_directory, sampler_load)
 
-        self.model.load_state_dict(torch.load(model_load_path))
+        self.model.load_state_dict(torch.load(model_load_path, map_location=self.device))
         self.logger.info("Finished loading model state_dict from %s"%model_load_path)
-        self.optimizer.load_state_dict(torch.load(optim_load_path))
+        self.optimizer.load_state_dict(torch.load(optim_load_path, map_location=self.device))
         self.logger.info("Finished loading optimizer state_dict from %s"%optim_load_path)
-        self.scheduler.load_state_dict(torch.load(scheduler_load_path))
+        self.scheduler.load_state_dict(torch.load(scheduler_load_path, map_location=self.device))
         self.logger.info("Finished loading scheduler state_dict from %s"%scheduler_load_path)
-        self.loss_fn.load_state_dict(torch.load(loss_load_path))
+        loss_state = torch.load(loss_load_path, map_location=self.device)
+        missing = [key for key in self.loss_fn.state_dict() if key not in loss_state]
+        if missing:
+            # checkpoints from before ProxyNCA proxies were registered parameters have no proxies, nor a loss optimizer
+            self.logger.warning("Loss state_dict in %s lacks %s. These start from their initial values"%(loss_load_path, ", ".join(missing)))
+        self.loss_fn.load_state_dict(loss_state, strict=not missing)
         self.logger.info("Finished loading loss state_dict from %s"%loss_load_path)
 
-        if self.loss_optimizer is not None: # For loss funtions with empty parameters
-            self.loss_optimizer.load_state_dict(torch.load(loss_optimizer_load_path))
+        if self.loss_optimizer is not None and not os.path.exists(loss_optimizer_load_path):
+            self.logger.warning("No loss optimizer state at %s. The loss optimizer starts fresh"%loss_optimizer_load_path)
+        elif self.loss_optimizer is not None: # For loss funtions with empty parameters
+            self.loss_optimizer.load_state_dict(torch.load(loss_optimizer_load_path, map_location=self.device))
             self.logger.info("Finished loading loss optimizer state_dict from %s"%loss_optimizer_load_path)
         else:
             self.logger.info("No need to load loss optimizer. Empty parameter list")
-        if self.loss_scheduler is not None: # For loss funtions with empty parameters
-            self.loss_scheduler.load_state_dict(torch.load(loss_scheduler_load_path))
+        if self.loss_scheduler is not None and not os.path.exists(loss_scheduler_load_path):
+            self.logger.warning("No loss scheduler state at %s. The loss scheduler starts fresh"%loss_scheduler_load_path)
+        elif self.loss_scheduler is not None: # For loss funtions with empty parameters
+            self.loss_scheduler.load_state_dict(torch.load(loss_scheduler_load_path, map_location=self.device))
             self.logger.info("Finished loading loss scheduler state_dict from %s"%loss_scheduler_load_path)
         else:
             self.logger.info("No need to load loss scheduler. Empty parameter list")
+        if self.train_sampler() is not None and os.path.exists(sampler_load_path):   # older checkpoints have no sampler state
+            self.train_sampler().load_state_dict(torch.load(sampler_load_path))
+            self.logger.info("Finished loading sampler state from %s"%sampler_load_path)
+
+    def loader_wait(self):
+        """ Log suffix with the mean time the last 100 steps waited for their batch, if the training loader tracks it (generators.DeviceLoader) """
+        if not hasattr(self.train_loader, "wait_time"):
+            return ""
+        return "\tLoader wait: {:.1f}ms/step".format(1000 * self.train_loader.wait_time(last=100))
+
+    def sync_loss_gradients(self):
+        """ Average the gradients of the loss parameters (ProxyNCA proxies, CenterLoss centers) across ranks, before the loss optimizer steps. The model's are averaged by DistributedDataParallel. """
+        if self.world_size > 1 and self.loss_optimizer is not None:
+            all_reduce_gradients(self.loss_fn.parameters())
+
+    def run_evaluation(self, *args, **kwargs):
+        """ Evaluate. In multi-process training, only rank 0 evaluates, and the other ranks wait for it. """
+        results = self.evaluate(*args, **kwargs) if is_main_process() else None
+        barrier()
+        return results
+
+    def train_sampler(self):
+        """ The training loader's sampler, if it has state to checkpoint (e.g. PKSampler), else None """
+        sampler = getattr(self.train_loader, "sampler", None)
+        return sampler if hasattr(sampler, "state_dict") else None
         
 
     def train(self):
@@ -147,4 +205,4 @@ class BaseTrainer:
         raise NotImplementedError()
 
     def initial_evaluate(self):
-        self.evaluate()
\ No newline at end of file
+        self.run_evaluation()
\ No newline at end of file
@@ -6,6 +6,7 @@ import numpy as np
 import utils.math
 import loss.builders
 from .BaseTrainer import BaseTrainer
+from utils.distributed import is_main_process
 
 class CarzamTrainer(BaseTrainer):
     try:
@@ -25,6 +26,7 @@ class CarzamTrainer(BaseTrainer):
 
         self.queries = queries
         self.test_mode = test_mode
+        self.batch_augmentation = kwargs.get("batch_augmentation", None)   # applied to uint8 training batches on the device, see SequencedGenerator
         self.loss = []
 
     # setup inherited from BaseTrainer
@@ -37,15 +39,18 @@ class CarzamTrainer(BaseTrainer):
         batch_kwargs = {}
         batch_kwargs["epoch"] = self.global_epoch
         img, batch_kwargs["labels"] = batch
-        img, batch_kwargs["labels"] = img.cuda(), batch_kwargs["labels"].cuda()
+        img, batch_kwargs["labels"] = img.to(self.device), batch_kwargs["labels"].to(self.device)
+        if self.batch_augmentation is not None:
+            img = self.batch_augmentation(img)
         # logits, features, labels
-        batch_kwargs["logits"], batch_kwargs["features"] = self.model(img)
+        batch_kwargs["logits"], batch_kwargs["features"] = self.train_model(img)
         loss = self.loss_fn(**batch_kwargs)
         if self.fp16 and self.apex is not None:
             with self.apex.amp.scale_loss(loss, self.optimizer) as scaled_loss:
                 scaled_loss.backward()
         else:
             loss.backward()
+        self.sync_loss_gradients()
         self.optimizer.step()
         if self.loss_optimizer is not None: # In case loss functions have no differentiable parameters
             self.loss_optimizer.step()
@@ -68,7 +73,7 @@ class CarzamTrainer(BaseTrainer):
             self.load(load_epoch)
 
         self.logger.info("Performing initial evaluation...")
-        self.evaluate(suffix="Pretest")
+        self.run_evaluation(suffix="Pretest")
 
         for epoch in range(self.epochs):
             if epoch >= continue_epoch:
@@ -80,14 +85,14 @@ class CarzamTrainer(BaseTrainer):
                     self.global_batch += 1
                     if (self.global_batch + 1) % self.step_verbose == 0:
                         loss_avg = sum(self.loss[-100:]) / float(len(self.loss[-100:]))
-                        self.logger.info('Epoch{0}.{1}\tTotal Loss: {2:.3f}'.format(self.global_epoch, self.global_batch, loss_avg))
+                        self.logger.info('Epoch{0}.{1}\tTotal Loss: {2:.3f}{3}'.format(self.global_epoch, self.global_batch, loss_avg, self.loader_wait()))
                 self.global_batch = 0
                 self.scheduler.step()
                 if self.loss_scheduler is not None:
                     self.loss_scheduler.step()
                 self.logger.info('{0} Completed epoch {1} {2}'.format('*'*10, self.global_epoch, '*'*10))
                 if self.global_epoch % self.test_frequency == 0:
-                    self.evaluate()
+                    self.run_evaluation()
                 if self.global_epoch % self.save_frequency == 0:
                     self.save()
                 self.global_epoch += 1
@@ -95,6 +100,8 @@ class CarzamTrainer(BaseTrainer):
                 self.global_epoch = epoch+1
 
     def save(self):
+        if not is_main_process():   # every rank holds the same weights
+            return
         self.logger.info("Saving model, optimizer, and scheduler.")
         MODEL_SAVE = self.model_save_name + '_epoch%i'%self.global_epoch + '.pth'
         OPTIM_SAVE = self.model_save_name + '_epoch%i'%self.global_epoch + '_optimizer.pth'
@@ -180,7 +187,7 @@ class CarzamTrainer(BaseTrainer):
             for batch in tqdm.tqdm(self.test_loader, total=len(self.test_loader), leave=False):
 
                 data, pid = batch
-                data = data.cuda()
+                data = data.to(self.device)
                 
                 feature = self.model(data).detach().cpu()
                 features.append(feature)
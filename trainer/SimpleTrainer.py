@@ -1,12 +1,13 @@
 import tqdm
-from collections import defaultdict, OrderedDict
-from sklearn.metrics import average_precision_score
+from collections import OrderedDict
 import shutil
 import os
 import torch
 import numpy as np
-from scipy.spatial.distance import cdist
 import loss.builders
+from utils.evaluation import evaluate_ranking, single_gallery_shot_cmc, euclidean_distances, BlockwiseSearch, KReciprocalReranker, track_distances, track_centroids, ArtifactGraph
+from utils.evaluation import EmbeddingStore, checkpoint_hash, dataset_fingerprint, cosine_distances, QuantizedEmbeddings, quantization_report, RankingMetrics
+from utils.distributed import is_main_process, barrier, shard_range, all_gather_tensors, all_gather_strings, all_reduce_metrics
 
 from .BaseTrainer import BaseTrainer
 
@@ -34,6 +35,19 @@ class SimpleTrainer(BaseTrainer):
         self.softaccuracy = []
 
         self.crawler = kwargs.get("crawler", None)
+        self.metric_chunk_size = kwargs.get("metric_chunk_size", 128)   # queries sorted at once during metric computation
+        self.gallery_tile_size = kwargs.get("gallery_tile_size", None)   # if set, evaluate streams the gallery in tiles of this size
+        self.track_pooling = kwargs.get("track_pooling", "min")   # one of min, mean, centroid
+        self.ranking = kwargs.get("ranking", "full")   # full argsort, or topk argpartition
+        self.exact_map = kwargs.get("exact_map", True)   # with topk ranking, rank deep enough for exact mAP instead of mAP@K
+        self.eval_metrics = kwargs.get("eval_metrics", None) or list(self.EVAL_METRICS.keys())   # metrics reported by evaluate
+        self.embedding_store = kwargs.get("embedding_store", None)   # directory of the on-disk feature store. None to always extract in memory
+        self.embedding_store_dtype = kwargs.get("embedding_store_dtype", "float32")
+        self.embedding_format = kwargs.get("embedding_format", "float32")   # gallery format for query-to-gallery distances: float32, float16, or int8
+        self.quantization_report = kwargs.get("quantization_report", False)   # log mAP of each embedding format against float32
+        self.eval_seed = kwargs.get("eval_seed", 0)   # seed for randomized metrics (single gallery shot CMC). None for a random seed
+        self.batch_augmentation = kwargs.get("batch_augmentation", None)   # applied to uint8 training batches on the device, see SequencedGenerator
+        self.distributed_eval = kwargs.get("distributed_eval", True)   # in multi-process runs, every rank extracts and ranks a share of the test set
 
     # setup inherited from BaseTrainer
     def step(self,batch):
@@ -43,9 +57,11 @@ class SimpleTrainer(BaseTrainer):
             self.loss_optimizer.zero_grad()
         batch_kwargs = {}
         img, batch_kwargs["labels"] = batch
-        img, batch_kwargs["labels"] = img.cuda(), batch_kwargs["labels"].cuda()
+        img, batch_kwargs["labels"] = img.to(self.device), batch_kwargs["labels"].to(self.device)
+        if self.batch_augmentation is not None:
+            img = self.batch_augmentation(img)
         # logits, features, labels
-        batch_kwargs["logits"], batch_kwargs["features"] = self.model(img)
+        batch_kwargs["logits"], batch_kwargs["features"] = self.train_model(img)
         batch_kwargs["epoch"] = self.global_epoch   # For CompactContrastiveLoss
         loss = self.loss_fn(**batch_kwargs)
         if self.fp16 and self.apex is not None:
@@ -53,6 +69,7 @@ class SimpleTrainer(BaseTrainer):
                 scaled_loss.backward()
         else:
             loss.backward()
+        self.sync_loss_gradients()
         self.optimizer.step()
         if self.loss_optimizer is not None: # In case loss object doesn;t have any parameters, this will be None. See optimizers.StandardLossOptimizer
             self.loss_optimizer.step()
@@ -96,14 +113,16 @@ class SimpleTrainer(BaseTrainer):
                     if (self.global_batch + 1) % self.step_verbose == 0:
                         loss_avg = sum(self.loss[-100:]) / float(len(self.loss[-100:]))
                         soft_avg = sum(self.softaccuracy[-100:]) / float(len(self.softaccuracy[-100:]))
-                        self.logger.info('Epoch{0}.{1}\tTotal Loss: {2:.3f} Softmax: {3:.3f}'.format(self.global_epoch, self.global_batch, loss_avg, soft_avg))
+                        self.logger.info('Epoch{0}.{1}\tTotal Loss: {2:.3f} Softmax: {3:.3f}{4}'.format(self.global_epoch, self.global_batch, loss_avg, soft_avg, self.loader_wait()))
+                if hasattr(self.train_loader, "wait_time"):
+                    self.logger.info('Epoch {0} waited {1:.1f}ms per step for training batches'.format(self.global_epoch, 1000 * self.train_loader.wait_time()))
                 self.global_batch = 0
                 self.scheduler.step()
                 if self.loss_scheduler is not None:
                     self.loss_scheduler.step()
                 self.logger.info('{0} Completed epoch {1} {2}'.format('*'*10, self.global_epoch, '*'*10))
                 if self.global_epoch % self.test_frequency == 0:
-                    self.evaluate()
+                    self.run_evaluation()
                 if self.global_epoch % self.save_frequency == 0:
                     self.save()
                 self.global_epoch += 1
@@ -113,7 +132,7 @@ class SimpleTrainer(BaseTrainer):
 
     # https://github.com/Jakel21/vehicle-ReID-baseline/blob/master/vehiclereid/eval_metrics.py
     def eval_vid(self,distmat, q_pids, g_pids, q_camids, g_camids, max_rank):
-        """Evaluation with veri metric
+        """Evaluation with veri metric. Only gallery samples with pid -1 are discarded.
         """
         num_q, num_g = distmat.shape
 
@@ -121,62 +140,25 @@ class SimpleTrainer(BaseTrainer):
             max_rank = num_g
             print('Note: number of gallery samples is quite small, got {}'.format(num_g))
 
-        indices = np.argsort(distmat, axis=1)
-        matches = (g_pids[indices] == q_pids[:, np.newaxis]).astype(np.int32)
-
-        # compute cmc curve for each query
-        all_cmc = []
-        all_AP = []
-        num_valid_q = 0.  # number of valid query
-    
-        for q_idx in range(num_q):
-            # get query pid and camid
-            q_pid = q_pids[q_idx]
-            q_camid = q_camids[q_idx]
-
-            # remove gallery samples that have the same pid and camid with query
-            order = indices[q_idx]
-            #remove = (g_pids[order] == q_pid) & (g_camids[order] == q_camid)
-            remove = (g_pids[order] == -1)
-            keep = np.invert(remove)
-
-            # compute cmc curve
-            raw_cmc = matches[q_idx][keep]  # binary vector, positions with value 1 are correct matches
-            if not np.any(raw_cmc):
-                # this condition is true when query identity does not appear in gallery
-                continue
-
-            cmc = raw_cmc.cumsum()
-            cmc[cmc > 1] = 1
-
-            all_cmc.append(cmc[:max_rank])
-            num_valid_q += 1.
-
-            # compute average precision
-            # reference: https://en.wikipedia.org/wiki/Evaluation_measures_(information_retrieval)#Average_precision
-            num_rel = raw_cmc.sum()
-            tmp_cmc = raw_cmc.cumsum()
-            tmp_cmc = [x / (i + 1.) for i, x in enumerate(tmp_cmc)]
-            tmp_cmc = np.asarray(tmp_cmc) * raw_cmc
-            AP = tmp_cmc.sum() / num_rel
-            all_AP.append(AP)
-
-        assert num_valid_q > 0, 'Error: all query identities do not appear in gallery'
-
-        all_cmc = np.asarray(all_cmc).astype(np.float32)
-        all_cmc = all_cmc.sum(0) / num_valid_q
-        mAP = np.mean(all_AP)
+        results = evaluate_ranking(distmat, q_pids, g_pids, q_camids, g_camids, topk=max_rank, junk="invalid_id", **self.ranking_kwargs())
+        return results["cmc"].astype(np.float32), results["mAP"]
 
-        return all_cmc, mAP
 
-
-    def evaluate(self):
+    def extract_features(self, start=0, stop=None):
+        """ Features, pids, cids, and image paths of the test set (queries first), for entries `start` to `stop` (the end if None). """
         self.model.eval()
         features, pids, cids, imgs = [], [], [], []
+        loader = self.test_loader
+        stop = len(loader.dataset) if stop is None else stop
+        if (start, stop) != (0, len(loader.dataset)) and hasattr(loader, "with_indices"):
+            loader = loader.with_indices(range(start, stop))   # PooledLoader, on the same workers
+        elif (start, stop) != (0, len(loader.dataset)):
+            loader = torch.utils.data.DataLoader(torch.utils.data.Subset(loader.dataset, range(start, stop)), batch_size=loader.batch_size, \
+                                                    shuffle=False, num_workers=loader.num_workers, collate_fn=loader.collate_fn)
         with torch.no_grad():
-            for batch in tqdm.tqdm(self.test_loader, total=len(self.test_loader), leave=False):
+            for batch in tqdm.tqdm(loader, total=len(loader), leave=False, disable=not is_main_process()):
                 data, pid, camid, img = batch
-                data = data.cuda()
+                data = data.to(self.device)
                 feature = self.model(data).detach().cpu()
                 features.append(feature)
                 pids.append(pid)
@@ -184,122 +166,190 @@ class SimpleTrainer(BaseTrainer):
                 imgs+=list(img)
         
         # For market 1501
+        if not features:    # an empty shard. all_gather_tensors takes the feature width from the other ranks
+            return torch.zeros(0, 0), torch.zeros(0, dtype=torch.int64), torch.zeros(0, dtype=torch.int64), imgs
         features, pids, cids = torch.cat(features, dim=0), torch.cat(pids, dim=0), torch.cat(cids, dim=0)
+        return features, pids, cids, imgs
+
+    def sharded_evaluation(self):
+        """ Whether evaluation is split across the ranks of a multi-process run """
+        return self.distributed_eval and getattr(self, "world_size", 1) > 1
+
+    def run_evaluation(self, *args, **kwargs):
+        """ Evaluate. With sharded evaluation every rank takes part, else only rank 0 does. See BaseTrainer.run_evaluation. """
+        if not self.sharded_evaluation():
+            return super(SimpleTrainer, self).run_evaluation(*args, **kwargs)
+        results = self.evaluate(*args, **kwargs)
+        barrier()
+        return results
+
+    def evaluation_features(self):
+        """ Features, pids, cids, and image paths of the whole test set, as extract_features returns them.
+
+        With sharded evaluation, each rank extracts a contiguous share of the test set, and the shares are all-gathered. With an embedding store, rank 0 brings the store up to date, and every rank then reads it.
         """
-        if self.crawler is not None:
-            track_features = [[] for _ in range(len(self.crawler.metadata["track"]["crawl"]))]
-            #track_features = [torch.zeros(features[0].shape) for _ in range(len(self.crawler.metadata["track"]["crawl"]))]
-            track_pids = [0]*len(self.crawler.metadata["track"]["crawl"])
-            track_cids = [0]*len(self.crawler.metadata["track"]["crawl"])
-            track_count = [0]*len(self.crawler.metadata["track"]["crawl"])
-            #pdb.set_trace()
-            #count = 0
-            for idx, img in enumerate(imgs[self.queries:]):  # use only gallery features, no query features
-                track_idx = self.crawler.metadata["track"]["dict"][img]
-                track_count[track_idx]+=1
-                track_pid = self.crawler.metadata["track"]["info"][track_idx]["pid"]
-                track_cid = self.crawler.metadata["track"]["info"][track_idx]["cid"]
-                track_features[track_idx].append(features[idx])
-                track_pids[track_idx] = track_pid
-                track_cids[track_idx] = track_cid
-            
-            #for idx,feats in enumerate(track_features): # Get average of features
-            #    track_features[idx] = feats / track_count[idx]  # maybe max...?
-
-            #track_features, track_pids, track_cids = torch.stack(track_features), torch.Tensor(track_pids).int(), torch.Tensor(track_cids).int()
-        else:
-            track_features, track_pids, track_cids = None, None, None
-        """
-        feature_to_track_map = {}
-        if "track" in self.crawler.metadata:
-            track_pids = [0]*len(self.crawler.metadata["track"]["crawl"])
-            track_cids = [0]*len(self.crawler.metadata["track"]["crawl"])
-            for idx, img in enumerate(imgs[self.queries:]):  # use only gallery features, no query features
-                track_idx = self.crawler.metadata["track"]["dict"][img]
-                feature_to_track_map[idx] = track_idx
-                track_pids[track_idx] = self.crawler.metadata["track"]["info"][track_idx]["pid"]
-                track_cids[track_idx] = self.crawler.metadata["track"]["info"][track_idx]["cid"]
-            track_pids, track_cids = torch.Tensor(track_pids).int(), torch.Tensor(track_cids).int()
-
-        query_features, gallery_features = features[:self.queries], features[self.queries:]
-        query_pid, gallery_pid = pids[:self.queries], pids[self.queries:]
-        query_cid, gallery_cid = cids[:self.queries], cids[self.queries:]
+        if self.embedding_store is not None:
+            if self.sharded_evaluation() and not is_main_process():
+                barrier()   # wait for rank 0 to update the store, then read it
+                return self.stored_features()
+            features = self.stored_features()
+            if self.sharded_evaluation():
+                barrier()
+            return features
+        if not self.sharded_evaluation():
+            return self.extract_features()
+        start, stop = shard_range(len(self.test_loader.dataset))
+        features, pids, cids, imgs = self.extract_features(start, stop)
+        return all_gather_tensors(features), all_gather_tensors(pids), all_gather_tensors(cids), all_gather_strings(imgs)
+
+    # metric name -> (artifact, key in its results, log label)
+    EVAL_METRICS = OrderedDict([
+        ("track_map", ("track_ranking", "mAP", "VeRi-mAP")),
+        ("track_cmc", ("track_ranking", "cmc", "VeRi CMC")),
+        ("map", ("ranking", "mAP", "mAP")),
+        ("minp", ("ranking", "mINP", "mINP")),
+        ("cmc", ("ranking", "cmc", "Market-1501 CMC")),
+        ("cuhk_cmc", ("single_shot_ranking", "cmc", "CUHK CMC")),
+        ("rerank_map", ("rerank_ranking", "mAP", "Re-rank mAP")),
+        ("rerank_cmc", ("rerank_ranking", "cmc", "ReRank CMC")),
+    ])
+    SHARDED_ARTIFACTS = ["ranking", "track_ranking"]   # split by query across ranks in sharded evaluation. The others are computed by rank 0.
 
-        
-        self.logger.info('Obtained features')
-        #distmat = self.cosine_query_to_gallery_distances(query_features, gallery_features)
-        distmat = self.query_to_gallery_distances(query_features, gallery_features) # query-to-gallery
-        self.logger.info('Got query-to-gallery distances')
-        if "track" in self.crawler.metadata:
-            track_distmat = self.build_track_distmat(distmat, feature_to_track_map)
-            self.logger.info('Got query-to-track distances')
-        qqdistmat = self.query_to_gallery_distances(query_features, query_features)
-        self.logger.info('Got query-to-query distances')
-        ggdistmat = self.query_to_gallery_distances(gallery_features, gallery_features)
-        self.logger.info('Got gallery-to-gallery distances')
-
-        rerank_distmat = self.rerank(distmat, qqdistmat, ggdistmat)
-        self.logger.info('Got rerank distances')
-
-        #distmat=  distmat.numpy()
-        self.logger.info('Validation in progress')
-        #m_cmc, mAP, _ = self.eval_func(distmat, query_pid.numpy(), gallery_pid.numpy(), query_cid.numpy(), gallery_cid.numpy(), 50)
-        m_cmc = self.cmc(distmat, query_ids=query_pid.numpy(), gallery_ids=gallery_pid.numpy(), query_cams=query_cid.numpy(), gallery_cams=gallery_cid.numpy(), topk=100, separate_camera_set=False, single_gallery_shot=False, first_match_break=True)
-        self.logger.info('Completed market-1501 CMC')
-        #c_cmc = self.cmc(distmat, query_ids=query_pid.numpy(), gallery_ids=gallery_pid.numpy(), query_cams=query_cid.numpy(), gallery_cams=gallery_cid.numpy(), topk=100, separate_camera_set=True, single_gallery_shot=True, first_match_break=False)
-        #self.logger.info('Completed CUHK CMC')
-        r_cmc = self.cmc(rerank_distmat, query_ids=query_pid.numpy(), gallery_ids=gallery_pid.numpy(), query_cams=query_cid.numpy(), gallery_cams=gallery_cid.numpy(), topk=100, separate_camera_set=False, single_gallery_shot=False, first_match_break=True)
-        self.logger.info('Completed Re-Rank')
-        
-        if "track" in self.crawler.metadata:
-            v_cmc = self.cmc(track_distmat, query_ids=query_pid.numpy(), gallery_ids=track_pids.numpy(), query_cams=query_cid.numpy(), gallery_cams=track_cids.numpy(), topk=100, separate_camera_set=False, single_gallery_shot=False, first_match_break=True)
-            v_mAP = self.mean_ap(track_distmat, query_ids=query_pid.numpy(), gallery_ids=track_pids.numpy(), query_cams=query_cid.numpy(), gallery_cams=track_cids.numpy())
-            self.logger.info('Completed VeRi-776 CMC')
+    def evaluate(self):
+        """ Compute the metrics in self.eval_metrics. Only the artifacts (distance matrices, rankings) those metrics need are built, each once.
 
+        With sharded evaluation, every rank must call evaluate: the ranks extract the test set and rank the queries together, and all of them return the SHARDED_ARTIFACTS metrics. The other metrics are returned by rank 0 only.
 
-        # Reranking
-        
-        mAP = self.mean_ap(distmat, query_ids=query_pid.numpy(), gallery_ids=gallery_pid.numpy(), query_cams=query_cid.numpy(), gallery_cams=gallery_cid.numpy())
-        r_mAP = self.mean_ap(rerank_distmat, query_ids=query_pid.numpy(), gallery_ids=gallery_pid.numpy(), query_cams=query_cid.numpy(), gallery_cams=gallery_cid.numpy())
+        Returns:
+            dict: Metric name -> value. CMC metrics are the full curve.
+        """
+        for metric in self.eval_metrics:
+            if metric not in self.EVAL_METRICS:
+                raise NotImplementedError("Evaluation metric must be one of %s. Got %s"%(str(list(self.EVAL_METRICS.keys())), metric))
+        artifacts = self.evaluation_artifacts()
+        results = {}
+        self.logger.info('Validation in progress')
+        artifacts["all_features"]   # extraction is collective, so every rank takes part, whichever metrics it computes
+        for metric in self.EVAL_METRICS:  # fixed order, so the log reads the same regardless of how metrics are listed
+            if metric not in self.eval_metrics:
+                continue
+            artifact, key, label = self.EVAL_METRICS[metric]
+            if self.sharded_evaluation() and not is_main_process() and artifact not in self.SHARDED_ARTIFACTS:
+                continue    # computed whole, by rank 0
+            if artifact.startswith("track") and (self.crawler is None or "track" not in self.crawler.metadata):
+                self.logger.info('Skipping {}: dataset has no track metadata'.format(metric))
+                continue
+            if artifact != "ranking" and self.gallery_tile_size is not None:
+                self.logger.info('Skipping {}: not available in blockwise mode'.format(metric))
+                continue
+            results[metric] = artifacts[artifact][key]
+            if key == "cmc":
+                for r in [1,2, 3, 4, 5]:
+                    self.logger.info('{} Rank-{}: {:.2%}'.format(label, r, results[metric][r-1]))
+            else:
+                self.logger.info('{}: {:.2%}'.format(label, results[metric]))
+        if self.quantization_report and is_main_process():
+            results["quantization_report"] = artifacts["quantization_report"]
+            for fmt, row in results["quantization_report"].items():
+                self.logger.info('{} gallery ({:.1f} MB): mAP {:.2%} (delta {:+.2%}), Rank-1 {:.2%}'.format(fmt, row["bytes"] / 2.**20, row["mAP"], row["mAP_delta"], row["rank1"]))
+        return results
+
+    def evaluation_artifacts(self):
+        """ Lazy graph of everything evaluate can compute. See utils.evaluation.ArtifactGraph. """
+        sharded = self.sharded_evaluation()
+        graph = ArtifactGraph(logger=self.logger)
+        graph.register("all_features", lambda g: self.split_features(*self.evaluation_features()))
+        # with sharded evaluation, "features" holds this rank's queries against the whole gallery, and "all_features" every query
+        graph.register("features", lambda g: self.shard_queries(g["all_features"]) if sharded else g["all_features"])
+        graph.register("gallery_embeddings", lambda g: QuantizedEmbeddings.quantize(g["features"]["gallery_features"], self.embedding_format) if self.embedding_format != "float32" else g["features"]["gallery_features"])
+        graph.register("distmat", lambda g: self.query_to_gallery_distances(g["features"]["query_features"], g["gallery_embeddings"]))
+        graph.register("all_distmat", lambda g: self.query_to_gallery_distances(g["all_features"]["query_features"], g["gallery_embeddings"]) if sharded else g["distmat"])
+        graph.register("ranking", lambda g: self.blockwise_ranking(g["features"], g["gallery_embeddings"], sharded=sharded) if self.gallery_tile_size is not None else self.ranking_results(g["distmat"], g["features"], sharded=sharded))
+        graph.register("single_shot_ranking", lambda g: {"cmc": self.cmc(g["all_distmat"], query_ids=g["all_features"]["query_pid"], gallery_ids=g["all_features"]["gallery_pid"], query_cams=g["all_features"]["query_cid"], \
+                                                                        gallery_cams=g["all_features"]["gallery_cid"], topk=100, separate_camera_set=True, single_gallery_shot=True, first_match_break=False)})
+        graph.register("quantization_report", lambda g: quantization_report(g["all_features"]["query_features"], g["all_features"]["gallery_features"], g["all_features"]["query_pid"], g["all_features"]["gallery_pid"], \
+                                                                            g["all_features"]["query_cid"], g["all_features"]["gallery_cid"], distance_fn=self.query_to_gallery_distances, topk=100, **self.ranking_kwargs()))
+        # re-ranking works from features, so no query-query or gallery-gallery matrix is built
+        graph.register("rerank_distmat", lambda g: self.rerank_features(g["all_features"]["query_features"], g["all_features"]["gallery_features"]))
+        graph.register("rerank_ranking", lambda g: self.ranking_results(g["rerank_distmat"], g["all_features"]))
+        graph.register("track_index", lambda g: self.build_track_index(g["features"]["gallery_imgs"]))
+        graph.register("track_distmat", self.track_distmat_artifact)
+        graph.register("track_ranking", lambda g: self.ranking_results(g["track_distmat"], g["features"], gallery_ids=g["track_index"][1].numpy(), gallery_cams=g["track_index"][2].numpy(), sharded=sharded))
+        return graph
+
+    def stored_features(self):
+        """ Features from the embedding store, extracting (and appending) only the entries it is missing. The store is rebuilt if it came from another checkpoint or dataset. """
+        dataset = self.test_loader.dataset.dataset    # (path, pid, cid) of queries, then gallery
+        store = EmbeddingStore(self.embedding_store, dtype=self.embedding_store_dtype)
+        model_hash = checkpoint_hash(self.model)
+        if store.count > len(dataset) or not store.matches(model_hash, dataset_fingerprint(dataset[:store.count])):
+            self.logger.info('Embedding store at {} is empty or stale. Rebuilding it'.format(self.embedding_store))
+            store.reset(model_hash, num_queries=self.queries, dtype=self.embedding_store_dtype)
+        if store.count < len(dataset):
+            self.logger.info('Extracting {} features missing from the embedding store'.format(len(dataset) - store.count))
+            features, pids, cids, imgs = self.extract_features(start=store.count)
+            track_dict = self.crawler.metadata["track"]["dict"] if self.crawler is not None and "track" in self.crawler.metadata else {}
+            store.append(features.numpy(), pids.numpy(), cids.numpy(), imgs, tracks=[track_dict.get(img, -1) for img in imgs])
+        else:
+            self.logger.info('Loaded {} features from the embedding store at {}'.format(store.count, self.embedding_store))
+        return torch.from_numpy(np.array(store.features, dtype=np.float32)), torch.from_numpy(store.pids), torch.from_numpy(store.cids), store.paths
+
+    def split_features(self, features, pids, cids, imgs):
+        return {
+            "query_features": features[:self.queries], "gallery_features": features[self.queries:],
+            "query_pid": pids[:self.queries].numpy(), "gallery_pid": pids[self.queries:].numpy(),
+            "query_cid": cids[:self.queries].numpy(), "gallery_cid": cids[self.queries:].numpy(),
+            "gallery_imgs": imgs[self.queries:],    # use only gallery features for tracks, no query features
+        }
+
+    def shard_queries(self, features):
+        """ split_features output, with only this rank's share of the queries """
+        start, stop = shard_range(len(features["query_pid"]))
+        shard = dict(features)
+        for key in ["query_features", "query_pid", "query_cid"]:
+            shard[key] = features[key][start:stop]
+        return shard
+
+    def ranking_results(self, distmat, features, gallery_ids=None, gallery_cams=None, sharded=False):
+        """ CMC, mAP, and mINP from one ranking of distmat against the gallery (or against other gallery_ids/gallery_cams, e.g. tracks)
+
+        With sharded, distmat holds this rank's queries only, and the metrics are reduced over all ranks' queries.
+        """
+        gallery_ids = features["gallery_pid"] if gallery_ids is None else gallery_ids
+        gallery_cams = features["gallery_cid"] if gallery_cams is None else gallery_cams
+        if not sharded:
+            return evaluate_ranking(distmat, features["query_pid"], gallery_ids, features["query_cid"], gallery_cams, topk=100, tie_aware=True, **self.ranking_kwargs())
+        metrics = RankingMetrics(topk=100, tie_aware=True, **self.ranking_kwargs())
+        metrics.update(distmat, features["query_pid"], gallery_ids, features["query_cid"], gallery_cams)
+        return all_reduce_metrics(metrics).compute()
+
+    def track_distmat_artifact(self, graph):
+        feature_to_track_map, track_pids, _ = graph["track_index"]
+        if self.track_pooling == "centroid":
+            return self.centroid_track_distmat(graph["features"]["query_features"], graph["features"]["gallery_features"], feature_to_track_map, len(track_pids))
+        return self.build_track_distmat(graph["distmat"], feature_to_track_map, pooling=self.track_pooling, num_tracks=len(track_pids))
+
+    def blockwise_ranking(self, features, gallery_embeddings, sharded=False):
+        """ Plain mAP/CMC/mINP with BlockwiseSearch. The query-to-gallery distance matrix is never materialized. With sharded, the metrics are reduced over all ranks' queries. """
+        self.logger.info('Blockwise search over {} gallery features in tiles of {}'.format(len(gallery_embeddings), self.gallery_tile_size))
+        searcher = BlockwiseSearch(topk=100, gallery_tile_size=self.gallery_tile_size, distance_fn=self.query_to_gallery_distances)
+        _, _, metrics = searcher.search(features["query_features"], gallery_embeddings, features["query_pid"], features["gallery_pid"], features["query_cid"], features["gallery_cid"])
+        return (all_reduce_metrics(metrics) if sharded else metrics).compute()
 
-        self.logger.info('Completed mAP Calculation')
-        
-        if "track" in self.crawler.metadata:
-            self.logger.info('VeRi-mAP: {:.2%}'.format(v_mAP))
-            for r in [1,2, 3, 4, 5]:
-                self.logger.info('VeRi CMC Rank-{}: {:.2%}'.format(r, v_cmc[r-1]))
-
-        self.logger.info('mAP: {:.2%}'.format(mAP))
-        #self.logger.info('VID_mAP: {:.2%}'.format(v_mAP))
-        for r in [1,2, 3, 4, 5]:
-            self.logger.info('Market-1501 CMC Rank-{}: {:.2%}'.format(r, m_cmc[r-1]))
-        self.logger.info('Re-rank mAP: {:.2%}'.format(r_mAP))
-        for r in [1,2, 3, 4, 5]:
-            self.logger.info('ReRank CMC Rank-{}: {:.2%}'.format(r, r_cmc[r-1]))
-        #for r in [1,2, 3, 4, 5,10,15,20]:
-        #    self.logger.info('CUHK CMC Rank-{}: {:.2%}'.format(r, c_cmc[r-1]))
-        
-  
     def query_to_gallery_distances(self, qf, gf):
         # distancesis sqrt(sum((a-b)^2))
         # so a^2 + b^2 - 2ab
-        a2b2 = torch.pow(qf, 2).sum(1, keepdim=True).expand(qf.size(0), gf.size(0))
-        a2b2 = a2b2 + torch.pow(gf, 2).sum(1, keepdim=True).expand(gf.size(0), qf.size(0)).t()
-        eu= torch.addmm(1,a2b2, -2, qf, gf.t())
-        eu = eu.clamp(min=1e-12).sqrt()
-        return eu
+        return euclidean_distances(qf, gf)
 
     def cosine_query_to_gallery_distances(self, qf, gf):
-        # distancesis sqrt(sum((a-b)^2))
-        # so a^2 + b^2 - 2ab
-        return cdist(qf, gf, metric='cosine')
+        # 1 - cosine similarity, in float32
+        return cosine_distances(qf, gf)
 
 
 
     # https://github.com/Cysu/open-reid/blob/master/reid/evaluation_metrics/ranking.py
     def mean_ap(self,distmat, query_ids=None, gallery_ids=None,
             query_cams=None, gallery_cams=None):
-        distmat = distmat
         m, n = distmat.shape
         if query_ids is None:
             query_ids = np.arange(m)
@@ -309,26 +359,11 @@ class SimpleTrainer(BaseTrainer):
             query_cams = np.zeros(m).astype(np.int32)
         if gallery_cams is None:
             gallery_cams = np.ones(n).astype(np.int32)
-        query_ids = np.asarray(query_ids)
-        gallery_ids = np.asarray(gallery_ids)
-        query_cams = np.asarray(query_cams)
-        gallery_cams = np.asarray(gallery_cams)
-        # Sort and find correct matches
-        indices = np.argsort(distmat, axis=1)
-        matches = (gallery_ids[indices] == query_ids[:, np.newaxis])
-        # Compute AP for each query
-        aps = []
-        for i in range(m):
-            # Filter out the same id and same camera
-            valid = ((gallery_ids[indices[i]] != query_ids[i]) |
-                    (gallery_cams[indices[i]] != query_cams[i]))
-            y_true = matches[i, valid]
-            y_score = -distmat[i][indices[i]][valid]
-            if not np.any(y_true): continue
-            aps.append(average_precision_score(y_true, y_score))
-        if len(aps) == 0:
-            raise RuntimeError("No valid query")
-        return np.mean(aps)
+        # tie_aware AP is what sklearn's average_precision_score computes for each query
+        return evaluate_ranking(distmat, query_ids, gallery_ids, query_cams, gallery_cams, topk=100, tie_aware=True, **self.ranking_kwargs())["mAP"]
+
+    def ranking_kwargs(self):
+        return {"chunk_size": self.metric_chunk_size, "ranking": self.ranking, "exact_map": self.exact_map}
 
     # https://github.com/Cysu/open-reid/blob/master/reid/evaluation_metrics/ranking.py
     def cmc(self,distmat, query_ids=None, gallery_ids=None,
@@ -336,55 +371,11 @@ class SimpleTrainer(BaseTrainer):
         separate_camera_set=False,
         single_gallery_shot=False,
         first_match_break=False):
-        m, n = distmat.shape
-        # Sort and find correct matches
-        indices = np.argsort(distmat, axis=1)
-        matches = (gallery_ids[indices] == query_ids[:, np.newaxis])
-        # Compute CMC for each query
-        ret = np.zeros(topk)
-        num_valid_queries = 0
-        for i in range(m):
-            # Filter out the same id and same camera
-            valid = ((gallery_ids[indices[i]] != query_ids[i]) |
-                    (gallery_cams[indices[i]] != query_cams[i]))
-            if separate_camera_set:
-                # Filter out samples from same camera
-                valid &= (gallery_cams[indices[i]] != query_cams[i])
-            if not np.any(matches[i, valid]): continue
-            if single_gallery_shot:
-                repeat = 10
-                gids = gallery_ids[indices[i][valid]]
-                inds = np.where(valid)[0]
-                ids_dict = defaultdict(list)
-                for j, x in zip(inds, gids):
-                    ids_dict[x].append(j)
-            else:
-                repeat = 1
-            for _ in range(repeat):
-                if single_gallery_shot:
-                    # Randomly choose one instance for each id
-                    sampled = (valid & self._unique_sample(ids_dict, len(valid)))
-                    index = np.nonzero(matches[i, sampled])[0]
-                else:
-                    index = np.nonzero(matches[i, valid])[0]
-                delta = 1. / (len(index) * repeat)
-                for j, k in enumerate(index):
-                    if k - j >= topk: break
-                    if first_match_break:
-                        ret[k - j] += 1
-                        break
-                    ret[k - j] += delta
-            num_valid_queries += 1
-        if num_valid_queries == 0:
-            raise RuntimeError("No valid query")
-        return ret.cumsum() / num_valid_queries
-
-    def _unique_sample(self,ids_dict, num):
-        mask = np.zeros(num, dtype=np.bool)
-        for _, indices in ids_dict.items():
-            i = np.random.choice(indices)
-            mask[i] = True
-        return mask
+        if not single_gallery_shot:
+            return evaluate_ranking(distmat, query_ids, gallery_ids, query_cams, gallery_cams, topk=topk, 
+                                    separate_camera_set=separate_camera_set, first_match_break=first_match_break, **self.ranking_kwargs())["cmc"]
+        return single_gallery_shot_cmc(distmat, query_ids, gallery_ids, query_cams, gallery_cams, topk=topk, separate_camera_set=separate_camera_set, 
+                                        first_match_break=first_match_break, seed=self.eval_seed, chunk_size=self.metric_chunk_size)
 
 
     def eval_func(self,distmat, q_pids, g_pids, q_camids, g_camids, max_rank=50):
@@ -395,131 +386,37 @@ class SimpleTrainer(BaseTrainer):
         if num_g < max_rank:
             max_rank = num_g
             print("Note: number of gallery samples is quite small, got {}".format(num_g))
-        indices = np.argsort(distmat, axis=1)
-        matches = (g_pids[indices] == q_pids[:, np.newaxis]).astype(np.int32)
-
-        # compute cmc curve for each query
-        all_cmc = []
-        all_AP = []
-        num_valid_q = 0.  # number of valid query
-        for q_idx in range(num_q):
-            # get query pid and camid
-            q_pid = q_pids[q_idx]
-            q_camid = q_camids[q_idx]
-
-            # remove gallery samples that have the same pid and camid with query
-            order = indices[q_idx]
-            remove = (g_pids[order] == q_pid) & (g_camids[order] == q_camid)
-            keep = np.invert(remove)
-
-            # compute cmc curve
-            # binary vector, positions with value 1 are correct matches
-            orig_cmc = matches[q_idx][keep]
-            if not np.any(orig_cmc):
-                # this condition is true when query identity does not appear in gallery
-                continue
-
-            cmc = orig_cmc.cumsum()
-            cmc[cmc > 1] = 1
-
-            all_cmc.append(cmc[:max_rank])
-            num_valid_q += 1.
-
-            # compute average precision
-            # reference: https://en.wikipedia.org/wiki/Evaluation_measures_(information_retrieval)#Average_precision
-            num_rel = orig_cmc.sum()
-            tmp_cmc = orig_cmc.cumsum()
-            tmp_cmc = [x / (i + 1.) for i, x in enumerate(tmp_cmc)]
-            tmp_cmc = np.asarray(tmp_cmc) * orig_cmc
-            AP = tmp_cmc.sum() / num_rel
-            all_AP.append(AP)
-
-        assert num_valid_q > 0, "Error: all query identities do not appear in gallery"
-
-        all_cmc = np.asarray(all_cmc).astype(np.float32)
-        all_cmc = all_cmc.sum(0) / num_valid_q
-        mAP = np.mean(all_AP)
-
-        return all_cmc, mAP, all_AP
 
+        results = evaluate_ranking(distmat, q_pids, g_pids, q_camids, g_camids, topk=max_rank, junk="same_camera", **self.ranking_kwargs())
+        return results["cmc"].astype(np.float32), results["mAP"], list(results["AP"])
 
-    def k_reciprocal_neigh(self,initial_rank, i, k1):
-        forward_k_neigh_index = initial_rank[i,:k1+1]
-        backward_k_neigh_index = initial_rank[forward_k_neigh_index,:k1+1]
-        fi = np.where(backward_k_neigh_index==i)[0]
-        return forward_k_neigh_index[fi]
 
     def rerank(self,q_g_dist, q_q_dist, g_g_dist, k1=20, k2=6, lambda_value=0.3):
-        # The following naming, e.g. gallery_num, is different from outer scope.
-        # Don't care about it.
-        original_dist = np.concatenate(
-        [np.concatenate([q_q_dist, q_g_dist], axis=1),
-        np.concatenate([q_g_dist.T, g_g_dist], axis=1)],
-        axis=0)
-        original_dist = 2. - 2 * original_dist   # change the cosine similarity metric to euclidean similarity metric
-        original_dist = np.power(original_dist, 2).astype(np.float32)
-        original_dist = np.transpose(1. * original_dist/np.max(original_dist,axis = 0))
-        V = np.zeros_like(original_dist).astype(np.float32)
-        #initial_rank = np.argsort(original_dist).astype(np.int32)
-        # top K1+1
-        initial_rank = np.argpartition( original_dist, range(1,k1+1) )
-
-        query_num = q_g_dist.shape[0]
-        all_num = original_dist.shape[0]
-
-        for i in range(all_num):
-            # k-reciprocal neighbors
-            k_reciprocal_index = self.k_reciprocal_neigh( initial_rank, i, k1)
-            k_reciprocal_expansion_index = k_reciprocal_index
-            for j in range(len(k_reciprocal_index)):
-                candidate = k_reciprocal_index[j]
-                candidate_k_reciprocal_index = self.k_reciprocal_neigh( initial_rank, candidate, int(np.around(k1/2)))
-                if len(np.intersect1d(candidate_k_reciprocal_index,k_reciprocal_index))> 2./3*len(candidate_k_reciprocal_index):
-                    k_reciprocal_expansion_index = np.append(k_reciprocal_expansion_index,candidate_k_reciprocal_index)
-
-            k_reciprocal_expansion_index = np.unique(k_reciprocal_expansion_index)
-            weight = np.exp(-original_dist[i,k_reciprocal_expansion_index])
-            V[i,k_reciprocal_expansion_index] = 1.*weight/np.sum(weight)
-
-        original_dist = original_dist[:query_num,]
-        if k2 != 1:
-            V_qe = np.zeros_like(V,dtype=np.float32)
-            for i in range(all_num):
-                V_qe[i,:] = np.mean(V[initial_rank[i,:k2],:],axis=0)
-            V = V_qe
-            del V_qe
-        del initial_rank
-        invIndex = []
-        for i in range(all_num):
-            invIndex.append(np.where(V[:,i] != 0)[0])
-
-        jaccard_dist = np.zeros_like(original_dist,dtype = np.float32)
-
-        for i in range(query_num):
-            temp_min = np.zeros(shape=[1,all_num],dtype=np.float32)
-            indNonZero = np.where(V[i,:] != 0)[0]
-            indImages = []
-            indImages = [invIndex[ind] for ind in indNonZero]
-            for j in range(len(indNonZero)):
-                temp_min[0,indImages[j]] = temp_min[0,indImages[j]]+ np.minimum(V[i,indNonZero[j]],V[indImages[j],indNonZero[j]])
-            jaccard_dist[i] = 1-temp_min/(2.-temp_min)
-
-        final_dist = jaccard_dist*(1-lambda_value) + original_dist*lambda_value
-        del original_dist
-        del V
-        del jaccard_dist
-        final_dist = final_dist[:query_num,query_num:]
-        return final_dist
-
-    def build_track_distmat(self,distmat, feature_to_track_map):
-        # distmat has shape [num_queries, num_gallery]
-        num_tracks = len(set(feature_to_track_map.values()))
-        track_distmat = np.full((distmat.shape[0], num_tracks), np.inf)
-        for q in range(distmat.shape[0]):
-            for g in range(distmat.shape[1]):
-                #q, g are indices
-                dist_val = distmat[q][g]
-                track_idx = feature_to_track_map[g]
-                if dist_val < track_distmat[q][track_idx]:
-                    track_distmat[q][track_idx] = dist_val
-        return track_distmat
\ No newline at end of file
+        return KReciprocalReranker(k1=k1, k2=k2, lambda_value=lambda_value).rerank(q_g_dist, q_q_dist, g_g_dist)
+
+    def rerank_features(self, query_features, gallery_features, k1=20, k2=6, lambda_value=0.3):
+        """ Same as rerank, but distances are computed in blocks from features, so the query-query and gallery-gallery matrices are never built. """
+        return KReciprocalReranker(k1=k1, k2=k2, lambda_value=lambda_value).rerank_features(query_features, gallery_features, distance_fn=self.query_to_gallery_distances)
+
+    def build_track_index(self, gallery_imgs):
+        """ Track index of each gallery image, and the pid/cid of each track. """
+        track_meta = self.crawler.metadata["track"]
+        num_tracks = len(track_meta["crawl"])
+        feature_to_track_map = np.array([track_meta["dict"][img] for img in gallery_imgs], dtype=np.int64)
+        track_pids = torch.Tensor([track_meta["info"][idx]["pid"] for idx in range(num_tracks)]).int()
+        track_cids = torch.Tensor([track_meta["info"][idx]["cid"] for idx in range(num_tracks)]).int()
+        return feature_to_track_map, track_pids, track_cids
+
+    def build_track_distmat(self,distmat, feature_to_track_map, pooling="min", num_tracks=None):
+        # distmat has shape [num_queries, num_gallery]. feature_to_track_map is the track index of each gallery column (array, or dict of column -> track)
+        if isinstance(feature_to_track_map, dict):
+            num_tracks = len(set(feature_to_track_map.values())) if num_tracks is None else num_tracks
+            feature_to_track_map = np.array([feature_to_track_map[g] for g in range(len(feature_to_track_map))], dtype=np.int64)
+        return track_distances(distmat, feature_to_track_map, num_tracks=num_tracks, pooling=pooling)
+
+    def centroid_track_distmat(self, query_features, gallery_features, feature_to_track_map, num_tracks):
+        # distances from each query to the mean feature of each track. Tracks without gallery images are never retrieved
+        centroids = track_centroids(gallery_features, feature_to_track_map, num_tracks)
+        track_distmat = np.asarray(self.query_to_gallery_distances(query_features, centroids)).copy()
+        track_distmat[:, np.bincount(feature_to_track_map, minlength=num_tracks) == 0] = np.inf
+        return track_distmat
@@ -8,6 +8,7 @@ import torch
 from torch import nn
 import numpy as np
 from torch.nn import functional as F
+from utils.torch_utils import resolve_device
 
 #from scipy.spatial.distance import cdist
 
@@ -42,7 +43,7 @@ class VAEGANTrainer:
 
     def setup(self, step_verbose = 5, save_frequency = 5, test_frequency = 5, \
                 save_directory = './checkpoint/', save_backup = False, backup_directory = None, gpus=1,\
-                fp16 = False, model_save_name = None, logger_file = None):
+                fp16 = False, model_save_name = None, logger_file = None, device = None):
         self.step_verbose = step_verbose
         self.save_frequency = save_frequency
         self.test_frequency = test_frequency
@@ -58,10 +59,11 @@ class VAEGANTrainer:
 
         self.gpus = gpus
 
-        if self.gpus != 1:
+        if self.gpus > 1:
             raise NotImplementedError()
         
-        self.model.cuda()
+        self.device = resolve_device(device)  # cuda if available, else cpu, unless set
+        self.model.to(self.device)
         
         self.fp16 = False   # fp16
         if self.fp16 and self.apex is not None:
@@ -72,8 +74,8 @@ class VAEGANTrainer:
         if batch[0].shape[0] < self.batch_size:
             return
         e_loss, de_loss, d_loss, z_loss, ae_loss = 0,0,0,0,0
-        ones = torch.ones(self.batch_size).cuda()
-        zeros = torch.zeros(self.batch_size).cuda()
+        ones = torch.ones(self.batch_size, device=self.device)
+        zeros = torch.zeros(self.batch_size, device=self.device)
         self.model.train()
         
         self.optimizer["Encoder"].zero_grad()
@@ -84,7 +86,7 @@ class VAEGANTrainer:
         
         
         img, labels = batch
-        img = img.cuda()
+        img = img.to(self.device)
         # logits, features, labels
 
         self.model.Encoder.train()
@@ -95,7 +97,7 @@ class VAEGANTrainer:
         self.model.Discriminator.zero_grad()
         real_ = self.model.Discriminator(img).squeeze()
         r_loss = self.loss_fn(real_, ones)
-        varz = torch.autograd.Variable(torch.randn((self.batch_size, self.latent_size)).unsqueeze(-1)).cuda()
+        varz = torch.autograd.Variable(torch.randn((self.batch_size, self.latent_size)).unsqueeze(-1)).to(self.device)
         generated = self.model.Decoder(varz)
         fake_ = self.model.Discriminator(generated).squeeze()
         f_loss = self.loss_fn(fake_, zeros)
@@ -106,7 +108,7 @@ class VAEGANTrainer:
 
 
         self.model.Decoder.zero_grad()
-        varzd = torch.autograd.Variable(torch.randn((self.batch_size, self.latent_size)).unsqueeze(-1)).cuda()
+        varzd = torch.autograd.Variable(torch.randn((self.batch_size, self.latent_size)).unsqueeze(-1)).to(self.device)
         fake_generated = self.model.Decoder(varzd)
         discri_fake = self.model.Discriminator(fake_generated).squeeze()
         df_loss = self.loss_fn(discri_fake, ones)
@@ -116,7 +118,7 @@ class VAEGANTrainer:
 
 
         self.model.LatentDiscriminator.zero_grad()
-        varzl = torch.autograd.Variable(torch.randn((self.batch_size, self.latent_size)).unsqueeze(-1)).cuda()
+        varzl = torch.autograd.Variable(torch.randn((self.batch_size, self.latent_size)).unsqueeze(-1)).to(self.device)
         z_real = self.model.LatentDiscriminator(varzl).squeeze()
         z_real_loss = self.loss_fn(z_real, ones)
         z_fake = self.model.LatentDiscriminator(self.model.Encoder(img).squeeze()).squeeze()
@@ -1,5 +1,7 @@
 from . import SimpleTrainer
-import torch, tqdm
+import torch
+import numpy as np
+from utils.evaluation import random_gallery_draws
 
 class VehicleIDTrainer(SimpleTrainer):
     try:
@@ -8,18 +10,14 @@ class VehicleIDTrainer(SimpleTrainer):
         apex = None
     except:
         apex = None
+    def __init__(self, *args, **kwargs):
+        super(VehicleIDTrainer, self).__init__(*args, **kwargs)
+        self.gallery_repeats = kwargs.get("gallery_repeats", 10)   # random gallery draws per test list, with VehicleIDDataCrawler's test_lists
+
     def evaluate(self):
-        self.model.eval()
-        features, pids, cids = [], [], []
-        with torch.no_grad():
-            for batch in tqdm.tqdm(self.test_loader, total=len(self.test_loader), leave=False):
-                data, pid, camid, img = batch
-                data = data.cuda()
-                feature = self.model(data).detach().cpu()
-                features.append(feature)
-                pids.append(pid)
-                cids.append(camid)
-        features, pids, cids = torch.cat(features, dim=0), torch.cat(pids, dim=0), torch.cat(cids, dim=0)
+        if self.crawler is not None and "protocols" in self.crawler.metadata:
+            return self.evaluate_protocols()
+        features, pids, cids, _ = self.evaluation_features()    # sharded across ranks with sharded evaluation
 
         query_features, gallery_features = features[:self.queries], features[self.queries:]
         query_pid, gallery_pid = pids[:self.queries], pids[self.queries:]
@@ -35,6 +33,29 @@ class VehicleIDTrainer(SimpleTrainer):
         self.logger.info('VID_mAP: {:.2%}'.format(v_mAP))
         for r in [1,2, 3, 4, 5,10,15,20]:
             self.logger.info('VID CMC Rank-{}: {:.2%}'.format(r, v_cmc[r-1]))
+
+    def evaluate_protocols(self):
+        """ Evaluate every test list crawled with VehicleIDDataCrawler's `test_lists` from one feature extraction over their union.
+
+        Each list is evaluated over self.gallery_repeats random draws of its gallery (one image per vehicle, the rest as queries), seeded with self.eval_seed. With sharded evaluation, every rank must call this, and all of them return the results.
+
+        Returns:
+            dict: Test list -> {'mAP', 'mAP_std', 'cmc', 'cmc_std'}, means and standard deviations over the draws
+        """
+        features, pids, _, imgs = self.evaluation_features()
+        row = {img: idx for idx, img in enumerate(imgs)}
+        self.logger.info('Validation in progress')
+        results = {}
+        for test_list, protocol in self.crawler.metadata["protocols"].items():
+            rows = torch.tensor([row[img] for img in protocol.paths], dtype=torch.int64)
+            draws = random_gallery_draws(features[rows], pids[rows].numpy(), self.cosine_query_to_gallery_distances, repeats=self.gallery_repeats, seed=self.eval_seed, \
+                                            topk=min(100, len(np.unique(protocol.pids))), **self.ranking_kwargs())
+            results[test_list] = {"mAP": draws["mAP"].mean(), "mAP_std": draws["mAP"].std(), "cmc": draws["cmc"].mean(axis=0), "cmc_std": draws["cmc"].std(axis=0)}
+            self.logger.info('{} ({} gallery draws) VID_mAP: {:.2%} +/- {:.2%}'.format(test_list, self.gallery_repeats, results[test_list]["mAP"], results[test_list]["mAP_std"]))
+            for r in [1, 5, 10, 20]:
+                if r <= len(results[test_list]["cmc"]):
+                    self.logger.info('{} VID CMC Rank-{}: {:.2%} +/- {:.2%}'.format(test_list, r, results[test_list]["cmc"][r-1], results[test_list]["cmc_std"][r-1]))
+        return results
   
     #def __evaluate(self):
     #    pass
\ No newline at end of file
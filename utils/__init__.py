@@ -23,8 +23,15 @@ def dynamic_import(cfg, module_name, import_name, default=None):
     imported_module = __import__("%s."%module_name+import_name, fromlist=[import_name])
     return  getattr(imported_module, import_name)
 
-def generate_logger(MODEL_SAVE_FOLDER, LOGGER_SAVE_NAME):
+def generate_logger(MODEL_SAVE_FOLDER, LOGGER_SAVE_NAME, rank=0):
     logger = logging.getLogger(MODEL_SAVE_FOLDER)
+    if rank > 0:
+        # in multi-process runs, other ranks only print warnings, and leave the log file to rank 0
+        logger.setLevel(logging.WARNING)
+        cs = logging.StreamHandler()
+        cs.setFormatter(logging.Formatter('%(asctime)s-%(msecs)d [rank {}] %(message)s'.format(rank),datefmt="%H:%M:%S"))
+        logger.addHandler(cs)
+        return logger
     logger.setLevel(logging.DEBUG)
     logger_save_path = os.path.join(MODEL_SAVE_FOLDER, LOGGER_SAVE_NAME)
     fh = logging.FileHandler(logger_save_path)
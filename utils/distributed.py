@@ -0,0 +1,149 @@
+import os
+import numpy as np
+import torch
+import torch.distributed as dist
+
+
+def init_distributed(backend=None, local_rank=None):
+    """ Join the process group of a multi-process run, if this process was started as part of one.
+
+    Processes are started with `python -m torch.distributed.launch --nproc_per_node=N script.py ...` (or torchrun), which sets RANK, WORLD_SIZE, MASTER_ADDR, and MASTER_PORT for each of them, and passes `--local_rank` (or sets LOCAL_RANK).
+
+    Args:
+        backend (str): 'gloo' (CPU or GPU) or 'nccl' (GPU only). None or '' runs a single process, even when launched with several.
+        local_rank (int): Rank of the process on its node, from `--local_rank`. None reads LOCAL_RANK.
+
+    Returns:
+        (int, int, int): Rank, world size, and local rank. (0, 1, 0) outside a multi-process run.
+    """
+    world_size = int(os.environ.get("WORLD_SIZE", 1))
+    if not backend or world_size < 2:
+        return 0, 1, 0
+    local_rank = int(os.environ.get("LOCAL_RANK", 0)) if local_rank is None or local_rank < 0 else local_rank
+    if not dist.is_initialized():
+        dist.init_process_group(backend=backend, init_method="env://")
+    return dist.get_rank(), dist.get_world_size(), local_rank
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized() and dist.get_world_size() > 1
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+def broadcast_module(module, src=0):
+    """ Copy the parameters and buffers of module on rank src to every other rank, in place. For modules not wrapped in DistributedDataParallel, e.g. losses with learned proxies or centers. """
+    if not is_distributed():
+        return
+    with torch.no_grad():
+        for tensor in list(module.parameters()) + list(module.buffers()):
+            dist.broadcast(tensor.data, src)
+
+
+def broadcast_seed(seed, src=0):
+    """ The seed of rank src on every rank, e.g. for samplers that must produce the same order everywhere """
+    if not is_distributed():
+        return seed
+    seed = torch.tensor([seed], dtype=torch.int64, device=_collective_device())
+    dist.broadcast(seed, src)
+    return int(seed.cpu().item())
+
+
+def all_reduce_gradients(parameters):
+    """ Average the gradients of parameters over all ranks, in place, with one all-reduce per device and dtype.
+
+    Parameters without a gradient on this rank count as zero, and get one, so every rank makes the same all-reduce calls.
+    """
+    if not is_distributed():
+        return
+    world_size = float(get_world_size())
+    groups = {}
+    for param in parameters:
+        if not param.requires_grad:
+            continue
+        if param.grad is None:
+            param.grad = torch.zeros_like(param)
+        groups.setdefault((param.grad.device, param.grad.dtype), []).append(param.grad)
+    for _, grads in sorted(groups.items(), key=lambda item: str(item[0])):
+        flat = torch.cat([grad.contiguous().view(-1) for grad in grads])
+        dist.all_reduce(flat)
+        flat /= world_size
+        offset = 0
+        for grad in grads:
+            grad.copy_(flat[offset:offset + grad.numel()].view_as(grad))
+            offset += grad.numel()
+
+
+def shard_range(count, rank=None, world_size=None):
+    """ (start, stop) of this rank's contiguous share of count items. Shares differ in size by at most one, and are in rank order """
+    rank = get_rank() if rank is None else rank
+    world_size = get_world_size() if world_size is None else world_size
+    return count * rank // world_size, count * (rank + 1) // world_size
+
+
+def _collective_device():
+    # nccl only moves CUDA tensors
+    return torch.device("cuda", torch.cuda.current_device()) if dist.get_backend() == "nccl" else torch.device("cpu")
+
+
+def all_gather_tensors(tensor):
+    """ The tensors of every rank, concatenated along dim 0 in rank order. Their sizes along dim 0 may differ.
+
+    All tensors must have the same number of dimensions. A rank with an empty tensor may have any other sizes, e.g. (0, 0) features from an empty shard: the trailing sizes are taken from the first non-empty rank.
+    """
+    if not is_distributed():
+        return tensor
+    device = _collective_device()
+    local = tensor.contiguous().to(device)
+    shapes = [torch.zeros(local.dim(), dtype=torch.int64, device=device) for _ in range(get_world_size())]
+    dist.all_gather(shapes, torch.tensor(local.shape, dtype=torch.int64, device=device))
+    shapes = [[int(size) for size in shape.cpu().tolist()] for shape in shapes]
+    sizes = [shape[0] for shape in shapes]
+    trailing = next((tuple(shape[1:]) for shape in shapes if shape[0] > 0), tuple(local.shape[1:]))
+    padded = torch.zeros((max(max(sizes), 1),) + trailing, dtype=local.dtype, device=device)
+    if local.shape[0] > 0:
+        padded[:local.shape[0]] = local
+    gathered = [torch.zeros_like(padded) for _ in sizes]
+    dist.all_gather(gathered, padded)
+    return torch.cat([part[:size] for part, size in zip(gathered, sizes)]).to(tensor.device)
+
+
+def all_gather_strings(strings):
+    """ The lists of strings of every rank, concatenated in rank order. Strings must not contain newlines, e.g. image paths. """
+    if not is_distributed():
+        return list(strings)
+    encoded = "".join(string + "\n" for string in strings).encode("utf-8")
+    gathered = all_gather_tensors(torch.from_numpy(np.frombuffer(encoded, dtype=np.uint8).copy()))
+    return gathered.numpy().tobytes().decode("utf-8").split("\n")[:-1]
+
+
+def all_reduce_metrics(metrics):
+    """ Combine, in place, the RankingMetrics each rank accumulated over its own queries, so that every rank computes the metrics of all queries.
+
+    CMC counts, AP and INP sums, and valid query counts are summed with one all-reduce. Per-query APs are gathered in rank order.
+    """
+    if not is_distributed():
+        return metrics
+    totals = np.concatenate([metrics.cmc_counts, [metrics.ap_sum, metrics.inp_sum, metrics.num_valid]]).astype(np.float64)
+    totals = torch.from_numpy(totals).to(_collective_device())
+    dist.all_reduce(totals)
+    totals = totals.cpu().numpy()
+    metrics.cmc_counts, metrics.ap_sum, metrics.inp_sum, metrics.num_valid = totals[:-3], float(totals[-3]), float(totals[-2]), int(round(totals[-1]))
+    aps = np.concatenate(metrics.aps) if len(metrics.aps) else np.zeros(0)
+    metrics.aps = [all_gather_tensors(torch.from_numpy(aps.astype(np.float64))).numpy()]
+    return metrics
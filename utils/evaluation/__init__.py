@@ -0,0 +1,8 @@
+from .metrics import RankingMetrics, evaluate_ranking, match_and_valid, single_gallery_shot_cmc, random_gallery_draws
+from .distances import euclidean_distances, cosine_distances
+from .search import BlockwiseSearch
+from .rerank import KReciprocalReranker
+from .tracks import track_distances, track_centroids
+from .artifacts import ArtifactGraph
+from .store import EmbeddingStore, checkpoint_hash, dataset_fingerprint
+from .quantize import QuantizedEmbeddings, quantization_report
@@ -0,0 +1,39 @@
+from collections import OrderedDict
+
+
+class ArtifactGraph:
+    """ Lazily computed, memoized evaluation artifacts.
+
+    Each artifact is registered with a producer function that builds it from the graph, reading whatever other artifacts it depends on with `graph[name]`. Nothing is computed until it is requested, and each artifact is computed at most once, so a metric only pays for the artifacts on its own path.
+
+    Args:
+        logger (logging.Logger): Optional. Logs each artifact as it is built.
+
+    Methods:
+        register(name, producer): Add an artifact. producer is called as producer(graph)
+        graph[name]: Build the artifact (and its dependencies) if needed, and return it
+        computed(): Names of the artifacts built so far, in the order they were built
+    """
+    def __init__(self, logger=None):
+        self.logger = logger
+        self.producers = {}
+        self.values = OrderedDict()
+
+    def register(self, name, producer):
+        self.producers[name] = producer
+        return self
+
+    def __contains__(self, name):
+        return name in self.producers
+
+    def __getitem__(self, name):
+        if name not in self.values:
+            if name not in self.producers:
+                raise KeyError("No producer registered for evaluation artifact %s"%name)
+            self.values[name] = self.producers[name](self)
+            if self.logger is not None:
+                self.logger.info('Built evaluation artifact {}'.format(name))
+        return self.values[name]
+
+    def computed(self):
+        return list(self.values.keys())
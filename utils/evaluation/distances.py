@@ -0,0 +1,41 @@
+import torch
+
+from .quantize import QuantizedEmbeddings
+
+
+def euclidean_distances(qf, gf):
+    """ Euclidean distances between two sets of features.
+
+    Args:
+        qf (torch.Tensor): Features with shape (m, d)
+        gf (torch.Tensor or QuantizedEmbeddings): Features with shape (n, d). Quantized features use their own kernel.
+
+    Returns:
+        torch.Tensor: Distances with shape (m, n)
+    """
+    if isinstance(gf, QuantizedEmbeddings):
+        return gf.euclidean_distances(qf)
+    # distance is sqrt(sum((a-b)^2))
+    # so a^2 + b^2 - 2ab
+    a2b2 = torch.pow(qf, 2).sum(1, keepdim=True).expand(qf.size(0), gf.size(0))
+    a2b2 = a2b2 + torch.pow(gf, 2).sum(1, keepdim=True).expand(gf.size(0), qf.size(0)).t()
+    eu = torch.addmm(a2b2, qf, gf.t(), beta=1, alpha=-2)
+    return eu.clamp(min=1e-12).sqrt()
+
+
+def cosine_distances(qf, gf):
+    """ Cosine distances (1 - cosine similarity) between two sets of features, in float32.
+
+    Args:
+        qf (torch.Tensor): Features with shape (m, d)
+        gf (torch.Tensor or QuantizedEmbeddings): Features with shape (n, d). Quantized features use their own kernel.
+
+    Returns:
+        torch.Tensor: Distances with shape (m, n)
+    """
+    if isinstance(gf, QuantizedEmbeddings):
+        return gf.cosine_distances(qf)
+    qf, gf = torch.as_tensor(qf).float(), torch.as_tensor(gf).float()
+    qn = qf / qf.norm(dim=1, keepdim=True).clamp(min=1e-12)
+    gn = gf / gf.norm(dim=1, keepdim=True).clamp(min=1e-12)
+    return 1 - torch.mm(qn, gn.t())
@@ -0,0 +1,348 @@
+import numpy as np
+
+
+def match_and_valid(gallery_ids, gallery_cams, query_ids, query_cams, junk="same_camera", separate_camera_set=False):
+    """ Correct-match and non-junk masks for a block of queries against gallery entries.
+
+    Args:
+        gallery_ids, gallery_cams (ndarray): Gallery IDs and cameras, either 1-D (shared by all queries) or one row per query
+        query_ids, query_cams (ndarray): 1-D query IDs and cameras
+        junk (str): See RankingMetrics
+        separate_camera_set (bool): See RankingMetrics
+
+    Returns:
+        (ndarray, ndarray): Boolean `matches` and `valid` masks with shape (num_queries, num_gallery)
+    """
+    matches = gallery_ids == query_ids[:, np.newaxis]
+    if junk == "same_camera":
+        valid = ~(matches & (gallery_cams == query_cams[:, np.newaxis]))
+    elif junk == "invalid_id":
+        valid = np.broadcast_to(gallery_ids != -1, matches.shape).copy()
+    else:
+        valid = np.ones(matches.shape, dtype=bool)
+    if separate_camera_set:
+        valid &= gallery_cams != query_cams[:, np.newaxis]
+    return matches, valid
+
+
+class RankingMetrics:
+    """ Batched CMC, mAP, and mINP for a query-to-gallery distance matrix.
+
+    Queries are processed in chunks of `chunk_size` rows. Each chunk is sorted once and every metric is read off cumulative sums over the sorted match matrix, so there is no per-query Python loop. Results are kept as running sums, so several `update` calls (or several RankingMetrics objects, see `merge`) can be combined before `compute`.
+
+    Args:
+        topk (int): Length of the CMC curve
+        junk (str): Gallery entries that are ignored for each query. One of:
+            1. 'same_camera' - entries with the same ID and the same camera as the query (Market-1501/VeRi protocol)
+            2. 'invalid_id' - entries with ID -1
+            3. 'none' - nothing is ignored
+        separate_camera_set (bool): Additionally ignore all gallery entries from the query's camera
+        first_match_break (bool): If True, CMC counts only the first correct match. Otherwise each correct match adds 1/num_matches at the number of incorrect matches before it (open-reid behavior)
+        tie_aware (bool): If True, tied distances are treated as a single threshold when computing AP. This matches sklearn's average_precision_score. Otherwise AP follows the sorted order.
+        chunk_size (int): Number of queries to sort at once. Peak memory is a few chunk_size x num_gallery arrays.
+        ranking (str): How each chunk is ranked. One of:
+            1. 'full' - argsort over the entire gallery
+            2. 'topk' - argpartition to the top `topk` non-junk entries (plus the correct matches, without first_match_break), and sort only those. CMC is exact. See `exact_map`.
+        exact_map (bool): Only used with ranking='topk'. If True, each chunk is partitioned down to its farthest correct match instead, so mAP and mINP are exact. If False, AP is mAP@K (normalized by min(num_matches, topk)) and mINP counts 0 for queries whose hardest match is outside the top K.
+
+    Methods:
+        update(distmat, query_ids, gallery_ids, query_cams, gallery_cams): Accumulate metrics for a block of queries
+        update_ranks(positive_ranks, num_pos): Accumulate metrics from precomputed ranks of the correct matches
+        merge(other): Add the accumulated sums of another RankingMetrics
+        compute(): Return a dict with `cmc`, `mAP`, `mINP`, and per-query `AP`
+    """
+    def __init__(self, topk=100, junk="same_camera", separate_camera_set=False, first_match_break=True, tie_aware=False, chunk_size=128, ranking="full", exact_map=True):
+        if junk not in ["same_camera", "invalid_id", "none"]:
+            raise NotImplementedError("junk must be one of ['same_camera', 'invalid_id', 'none']. Got %s"%junk)
+        if ranking not in ["full", "topk"]:
+            raise NotImplementedError("ranking must be one of ['full', 'topk']. Got %s"%ranking)
+        self.topk = topk
+        self.junk = junk
+        self.separate_camera_set = separate_camera_set
+        self.first_match_break = first_match_break
+        self.tie_aware = tie_aware
+        self.chunk_size = chunk_size
+        self.ranking = ranking
+        self.exact_map = exact_map
+        self.reset()
+
+    def reset(self):
+        self.cmc_counts = np.zeros(self.topk, dtype=np.float64)
+        self.ap_sum = 0.
+        self.inp_sum = 0.
+        self.num_valid = 0
+        self.aps = []
+
+    def update(self, distmat, query_ids, gallery_ids, query_cams, gallery_cams):
+        """ Accumulate metrics for a block of queries.
+
+        Args:
+            distmat (array-like): Distances with shape (num_queries, num_gallery). Torch tensors are accepted.
+            query_ids, gallery_ids, query_cams, gallery_cams (array-like): IDs and camera IDs
+        """
+        distmat = np.asarray(distmat)
+        query_ids, gallery_ids = np.asarray(query_ids), np.asarray(gallery_ids)
+        query_cams, gallery_cams = np.asarray(query_cams), np.asarray(gallery_cams)
+        for start in range(0, distmat.shape[0], self.chunk_size):
+            stop = start + self.chunk_size
+            dist, q_ids, q_cams = distmat[start:stop], query_ids[start:stop], query_cams[start:stop]
+            if self.ranking == "topk":
+                self.aps.append(self._update_topk(dist, q_ids, gallery_ids, q_cams, gallery_cams))
+            else:
+                order = np.argsort(dist, axis=1)
+                sorted_dist = np.take_along_axis(dist, order, axis=1) if self.tie_aware else None
+                self.aps.append(self._accumulate(gallery_ids[order], gallery_cams[order], q_ids, q_cams, sorted_dist)[1])
+
+    def _update_topk(self, dist, query_ids, gallery_ids, query_cams, gallery_cams):
+        # rank each row only as deep as needed with argpartition, then sort just that head. Returns AP of the kept rows in row order
+        matches, valid = match_and_valid(gallery_ids, gallery_cams, query_ids, query_cams, self.junk, self.separate_camera_set)
+        hits = matches & valid
+        num_pos = hits.sum(axis=1)
+        num_gallery = dist.shape[1]
+        dist = np.where(valid, dist, np.inf)   # junk never takes a slot in the head
+        # without first_match_break, CMC also reads matches that come after the first topk misses
+        depth = np.minimum(self.topk + (0 if self.first_match_break else 1) * num_pos, num_gallery)
+        if self.exact_map:
+            # everything up to the farthest correct match is needed for exact AP and mINP
+            farthest = np.where(hits, dist, -np.inf).max(axis=1)
+            depth = np.maximum(depth, (dist <= farthest[:, np.newaxis]).sum(axis=1))
+
+        # rows are partitioned in groups sharing a depth of topk, 4*topk, 16*topk, ..., num_gallery, so one hard query does not deepen the whole chunk
+        tiers = [self.topk * 4**power for power in range(int(np.ceil(np.log(max(num_gallery / float(self.topk), 1)) / np.log(4))))] + [num_gallery]
+        row_tier = np.searchsorted(tiers, depth)
+        kept_rows, aps = [], []
+        for tier in np.unique(row_tier):
+            rows = np.nonzero(row_tier == tier)[0]
+            tier_dist = dist[rows]
+            if tiers[tier] < num_gallery:
+                head = np.argpartition(tier_dist, tiers[tier] - 1, axis=1)[:, :tiers[tier]]
+                head = np.take_along_axis(head, np.argsort(np.take_along_axis(tier_dist, head, axis=1), axis=1), axis=1)
+            else:
+                head = np.argsort(tier_dist, axis=1)
+            sorted_dist = np.take_along_axis(tier_dist, head, axis=1) if self.tie_aware else None
+            keep, tier_aps = self._accumulate(gallery_ids[head], gallery_cams[head], query_ids[rows], query_cams[rows], sorted_dist, num_pos[rows])
+            kept_rows.append(rows[keep])
+            aps.append(tier_aps)
+        return np.concatenate(aps)[np.argsort(np.concatenate(kept_rows), kind="mergesort")]
+
+    def _accumulate(self, ranked_ids, ranked_cams, query_ids, query_cams, sorted_dist=None, num_pos=None):
+        # ranked_ids/ranked_cams are gallery IDs/cameras in ranked order, one row per query. They may cover only the top of the ranking,
+        # in which case num_pos is the number of correct matches in the full gallery
+        matches, valid = match_and_valid(ranked_ids, ranked_cams, query_ids, query_cams, self.junk, self.separate_camera_set)
+        hits = matches & valid
+        ranked_pos = hits.sum(axis=1)
+        num_pos = ranked_pos if num_pos is None else num_pos
+        keep = num_pos > 0  # queries whose identity does not appear in the gallery are skipped
+        if not keep.any():
+            return keep, np.zeros(0)
+        hits, valid, num_pos, ranked_pos = hits[keep], valid[keep], num_pos[keep], ranked_pos[keep]
+        rows = np.arange(hits.shape[0])
+
+        cum_hits = np.cumsum(hits, axis=1, dtype=np.int32)
+        cum_valid = np.cumsum(valid, axis=1, dtype=np.int32)   # 1-based rank among non-junk entries
+
+        # CMC
+        if self.first_match_break:
+            first_rank = cum_valid[rows, hits.argmax(axis=1)] - 1
+            first_rank = first_rank[(first_rank < self.topk) & (ranked_pos > 0)]
+            self.cmc_counts += np.bincount(first_rank, minlength=self.topk)[:self.topk]
+        else:
+            hit_rows, hit_cols = np.nonzero(hits)
+            misses_before = (cum_valid - cum_hits)[hit_rows, hit_cols]
+            inside = misses_before < self.topk
+            weights = 1. / num_pos[hit_rows[inside]]
+            self.cmc_counts += np.bincount(misses_before[inside], weights=weights, minlength=self.topk)[:self.topk]
+
+        # AP
+        if self.tie_aware:
+            # precision is read at the last entry of each group of tied distances
+            sorted_dist = sorted_dist[keep]
+            num_cols = sorted_dist.shape[1]
+            group_end = np.full(sorted_dist.shape, num_cols, dtype=np.int64)
+            group_end[:, -1] = num_cols - 1
+            group_end[:, :-1] = np.where(sorted_dist[:, 1:] != sorted_dist[:, :-1], np.arange(num_cols - 1), num_cols)
+            group_end = np.minimum.accumulate(group_end[:, ::-1], axis=1)[:, ::-1]
+            precision = np.take_along_axis(cum_hits, group_end, axis=1) / np.maximum(np.take_along_axis(cum_valid, group_end, axis=1), 1).astype(np.float64)
+        else:
+            precision = cum_hits / np.maximum(cum_valid, 1).astype(np.float64)
+        # when the ranking is truncated this is AP@K, otherwise min(num_pos, cum_valid[:, -1]) == num_pos
+        aps = (precision * hits).sum(axis=1) / np.minimum(num_pos, cum_valid[:, -1])
+
+        # mINP: num_pos over the rank of the hardest positive
+        last_hit = hits.shape[1] - 1 - hits[:, ::-1].argmax(axis=1)
+        inps = np.where(ranked_pos == num_pos, num_pos / cum_valid[rows, last_hit].astype(np.float64), 0.)
+
+        self.ap_sum += aps.sum()
+        self.inp_sum += inps.sum()
+        self.num_valid += int(keep.sum())
+        return keep, aps
+
+    def update_ranks(self, positive_ranks, num_pos):
+        """ Accumulate metrics from the ranks of each query's correct matches.
+
+        This is used when the full sorted gallery is not available, e.g. by BlockwiseSearch. Ties are resolved by whatever order produced the ranks, so `tie_aware` does not apply here.
+
+        Args:
+            positive_ranks (ndarray): Shape (num_queries, max_matches). 1-based ranks of the correct matches among the non-junk gallery entries, sorted ascending per row. Only the first num_pos[i] entries of row i are read.
+            num_pos (ndarray): Number of correct matches for each query
+        """
+        positive_ranks, num_pos = np.asarray(positive_ranks), np.asarray(num_pos)
+        keep = num_pos > 0
+        if not keep.any():
+            return
+        ranks, num_pos = positive_ranks[keep], num_pos[keep]
+        rows = np.arange(ranks.shape[0])
+        position = np.arange(1, ranks.shape[1] + 1)[np.newaxis, :]
+        present = position <= num_pos[:, np.newaxis]
+        ranks = np.where(present, ranks, 1)
+
+        if self.first_match_break:
+            first_rank = ranks[:, 0] - 1
+            first_rank = first_rank[first_rank < self.topk]
+            self.cmc_counts += np.bincount(first_rank, minlength=self.topk)[:self.topk]
+        else:
+            misses_before = ranks - position
+            inside = present & (misses_before < self.topk)
+            weights = np.broadcast_to(1. / num_pos[:, np.newaxis], ranks.shape)[inside]
+            self.cmc_counts += np.bincount(misses_before[inside], weights=weights, minlength=self.topk)[:self.topk]
+
+        aps = np.where(present, position / ranks.astype(np.float64), 0.).sum(axis=1) / num_pos
+        inps = num_pos / ranks[rows, num_pos - 1].astype(np.float64)
+
+        self.ap_sum += aps.sum()
+        self.inp_sum += inps.sum()
+        self.num_valid += int(keep.sum())
+        self.aps.append(aps)
+
+    def merge(self, other):
+        self.cmc_counts += other.cmc_counts
+        self.ap_sum += other.ap_sum
+        self.inp_sum += other.inp_sum
+        self.num_valid += other.num_valid
+        self.aps += other.aps
+        return self
+
+    def compute(self):
+        if self.num_valid == 0:
+            raise RuntimeError("No valid query")
+        return {
+            "cmc": self.cmc_counts.cumsum() / self.num_valid,
+            "mAP": self.ap_sum / self.num_valid,
+            "mINP": self.inp_sum / self.num_valid,
+            "AP": np.concatenate(self.aps) if len(self.aps) else np.zeros(0)
+        }
+
+
+def single_gallery_shot_cmc(distmat, query_ids, gallery_ids, query_cams, gallery_cams, topk=100, separate_camera_set=False, first_match_break=False, repeat=10, seed=None, chunk_size=128):
+    """ CMC where the gallery holds one randomly drawn image per identity (CUHK03 protocol), averaged over `repeat` draws.
+
+    Same expected value as open-reid's single_gallery_shot CMC, but all draws for a chunk of queries are made at once. Each non-junk gallery entry gets a uniform random key, and the entry with the smallest key in each identity is the one drawn. The rank of the drawn correct match is the number of drawn entries closer to the query than it (ties broken by gallery index), so no sort is needed.
+
+    Args:
+        distmat (array-like): Distances with shape (num_queries, num_gallery). Torch tensors are accepted.
+        query_ids, gallery_ids, query_cams, gallery_cams (array-like): IDs and camera IDs
+        topk (int): Length of the CMC curve
+        separate_camera_set (bool): Ignore all gallery entries from the query's camera
+        first_match_break (bool): Kept for parity with open-reid, where each draw then adds 1 instead of 1/repeat
+        repeat (int): Number of random draws per query
+        seed (int): Seed for the draws. None for a random seed.
+        chunk_size (int): Query draws (queries x repeat) processed at once. Peak memory is a few chunk_size x num_gallery arrays.
+
+    Returns:
+        ndarray: CMC curve of length topk
+    """
+    distmat = np.asarray(distmat)
+    query_ids, gallery_ids = np.asarray(query_ids), np.asarray(gallery_ids)
+    query_cams, gallery_cams = np.asarray(query_cams), np.asarray(gallery_cams)
+    rng = np.random.RandomState(seed)
+    num_gallery = distmat.shape[1]
+    # gallery entries grouped by identity, for a per-identity minimum over the random keys
+    identity = np.unique(gallery_ids, return_inverse=True)[1]
+    by_identity = np.argsort(identity, kind="mergesort")
+    starts = np.nonzero(np.r_[True, np.diff(identity[by_identity]) != 0])[0]
+    gallery_index = np.arange(num_gallery)
+
+    cmc_counts = np.zeros(topk, dtype=np.float64)
+    num_valid = 0
+    query_chunk = max(1, chunk_size // repeat)
+    for start in range(0, distmat.shape[0], query_chunk):
+        stop = start + query_chunk
+        matches, valid = match_and_valid(gallery_ids, gallery_cams, query_ids[start:stop], query_cams[start:stop], "same_camera", separate_camera_set)
+        keep = (matches & valid).any(axis=1)
+        if not keep.any():
+            continue
+        num_valid += int(keep.sum())
+        dist = np.repeat(distmat[start:stop][keep], repeat, axis=0)
+        matches, valid = np.repeat(matches[keep], repeat, axis=0), np.repeat(valid[keep], repeat, axis=0)
+
+        keys = np.where(valid, rng.random_sample(valid.shape), 2.)   # junk can never be drawn
+        identity_min = np.minimum.reduceat(keys[:, by_identity], starts, axis=1)
+        drawn = valid & (keys == identity_min[:, identity])
+        drawn_match = np.argmax(drawn & matches, axis=1)
+        rows = np.arange(len(dist))
+        match_dist = dist[rows, drawn_match][:, np.newaxis]
+        ahead = (dist < match_dist) | ((dist == match_dist) & (gallery_index < drawn_match[:, np.newaxis]))
+        rank = (drawn & ahead).sum(axis=1)
+        rank = rank[rank < topk]
+        cmc_counts += np.bincount(rank, minlength=topk)[:topk] * (1. if first_match_break else 1. / repeat)
+    if num_valid == 0:
+        raise RuntimeError("No valid query")
+    return cmc_counts.cumsum() / num_valid
+
+
+def random_gallery_draws(features, ids, distance_fn, repeats=10, seed=None, chunk_size=128, **kwargs):
+    """ CMC, mAP, and mINP of a test set with no fixed gallery (VehicleID protocol), for `repeats` random draws of the gallery.
+
+    Each draw puts one randomly chosen image of every identity in the gallery, and uses all other images as queries. All draws are made at once, as in single_gallery_shot_cmc: every image gets a uniform random key per draw, and the image with the smallest key in each identity is drawn. Distances from a chunk of images to the whole test set are computed once and shared by every draw, which only selects its query rows and gallery columns from them.
+
+    Args:
+        features (torch.Tensor): Features of the test set, shape (num_images, d)
+        ids (array-like): Identity of each image
+        distance_fn (callable): (features, features) -> distances, e.g. cosine_distances
+        repeats (int): Number of gallery draws
+        seed (int): Seed for the draws. None for a random seed.
+        chunk_size (int): Images whose distances are computed at once. Peak memory is a few chunk_size x num_images arrays.
+        kwargs: Passed to RankingMetrics. junk defaults to 'invalid_id', since there are no cameras.
+
+    Returns:
+        dict: `cmc` with shape (repeats, topk), and `mAP` and `mINP` with shape (repeats,)
+    """
+    ids = np.asarray(ids)
+    kwargs.setdefault("junk", "invalid_id")
+    kwargs.setdefault("chunk_size", chunk_size)
+    rng = np.random.RandomState(seed)
+    identity = np.unique(ids, return_inverse=True)[1]
+    by_identity = np.argsort(identity, kind="mergesort")
+    starts = np.nonzero(np.r_[True, np.diff(identity[by_identity]) != 0])[0]
+    keys = rng.random_sample((repeats, len(ids)))
+    identity_min = np.minimum.reduceat(keys[:, by_identity], starts, axis=1)
+    drawn = keys == identity_min[:, identity]   # (repeats, num_images), one True per identity in each row
+    galleries = [np.nonzero(row)[0] for row in drawn]
+    cams = np.zeros(len(ids), dtype=np.int64)   # unused with invalid_id junk
+
+    metrics = [RankingMetrics(**kwargs) for _ in range(repeats)]
+    for start in range(0, len(ids), chunk_size):
+        stop = min(start + chunk_size, len(ids))
+        dist = np.asarray(distance_fn(features[start:stop], features))
+        for repeat, gallery in enumerate(galleries):
+            queries = ~drawn[repeat, start:stop]
+            if queries.any():
+                metrics[repeat].update(dist[queries][:, gallery], ids[start:stop][queries], ids[gallery], cams[start:stop][queries], cams[gallery])
+    results = [metric.compute() for metric in metrics]
+    return {key: np.stack([result[key] for result in results]) for key in ["cmc", "mAP", "mINP"]}
+
+
+def evaluate_ranking(distmat, query_ids, gallery_ids, query_cams, gallery_cams, **kwargs):
+    """ Convenience wrapper that runs RankingMetrics over a full distance matrix.
+
+    Args:
+        distmat (array-like): Distances with shape (num_queries, num_gallery)
+        query_ids, gallery_ids, query_cams, gallery_cams (array-like): IDs and camera IDs
+        kwargs: Passed to RankingMetrics
+
+    Returns:
+        dict: `cmc`, `mAP`, `mINP`, and per-query `AP` for queries with at least one valid match
+    """
+    metrics = RankingMetrics(**kwargs)
+    metrics.update(distmat, query_ids, gallery_ids, query_cams, gallery_cams)
+    return metrics.compute()
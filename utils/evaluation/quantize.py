@@ -0,0 +1,135 @@
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+from .metrics import evaluate_ranking
+
+
+class QuantizedEmbeddings:
+    """ Scalar-quantized embeddings, with distance kernels that work on the stored codes.
+
+    Formats:
+        1. 'float32' - stored as is
+        2. 'float16' - half precision, 2 bytes per value
+        3. 'int8' - per-dimension affine quantization to 256 levels, 1 byte per value. Each dimension keeps an offset (its minimum) and a scale ((max - min) / 255), so value = offset + scale * code.
+
+    Distances are computed against float32 queries (asymmetric distance). Codes are decoded one tile at a time, so only tile_size x d floats exist at once besides the output. For int8, the scale and offset are folded into the query instead of decoding the gallery: q.g = q.offset + (q * scale).code
+
+    Args:
+        codes (torch.Tensor): Stored values, (n, d)
+        fmt (str): One of 'float32', 'float16', 'int8'
+        scale, offset (torch.Tensor): Per-dimension scale and offset, (d,). int8 only.
+        tile_size (int): Rows decoded at once by the distance kernels
+
+    Methods:
+        QuantizedEmbeddings.quantize(features, fmt): Build from float features
+        dequantize(): float32 features, (n, d)
+        euclidean_distances(query_features), cosine_distances(query_features): (m, n) distances from float32 queries
+        embeddings[start:stop]: The same embeddings restricted to some rows, sharing the codes
+    """
+    FORMATS = ["float32", "float16", "int8"]
+
+    def __init__(self, codes, fmt="float32", scale=None, offset=None, tile_size=4096):
+        if fmt not in self.FORMATS:
+            raise NotImplementedError("Embedding format must be one of %s. Got %s"%(str(self.FORMATS), fmt))
+        self.codes = codes
+        self.fmt = fmt
+        self.scale = scale
+        self.offset = offset
+        self.tile_size = tile_size
+        self._squared_norms = None
+
+    @classmethod
+    def quantize(cls, features, fmt="int8", tile_size=4096):
+        features = torch.as_tensor(np.asarray(features) if not isinstance(features, torch.Tensor) else features).float()
+        if fmt == "int8":
+            offset = features.min(dim=0)[0]
+            scale = ((features.max(dim=0)[0] - offset) / 255.).clamp(min=1e-12)
+            codes = torch.round((features - offset) / scale).clamp(0, 255).to(torch.uint8)
+            return cls(codes, fmt, scale, offset, tile_size)
+        if fmt == "float16":
+            return cls(features.half(), fmt, tile_size=tile_size)
+        return cls(features, fmt, tile_size=tile_size)
+
+    def __len__(self):
+        return self.codes.size(0)
+
+    @property
+    def shape(self):
+        return tuple(self.codes.shape)
+
+    @property
+    def nbytes(self):
+        return self.codes.numel() * self.codes.element_size()
+
+    def __getitem__(self, index):
+        subset = QuantizedEmbeddings(self.codes[index], self.fmt, self.scale, self.offset, self.tile_size)
+        if self._squared_norms is not None:
+            subset._squared_norms = self._squared_norms[index]
+        return subset
+
+    def _decode(self, start, stop):
+        codes = self.codes[start:stop].float()
+        if self.fmt == "int8":
+            return codes * self.scale + self.offset
+        return codes
+
+    def dequantize(self):
+        return torch.cat([self._decode(start, start + self.tile_size) for start in range(0, len(self), self.tile_size)], dim=0) \
+            if len(self) else torch.zeros(0, self.codes.size(1))
+
+    def squared_norms(self):
+        if self._squared_norms is None:
+            self._squared_norms = torch.cat([self._decode(start, start + self.tile_size).pow(2).sum(1) for start in range(0, len(self), self.tile_size)]) \
+                if len(self) else torch.zeros(0)
+        return self._squared_norms
+
+    def dot(self, query_features):
+        """ Inner products between float32 queries (m, d) and every stored embedding. Returns (m, n) """
+        query_features = query_features.float()
+        out = torch.empty(query_features.size(0), len(self))
+        if self.fmt == "int8":
+            query_offset = torch.mv(query_features, self.offset).unsqueeze(1)
+            query_scaled = query_features * self.scale
+        for start in range(0, len(self), self.tile_size):
+            stop = min(start + self.tile_size, len(self))
+            if self.fmt == "int8":
+                out[:, start:stop] = torch.addmm(query_offset.expand(-1, stop - start), query_scaled, self.codes[start:stop].float().t())
+            else:
+                out[:, start:stop] = torch.mm(query_features, self.codes[start:stop].float().t())
+        return out
+
+    def euclidean_distances(self, query_features):
+        # same as utils.evaluation.euclidean_distances: sqrt(a^2 + b^2 - 2ab)
+        a2b2 = torch.pow(query_features.float(), 2).sum(1, keepdim=True) + self.squared_norms().unsqueeze(0)
+        return (a2b2 - 2 * self.dot(query_features)).clamp(min=1e-12).sqrt()
+
+    def cosine_distances(self, query_features):
+        query_norms = query_features.float().norm(dim=1, keepdim=True).clamp(min=1e-12)
+        return 1 - self.dot(query_features) / (query_norms * self.squared_norms().sqrt().clamp(min=1e-12).unsqueeze(0))
+
+
+def quantization_report(query_features, gallery_features, query_ids, gallery_ids, query_cams, gallery_cams, formats=("float32", "float16", "int8"), distance_fn=None, **kwargs):
+    """ mAP and rank-1 of each gallery embedding format, and the mAP change relative to float32.
+
+    Args:
+        query_features, gallery_features (torch.Tensor): float32 features
+        query_ids, gallery_ids, query_cams, gallery_cams (array-like): IDs and camera IDs
+        formats (list): Formats to compare. See QuantizedEmbeddings.
+        distance_fn (callable): (query_features, QuantizedEmbeddings) -> distances. Default: Euclidean
+        kwargs: Passed to RankingMetrics
+
+    Returns:
+        OrderedDict: format -> {'mAP', 'mAP_delta', 'rank1', 'bytes'}. mAP_delta is relative to float32.
+    """
+    distance_fn = distance_fn if distance_fn is not None else (lambda qf, gallery: gallery.euclidean_distances(qf))
+    kwargs.setdefault("tie_aware", True)
+    report = OrderedDict()
+    baseline = None
+    for fmt in ["float32"] + [item for item in formats if item != "float32"]:
+        gallery = QuantizedEmbeddings.quantize(gallery_features, fmt)
+        results = evaluate_ranking(distance_fn(query_features, gallery), query_ids, gallery_ids, query_cams, gallery_cams, **kwargs)
+        baseline = results["mAP"] if baseline is None else baseline
+        report[fmt] = {"mAP": results["mAP"], "mAP_delta": results["mAP"] - baseline, "rank1": results["cmc"][0], "bytes": gallery.nbytes}
+    return report
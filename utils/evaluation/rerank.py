@@ -0,0 +1,144 @@
+import numpy as np
+import scipy.sparse as sp
+import torch
+
+from .distances import euclidean_distances
+
+
+class KReciprocalReranker:
+    """ k-reciprocal re-ranking (Zhong et al., CVPR 2017) with sparse neighbor weights.
+
+    Produces the same final distances as the dense reference implementation, but never allocates a (Q+G) x (Q+G) matrix. Rows of the normalized distance matrix are generated in blocks of `block_size`, from either the dense qq/qg/gg matrices or directly from features. Only the top-(k1+1) neighbor table is kept from them. k-reciprocal sets, their expansion, query expansion, and the Jaccard distance are computed with sparse products. Memory grows with (Q+G)*k1*k2, plus the Q x G output.
+
+    Args:
+        k1 (int): Neighborhood size for the k-reciprocal sets
+        k2 (int): Neighborhood size for query expansion. 1 disables it.
+        lambda_value (float): Weight of the original distance in the final distance
+        block_size (int): Rows of the (Q+G) x (Q+G) distance matrix generated at once
+        query_chunk_size (int): Queries processed together in the Jaccard step
+
+    Methods:
+        rerank(q_g_dist, q_q_dist, g_g_dist): Re-rank from dense distance matrices
+        rerank_features(query_features, gallery_features, distance_fn): Re-rank from features, without any dense qq/gg matrix
+    """
+    def __init__(self, k1=20, k2=6, lambda_value=0.3, block_size=1024, query_chunk_size=64):
+        self.k1 = k1
+        self.k2 = k2
+        self.lambda_value = lambda_value
+        self.block_size = block_size
+        self.query_chunk_size = query_chunk_size
+
+    def rerank(self, q_g_dist, q_q_dist, g_g_dist):
+        """ Re-rank from dense distance matrices. Torch tensors are accepted.
+
+        Returns:
+            ndarray: Re-ranked query-to-gallery distances with shape (Q, G)
+        """
+        q_g_dist, q_q_dist, g_g_dist = np.asarray(q_g_dist), np.asarray(q_q_dist), np.asarray(g_g_dist)
+        num_query = q_g_dist.shape[0]
+
+        def columns(start, stop):
+            # columns [start, stop) of [[qq, qg], [qg.T, gg]]
+            blocks = []
+            if start < num_query:
+                blocks.append(np.concatenate([q_q_dist[:, start:min(stop, num_query)], q_g_dist.T[:, start:min(stop, num_query)]], axis=0))
+            if stop > num_query:
+                g_start, g_stop = max(start, num_query) - num_query, stop - num_query
+                blocks.append(np.concatenate([q_g_dist[:, g_start:g_stop], g_g_dist[:, g_start:g_stop]], axis=0))
+            return np.concatenate(blocks, axis=1)
+
+        return self._rerank(num_query, num_query + g_g_dist.shape[0], columns)
+
+    def rerank_features(self, query_features, gallery_features, distance_fn=None):
+        """ Re-rank from features. Distances are computed block by block with distance_fn (default: euclidean_distances).
+
+        Returns:
+            ndarray: Re-ranked query-to-gallery distances with shape (Q, G)
+        """
+        distance_fn = distance_fn if distance_fn is not None else euclidean_distances
+        all_features = torch.cat([torch.as_tensor(query_features), torch.as_tensor(gallery_features)], dim=0).float()
+
+        def columns(start, stop):
+            return distance_fn(all_features, all_features[start:stop]).cpu().numpy()
+
+        return self._rerank(len(query_features), len(all_features), columns)
+
+    def _rows(self, columns, start, stop):
+        # rows [start, stop) of the normalized distance matrix. Row i is column i of the transformed distances, divided by its maximum
+        original_dist = 2. - 2 * columns(start, stop)   # change the cosine similarity metric to euclidean similarity metric
+        original_dist = np.power(original_dist, 2).astype(np.float32)
+        return np.transpose(1. * original_dist/np.max(original_dist,axis = 0))
+
+    def _rerank(self, num_query, num_all, columns):
+        k1, k2 = self.k1, self.k2
+        k_half = int(np.around(k1/2))
+
+        # pass 1: sorted top-(k1+1) neighbor table
+        neighbors = np.zeros((num_all, k1 + 1), dtype=np.int64)
+        for start in range(0, num_all, self.block_size):
+            stop = min(start + self.block_size, num_all)
+            dist = self._rows(columns, start, stop)
+            nearest = np.argpartition(dist, k1, axis=1)[:, :k1 + 1]
+            order = np.argsort(np.take_along_axis(dist, nearest, axis=1), axis=1, kind="mergesort")
+            neighbors[start:stop] = np.take_along_axis(nearest, order, axis=1)
+
+        # k-reciprocal sets R, and the half-size sets R_half used as expansion candidates
+        forward = self._neighbor_matrix(neighbors[:, :k1 + 1], num_all)
+        forward_half = self._neighbor_matrix(neighbors[:, :k_half + 1], num_all)
+        reciprocal = forward.multiply(forward.T).tocsr()
+        reciprocal_half = forward_half.multiply(forward_half.T).tocsr()
+
+        # a candidate c in R(i) is accepted if |R_half(c) & R(i)| > 2/3 |R_half(c)|
+        overlap = reciprocal.multiply(reciprocal.dot(reciprocal_half.T)).tocoo()
+        half_size = np.asarray(reciprocal_half.sum(axis=1)).ravel()
+        accepted = overlap.data > 2./3 * half_size[overlap.col]
+        accepted = sp.csr_matrix((np.ones(accepted.sum(), dtype=np.float32), (overlap.row[accepted], overlap.col[accepted])), shape=(num_all, num_all))
+        expansion = (reciprocal + accepted.dot(reciprocal_half)).tocsr()
+        expansion.sort_indices()
+
+        # pass 2: Gaussian weights over each expanded set, plus the original query-to-gallery distances
+        weights = np.zeros(expansion.nnz, dtype=np.float32)
+        original_qg = np.zeros((num_query, num_all - num_query), dtype=np.float32)
+        for start in range(0, num_all, self.block_size):
+            stop = min(start + self.block_size, num_all)
+            dist = self._rows(columns, start, stop)
+            lo, hi = expansion.indptr[start], expansion.indptr[stop]
+            row_len = np.diff(expansion.indptr[start:stop + 1])
+            local_rows = np.repeat(np.arange(stop - start), row_len)
+            weight = np.exp(-dist[local_rows, expansion.indices[lo:hi]])
+            weights[lo:hi] = weight / np.repeat(np.bincount(local_rows, weights=weight, minlength=stop - start), row_len)
+            if start < num_query:
+                original_qg[start:min(stop, num_query)] = dist[:min(stop, num_query) - start, num_query:]
+        V = sp.csr_matrix((weights, expansion.indices, expansion.indptr), shape=(num_all, num_all))
+
+        # local query expansion: average V over the k2 nearest neighbors
+        if k2 != 1:
+            V = self._neighbor_matrix(neighbors[:, :k2], num_all, value=1./k2).dot(V).tocsr()
+
+        # Jaccard distance: 1 - sum_j min(V[i,j], V[k,j]) / (2 - sum_j min(V[i,j], V[k,j]))
+        V_columns = V.tocsc()
+        num_gallery = num_all - num_query
+        jaccard_dist = np.zeros((num_query, num_gallery), dtype=np.float32)
+        for start in range(0, num_query, self.query_chunk_size):
+            stop = min(start + self.query_chunk_size, num_query)
+            block = V[start:stop].tocoo()
+            col_start, col_len = V_columns.indptr[block.col], np.diff(V_columns.indptr)[block.col]
+            offsets = np.repeat(col_start - (np.cumsum(col_len) - col_len), col_len) + np.arange(col_len.sum())
+            other = V_columns.indices[offsets]
+            shared = np.minimum(np.repeat(block.data, col_len), V_columns.data[offsets])
+            rows = np.repeat(block.row, col_len)
+            in_gallery = other >= num_query
+            temp_min = np.bincount(rows[in_gallery] * num_gallery + other[in_gallery] - num_query, weights=shared[in_gallery], minlength=(stop - start) * num_gallery)
+            temp_min = temp_min.reshape(stop - start, num_gallery)
+            jaccard_dist[start:stop] = 1 - temp_min/(2. - temp_min)
+
+        return jaccard_dist*(1-self.lambda_value) + original_qg*self.lambda_value
+
+    def _neighbor_matrix(self, neighbors, num_all, value=1.):
+        # sparse (num_all x num_all) matrix with `value` at (i, j) for each j in neighbors[i]
+        rows, cols = neighbors.shape
+        indptr = np.arange(0, rows * cols + 1, cols)
+        data = np.full(rows * cols, value, dtype=np.float32)
+        matrix = sp.csr_matrix((data, neighbors.ravel(), indptr), shape=(num_all, num_all))
+        matrix.sum_duplicates()
+        return matrix
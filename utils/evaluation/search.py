@@ -0,0 +1,139 @@
+import numpy as np
+import torch
+
+from .distances import euclidean_distances
+from .metrics import RankingMetrics, match_and_valid
+from .quantize import QuantizedEmbeddings
+
+
+class BlockwiseSearch:
+    """ Query-to-gallery search that streams the gallery in tiles.
+
+    The full query x gallery distance matrix is never built. For each chunk of queries, gallery tiles are scored one at a time and only a running top-k is kept. When gallery IDs are provided, a second pass over the tiles counts the non-junk gallery entries ranked above each correct match. Those counts are the exact ranks needed for CMC, mAP, and mINP (ties are broken by gallery index). Peak memory is roughly query_chunk_size x (gallery_tile_size + topk) distances, independent of gallery size.
+
+    Args:
+        topk (int): Number of nearest gallery entries kept for each query
+        query_chunk_size (int): Number of queries searched together
+        gallery_tile_size (int): Number of gallery features scored at once
+        junk (str): Gallery entries to skip for each query. See RankingMetrics. Only used when gallery IDs are given.
+        distance_fn (callable): Function (qf, gf) -> torch.Tensor of distances. Default: euclidean_distances
+
+    Methods:
+        search(query_features, gallery_features, ...): Returns top-k distances, top-k indices, and RankingMetrics
+    """
+    def __init__(self, topk=100, query_chunk_size=256, gallery_tile_size=8192, junk="same_camera", distance_fn=None):
+        self.topk = topk
+        self.query_chunk_size = query_chunk_size
+        self.gallery_tile_size = gallery_tile_size
+        self.junk = junk
+        self.distance_fn = distance_fn if distance_fn is not None else euclidean_distances
+
+    def search(self, query_features, gallery_features, query_ids=None, gallery_ids=None, query_cams=None, gallery_cams=None, metrics=None):
+        """ Search the gallery for every query.
+
+        Args:
+            query_features (torch.Tensor or ndarray): Shape (num_queries, d)
+            gallery_features (torch.Tensor, ndarray, or QuantizedEmbeddings): Shape (num_gallery, d). A numpy memmap works; only one tile is read at a time.
+            query_ids, gallery_ids, query_cams, gallery_cams (array-like): Optional. If gallery_ids is given, junk entries are skipped and metrics are accumulated.
+            metrics (RankingMetrics): Optional accumulator. One is created with matching topk and junk if not provided.
+
+        Returns:
+            (ndarray, ndarray, RankingMetrics): Top-k distances (num_queries x topk, ascending), top-k gallery indices (-1 where fewer than topk entries exist), and the metric accumulator (None without gallery_ids)
+        """
+        num_query, num_gallery = len(query_features), len(gallery_features)
+        evaluate = gallery_ids is not None
+        if evaluate:
+            query_ids, gallery_ids = np.asarray(query_ids), np.asarray(gallery_ids)
+            query_cams = np.asarray(query_cams) if query_cams is not None else np.zeros(num_query, dtype=np.int64)
+            gallery_cams = np.asarray(gallery_cams) if gallery_cams is not None else np.ones(num_gallery, dtype=np.int64)
+            if metrics is None:
+                metrics = RankingMetrics(topk=self.topk, junk=self.junk)
+        else:
+            metrics = None
+
+        topk = min(self.topk, num_gallery)
+        topk_dist = np.full((num_query, topk), np.inf, dtype=np.float32)
+        topk_idx = np.full((num_query, topk), -1, dtype=np.int64)
+        for start in range(0, num_query, self.query_chunk_size):
+            stop = min(start + self.query_chunk_size, num_query)
+            qf = self._as_tensor(query_features[start:stop])
+            q_ids = query_ids[start:stop] if evaluate else None
+            q_cams = query_cams[start:stop] if evaluate else None
+            topk_dist[start:stop], topk_idx[start:stop], positives = self._first_pass(qf, gallery_features, q_ids, q_cams, gallery_ids, gallery_cams, topk)
+            if evaluate:
+                ranks, num_pos = self._second_pass(qf, gallery_features, q_ids, q_cams, gallery_ids, gallery_cams, positives)
+                metrics.update_ranks(ranks, num_pos)
+        return topk_dist, topk_idx, metrics
+
+    def _as_tensor(self, features):
+        if isinstance(features, QuantizedEmbeddings):
+            return features    # distance_fn decodes these itself
+        if isinstance(features, torch.Tensor):
+            return features.float()
+        return torch.from_numpy(np.ascontiguousarray(features, dtype=np.float32))
+
+    def _tiles(self, qf, gallery_features, q_ids, q_cams, gallery_ids, gallery_cams):
+        # yields (start, distances, valid, hits) for each gallery tile. valid/hits are None without gallery IDs
+        for start in range(0, len(gallery_features), self.gallery_tile_size):
+            stop = min(start + self.gallery_tile_size, len(gallery_features))
+            dist = self.distance_fn(qf, self._as_tensor(gallery_features[start:stop])).cpu().numpy()
+            valid, hits = None, None
+            if q_ids is not None:
+                matches, valid = match_and_valid(gallery_ids[start:stop], gallery_cams[start:stop], q_ids, q_cams, self.junk)
+                hits = matches & valid
+                dist = np.where(valid, dist, np.inf)
+            yield start, dist, valid, hits
+
+    def _first_pass(self, qf, gallery_features, q_ids, q_cams, gallery_ids, gallery_cams, topk):
+        # running top-k, plus (row, gallery index, distance) of each correct match
+        rows = qf.size(0)
+        best_dist = np.full((rows, 0), np.inf, dtype=np.float32)
+        best_idx = np.full((rows, 0), -1, dtype=np.int64)
+        positives = ([], [], [])
+        for start, dist, valid, hits in self._tiles(qf, gallery_features, q_ids, q_cams, gallery_ids, gallery_cams):
+            tile_idx = np.broadcast_to(np.arange(start, start + dist.shape[1]), dist.shape)
+            cand_dist = np.concatenate([best_dist, dist.astype(np.float32)], axis=1)
+            cand_idx = np.concatenate([best_idx, tile_idx], axis=1)
+            if cand_dist.shape[1] > topk:
+                part = np.argpartition(cand_dist, topk - 1, axis=1)[:, :topk]
+                cand_dist = np.take_along_axis(cand_dist, part, axis=1)
+                cand_idx = np.take_along_axis(cand_idx, part, axis=1)
+            best_dist, best_idx = cand_dist, cand_idx
+            if hits is not None:
+                hit_rows, hit_cols = np.nonzero(hits)
+                positives[0].append(hit_rows)
+                positives[1].append(hit_cols + start)
+                positives[2].append(dist[hit_rows, hit_cols])
+        order = np.argsort(best_dist, axis=1, kind="mergesort")
+        best_dist = np.take_along_axis(best_dist, order, axis=1)
+        best_idx = np.where(np.isinf(best_dist), -1, np.take_along_axis(best_idx, order, axis=1))
+        return best_dist, best_idx, positives
+
+    def _second_pass(self, qf, gallery_features, q_ids, q_cams, gallery_ids, gallery_cams, positives):
+        # count the non-junk gallery entries ranked above each correct match, ordering by (distance, gallery index)
+        rows = qf.size(0)
+        hit_rows, hit_idx, hit_dist = [np.concatenate(item) for item in positives]
+        num_pos = np.bincount(hit_rows, minlength=rows)
+        max_pos = int(num_pos.max()) if len(num_pos) else 0
+        if max_pos == 0:
+            return np.zeros((rows, 0), dtype=np.int64), num_pos
+        # pad to a (rows, max_pos) table
+        order = np.argsort(hit_rows, kind="mergesort")
+        hit_rows, hit_idx, hit_dist = hit_rows[order], hit_idx[order], hit_dist[order]
+        slot = np.arange(len(hit_rows)) - np.repeat(np.cumsum(num_pos) - num_pos, num_pos)
+        pos_dist = np.full((rows, max_pos), np.inf)
+        pos_key = np.full((rows, max_pos), np.inf)
+        pos_dist[hit_rows, slot] = hit_dist
+        pos_key[hit_rows, slot] = hit_idx - 0.5    # sorts just ahead of its own gallery entry
+        counts = np.zeros((rows, max_pos), dtype=np.int64)
+        row_idx = np.arange(rows)[:, np.newaxis]
+        for start, dist, _, _ in self._tiles(qf, gallery_features, q_ids, q_cams, gallery_ids, gallery_cams):
+            tile_size = dist.shape[1]
+            tile_key = np.broadcast_to(np.arange(start, start + tile_size, dtype=np.float64), dist.shape)
+            order = np.lexsort((np.concatenate([tile_key, pos_key], axis=1), np.concatenate([dist, pos_dist], axis=1)), axis=1)
+            is_pos = order >= tile_size
+            tile_before = np.arange(order.shape[1])[np.newaxis, :] - (np.cumsum(is_pos, axis=1) - is_pos)
+            pos_rows = np.broadcast_to(row_idx, order.shape)[is_pos]
+            counts[pos_rows, order[is_pos] - tile_size] += tile_before[is_pos]
+        ranks = np.where(pos_dist < np.inf, counts + 1, np.iinfo(np.int64).max)
+        return np.sort(ranks, axis=1), num_pos
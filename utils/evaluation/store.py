@@ -0,0 +1,147 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+
+
+def checkpoint_hash(model):
+    """ SHA1 of a model's state_dict (parameter names and values). Two models with the same weights get the same hash. """
+    digest = hashlib.sha1()
+    for name, tensor in model.state_dict().items():
+        digest.update(name.encode("utf-8"))
+        digest.update(tensor.detach().cpu().numpy().tobytes())
+    return digest.hexdigest()
+
+
+def dataset_fingerprint(items):
+    """ SHA1 of an ordered list of (path, pid, cid) entries, e.g. query + gallery crawl of a dataset. """
+    digest = hashlib.sha1()
+    for path, pid, cid in items:
+        digest.update("{}\t{}\t{}\n".format(path, int(pid), int(cid)).encode("utf-8"))
+    return digest.hexdigest()
+
+
+class EmbeddingStore:
+    """ On-disk store of query/gallery embeddings, readable without the model.
+
+    A store is a directory with a raw (count x dim) feature matrix, opened as a numpy memmap, plus pid, cid, and track index arrays, the image paths, and a meta.json. The meta records the checkpoint hash of the model that produced the features, and the fingerprint of the (path, pid, cid) entries stored so far, so a stale store can be detected by comparing against the current model and dataset. Entries can be appended incrementally.
+
+    Args:
+        directory (str): Store directory. Created if it does not exist.
+        dtype (str): 'float32' or 'float16'. Storage type of new stores. An existing store keeps its own dtype until `reset`.
+
+    Attributes:
+        count (int): Number of stored entries
+        num_queries (int): Number of leading entries that are queries
+        features (np.memmap): (count, dim) features. Read-only.
+        pids, cids, tracks (ndarray): int64 arrays of length count. tracks is -1 where an image has no track.
+        paths (list): Image paths
+
+    Methods:
+        matches(checkpoint_hash, dataset_fingerprint): Whether the store was built by this checkpoint from exactly these entries
+        reset(checkpoint_hash, num_queries): Empty the store for a new checkpoint
+        append(features, pids, cids, paths, tracks): Add entries at the end
+    """
+    def __init__(self, directory, dtype="float32"):
+        if dtype not in ["float32", "float16"]:
+            raise NotImplementedError("Embedding store dtype must be one of ['float32', 'float16']. Got %s"%dtype)
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.meta = {"checkpoint_hash": None, "dataset_fingerprint": dataset_fingerprint([]), "dtype": dtype, "dim": 0, "count": 0, "num_queries": 0}
+        if os.path.exists(self._path("meta.json")):
+            with open(self._path("meta.json"), "r") as meta_file:
+                self.meta = json.load(meta_file)
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    @property
+    def count(self):
+        return self.meta["count"]
+
+    @property
+    def num_queries(self):
+        return self.meta["num_queries"]
+
+    @property
+    def checkpoint_hash(self):
+        return self.meta["checkpoint_hash"]
+
+    @property
+    def dataset_fingerprint(self):
+        return self.meta["dataset_fingerprint"]
+
+    @property
+    def features(self):
+        if self.count == 0:
+            return np.zeros((0, self.meta["dim"]), dtype=self.meta["dtype"])
+        return np.memmap(self._path("features.bin"), dtype=self.meta["dtype"], mode="r", shape=(self.count, self.meta["dim"]))
+
+    def _array(self, name):
+        if self.count == 0:
+            return np.zeros(0, dtype=np.int64)
+        return np.fromfile(self._path(name + ".bin"), dtype=np.int64, count=self.count)
+
+    @property
+    def pids(self):
+        return self._array("pids")
+
+    @property
+    def cids(self):
+        return self._array("cids")
+
+    @property
+    def tracks(self):
+        return self._array("tracks")
+
+    @property
+    def paths(self):
+        if self.count == 0:
+            return []
+        with open(self._path("paths.txt"), "r") as paths_file:
+            return paths_file.read().split("\n")[:self.count]
+
+    def matches(self, checkpoint_hash, dataset_fingerprint):
+        return self.checkpoint_hash == checkpoint_hash and self.dataset_fingerprint == dataset_fingerprint
+
+    def reset(self, checkpoint_hash, num_queries=0, dtype=None):
+        for name in ["features.bin", "pids.bin", "cids.bin", "tracks.bin", "paths.txt"]:
+            if os.path.exists(self._path(name)):
+                os.remove(self._path(name))
+        self.meta = {"checkpoint_hash": checkpoint_hash, "dataset_fingerprint": dataset_fingerprint([]), "dtype": dtype or self.meta["dtype"], "dim": 0, "count": 0, "num_queries": num_queries}
+        self._write_meta()
+
+    def append(self, features, pids, cids, paths, tracks=None):
+        """ Add entries at the end of the store.
+
+        Args:
+            features (ndarray): (n, dim) features
+            pids, cids (array-like): n identities and camera IDs
+            paths (list): n image paths
+            tracks (array-like): Optional. n track indices
+        """
+        features = np.ascontiguousarray(features, dtype=self.meta["dtype"])
+        if self.count > 0 and features.shape[1] != self.meta["dim"]:
+            raise ValueError("Appending features of dimension %i to an embedding store of dimension %i"%(features.shape[1], self.meta["dim"]))
+        tracks = np.full(len(features), -1, dtype=np.int64) if tracks is None else tracks
+        # anything past `count` is left over from an interrupted append, and is dropped first
+        row_bytes = {"features.bin": features.shape[1] * features.dtype.itemsize, "pids.bin": 8, "cids.bin": 8, "tracks.bin": 8}
+        for name, data in [("features.bin", features), ("pids.bin", pids), ("cids.bin", cids), ("tracks.bin", tracks)]:
+            with open(self._path(name), "ab") as data_file:
+                data_file.truncate(self.count * row_bytes[name])
+                data_file.write(np.ascontiguousarray(data, dtype=features.dtype if name == "features.bin" else np.int64).tobytes())
+        stored_paths = self.paths
+        with open(self._path("paths.txt"), "w") as paths_file:
+            paths_file.write("\n".join(stored_paths + [str(path) for path in paths]))
+
+        self.meta["dim"] = features.shape[1]
+        self.meta["count"] = self.count + len(features)
+        self.meta["dataset_fingerprint"] = dataset_fingerprint(zip(self.paths, self.pids, self.cids))
+        self._write_meta()
+
+    def _write_meta(self):
+        # written last, so an interrupted write leaves the previous meta (and count) in place
+        with open(self._path("meta.json.tmp"), "w") as meta_file:
+            json.dump(self.meta, meta_file)
+        os.replace(self._path("meta.json.tmp"), self._path("meta.json"))
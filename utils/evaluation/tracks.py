@@ -0,0 +1,58 @@
+import numpy as np
+import torch
+
+
+def _track_groups(track_index, num_tracks):
+    # column order that groups gallery entries by track, the start of each non-empty group, and the tracks those groups belong to
+    track_index = np.asarray(track_index)
+    order = np.argsort(track_index, kind="mergesort")
+    counts = np.bincount(track_index, minlength=num_tracks)
+    present = np.nonzero(counts)[0]
+    starts = (np.cumsum(counts) - counts)[present]
+    return order, starts, present, counts
+
+
+def track_distances(distmat, track_index, num_tracks=None, pooling="min"):
+    """ Aggregate query-to-image distances into query-to-track distances.
+
+    Args:
+        distmat (array-like): Query-to-gallery distances with shape (num_queries, num_gallery). Torch tensors are accepted.
+        track_index (ndarray): Track of each gallery image, shape (num_gallery,)
+        num_tracks (int): Number of tracks. Defaults to max(track_index)+1. Tracks without images get distance inf.
+        pooling (str): 'min' for the closest image of each track, 'mean' for the average distance to its images
+
+    Returns:
+        ndarray: Query-to-track distances with shape (num_queries, num_tracks)
+    """
+    distmat = np.asarray(distmat)
+    track_index = np.asarray(track_index)
+    num_tracks = int(track_index.max()) + 1 if num_tracks is None else num_tracks
+    order, starts, present, counts = _track_groups(track_index, num_tracks)
+    track_distmat = np.full((distmat.shape[0], num_tracks), np.inf, dtype=distmat.dtype)
+    if pooling == "min":
+        track_distmat[:, present] = np.minimum.reduceat(distmat[:, order], starts, axis=1)
+    elif pooling == "mean":
+        track_distmat[:, present] = np.add.reduceat(distmat[:, order], starts, axis=1) / counts[present]
+    else:
+        raise NotImplementedError("Track pooling must be one of ['min', 'mean', 'centroid']. Got %s"%pooling)
+    return track_distmat
+
+
+def track_centroids(gallery_features, track_index, num_tracks=None):
+    """ Mean feature of each track.
+
+    Args:
+        gallery_features (torch.Tensor): Gallery features with shape (num_gallery, d)
+        track_index (ndarray): Track of each gallery image, shape (num_gallery,)
+        num_tracks (int): Number of tracks. Defaults to max(track_index)+1. Tracks without images get a zero centroid.
+
+    Returns:
+        torch.Tensor: Track centroids with shape (num_tracks, d)
+    """
+    track_index = torch.as_tensor(np.asarray(track_index), dtype=torch.int64)
+    num_tracks = int(track_index.max()) + 1 if num_tracks is None else num_tracks
+    centroids = torch.zeros(num_tracks, gallery_features.size(1), dtype=gallery_features.dtype)
+    centroids.index_add_(0, track_index, gallery_features)
+    counts = torch.zeros(num_tracks, dtype=gallery_features.dtype)
+    counts.index_add_(0, track_index, torch.ones(len(track_index), dtype=gallery_features.dtype))
+    return centroids / counts.clamp(min=1).unsqueeze(1)
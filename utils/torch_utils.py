@@ -1,3 +1,4 @@
+import os
 import torch
 from collections import OrderedDict
 
@@ -34,4 +35,35 @@ def rename_state_dict_keys(source, key_transformation, target=None):
         new_key = key_transformation(key)
         new_state_dict[new_key] = value
 
-    torch.save(new_state_dict, target)
\ No newline at end of file
+    torch.save(new_state_dict, target)
+
+def resolve_device(device=None):
+    """ The torch.device to run on.
+
+    Args:
+        device (str): 'cuda', 'cuda:N', or 'cpu'. None or 'auto' picks CUDA when a GPU is available, and CPU otherwise.
+    """
+    if device is None or device == "auto":
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+    return torch.device(device)
+
+
+def configure_threads(intra_op_threads=None, inter_op_threads=None, device=None, processes=1):
+    """ Size PyTorch's CPU thread pools.
+
+    Args:
+        intra_op_threads (int): Threads used inside a single op (matmul, conv). None splits the cores between processes on CPU runs, unless OMP_NUM_THREADS is set, and keeps the PyTorch default otherwise.
+        inter_op_threads (int): Threads used to run independent ops in parallel. None keeps the PyTorch default.
+        device (torch.device): Device the run trains on
+        processes (int): Processes of a multi-process run on this machine, which share its cores
+
+    Returns:
+        (int, int): Intra-op and inter-op thread counts in effect
+    """
+    if intra_op_threads is not None:
+        torch.set_num_threads(intra_op_threads)
+    elif device is not None and torch.device(device).type == "cpu" and "OMP_NUM_THREADS" not in os.environ:
+        torch.set_num_threads(max((os.cpu_count() or 1) // processes, 1))
+    if inter_op_threads is not None and hasattr(torch, "set_num_interop_threads"):
+        torch.set_num_interop_threads(inter_op_threads)
+    return torch.get_num_threads(), (torch.get_num_interop_threads() if hasattr(torch, "get_num_interop_threads") else None)
@@ -3,6 +3,7 @@ import kaptan
 import click
 import utils
 import torch, torchsummary, torchvision
+from utils.torch_utils import resolve_device, configure_threads
 
 
 @click.command()
@@ -44,10 +45,13 @@ def main(config, mode, weights):
     else:
         backup_logger = None
 
-    NUM_GPUS = torch.cuda.device_count()
+    DEVICE = resolve_device(config.get("EXECUTION.DEVICE", None))
+    INTRA_OP_THREADS, INTER_OP_THREADS = configure_threads(config.get("EXECUTION.INTRA_OP_THREADS", None), config.get("EXECUTION.INTER_OP_THREADS", None), device=DEVICE)
+    NUM_GPUS = torch.cuda.device_count() if DEVICE.type == "cuda" else 0
     if NUM_GPUS > 1:
         raise RuntimeError("Not built for multi-GPU. Please start with single-GPU.")
     logger.info("Found %i GPUs"%NUM_GPUS)
+    logger.info("Running on {} with {} intra-op and {} inter-op threads".format(DEVICE, INTRA_OP_THREADS, INTER_OP_THREADS))
 
 
     # --------------------- BUILD GENERATORS ------------------------
@@ -94,16 +98,16 @@ def main(config, mode, weights):
     logger.info("Finished instantiating model")
 
     if mode == "test":
-        vaegan_model.load_state_dict(torch.load(weights))
-        vaegan_model.cuda()
+        vaegan_model.load_state_dict(torch.load(weights, map_location=DEVICE))
+        vaegan_model.to(DEVICE)
         vaegan_model.eval()
     else:
-        vaegan_model.cuda()
+        vaegan_model.to(DEVICE)
         #logger.info(torchsummary.summary(vaegan_model, input_size=(config.get("TRANSFORMATION.CHANNELS"), *config.get("DATASET.SHAPE"))))
-        logger.info(torchsummary.summary(vaegan_model.Encoder, input_size=(config.get("TRANSFORMATION.CHANNELS"), *config.get("DATASET.SHAPE"))))
-        logger.info(torchsummary.summary(vaegan_model.Decoder, input_size=(config.get("MODEL.LATENT_DIMENSIONS"), 1)))
-        logger.info(torchsummary.summary(vaegan_model.LatentDiscriminator, input_size=(config.get("MODEL.LATENT_DIMENSIONS"), 1)))
-        logger.info(torchsummary.summary(vaegan_model.Discriminator, input_size=(config.get("TRANSFORMATION.CHANNELS"), *config.get("DATASET.SHAPE"))))
+        logger.info(torchsummary.summary(vaegan_model.Encoder, input_size=(config.get("TRANSFORMATION.CHANNELS"), *config.get("DATASET.SHAPE")), device=DEVICE.type))
+        logger.info(torchsummary.summary(vaegan_model.Decoder, input_size=(config.get("MODEL.LATENT_DIMENSIONS"), 1), device=DEVICE.type))
+        logger.info(torchsummary.summary(vaegan_model.LatentDiscriminator, input_size=(config.get("MODEL.LATENT_DIMENSIONS"), 1), device=DEVICE.type))
+        logger.info(torchsummary.summary(vaegan_model.Discriminator, input_size=(config.get("TRANSFORMATION.CHANNELS"), *config.get("DATASET.SHAPE")), device=DEVICE.type))
     
 
     # --------------------- INSTANTIATE LOSS ------------------------
@@ -151,7 +155,7 @@ def main(config, mode, weights):
     logger.info("Loaded {} from {} to build VAEGAN model".format(config.get("EXECUTION.TRAINER"), "trainer"))
 
     loss_stepper = Trainer(model=vaegan_model, loss_fn = None, optimizer = optimizer, scheduler = scheduler, train_loader = train_generator.dataloader, test_loader = test_generator.dataloader, epochs = config.get("EXECUTION.EPOCHS"), batch_size = config.get("TRANSFORMATION.BATCH_SIZE"), latent_size = config.get("MODEL.LATENT_DIMENSIONS"), logger = logger)
-    loss_stepper.setup(step_verbose = config.get("LOGGING.STEP_VERBOSE"), save_frequency=config.get("SAVE.SAVE_FREQUENCY"), test_frequency = config.get("EXECUTION.TEST_FREQUENCY"), save_directory = MODEL_SAVE_FOLDER, save_backup = DRIVE_BACKUP, backup_directory = CHECKPOINT_DIRECTORY, gpus=NUM_GPUS, fp16 = config.get("OPTIMIZER.FP16"), model_save_name = MODEL_SAVE_NAME, logger_file = LOGGER_SAVE_NAME)
+    loss_stepper.setup(step_verbose = config.get("LOGGING.STEP_VERBOSE"), save_frequency=config.get("SAVE.SAVE_FREQUENCY"), test_frequency = config.get("EXECUTION.TEST_FREQUENCY"), save_directory = MODEL_SAVE_FOLDER, save_backup = DRIVE_BACKUP, backup_directory = CHECKPOINT_DIRECTORY, gpus=NUM_GPUS, fp16 = config.get("OPTIMIZER.FP16"), model_save_name = MODEL_SAVE_NAME, logger_file = LOGGER_SAVE_NAME, device = DEVICE)
     if mode == 'train':
       loss_stepper.train(continue_epoch=previous_stop)
     elif mode == 'test':